@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Benchmark the OHMEC utilities on the study datasets.
+
+Each stage is timed --repeat times on each study file, and the best time
+is what gets compared (the others are mostly noise from the machine):
+
+  load              load_ohmec_geojson() of the file's text, read included
+  resolve           FeatureStore() of the parsed dataset: indexing and
+                    coordinate_copy / coordinate_copies resolution
+  shapes            Shapely shapes of every polygon feature
+  check_boundaries  check_boundaries.py FILE, without a pair cache
+  check_merges      check_merges.py --sweep FILE
+  geojson2kml       geojson2kml.py FILE --all
+  kml2geojson       kml2geojson.py on the KML geojson2kml.py wrote
+
+The first three run in this process; the scripts run as subprocesses, so
+their times include interpreter start-up and imports, as a user sees them.
+
+Results are written as JSON (--out), along with the Python, Shapely and
+GEOS versions and the machine. Given a --baseline (by default the one
+kept under .ohmec_cache/), every stage that got slower by more than
+--threshold, and by more than --min-delta seconds, is reported and the
+exit status is 1. --save-baseline makes this run the baseline. Times
+only compare on the same machine; a baseline from another one is
+reported, and compared anyway.
+
+Usage:
+  benchmark.py [--repeat N] [--stages load,shapes,...] [--out FILE]
+               [--baseline FILE] [--threshold 0.2] [--save-baseline] [file ...]
+  With no files, benchmarks all ohmec_data_*.geojson in the repo root.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+ROOT = Path(__file__).resolve().parents[1]
+UTILITIES = Path(__file__).resolve().parent
+sys.path.insert(0, str(UTILITIES))
+from feature_store import FeatureStore  # noqa: E402
+from load_ohmec_geojson import load_ohmec_geojson  # noqa: E402
+
+RESULTS_FORMAT = 1
+DEFAULT_OUT = ROOT / ".ohmec_cache" / "benchmark.json"
+DEFAULT_BASELINE = ROOT / ".ohmec_cache" / "benchmark_baseline.json"
+STAGES = ("load", "resolve", "shapes", "check_boundaries", "check_merges", "geojson2kml", "kml2geojson")
+
+
+class StageError(RuntimeError):
+  """A script being timed failed."""
+
+
+def _run(args: list, stdout=subprocess.DEVNULL) -> None:
+  proc = subprocess.run([sys.executable, *[str(a) for a in args]], stdout=stdout,
+                        stderr=subprocess.PIPE, cwd=ROOT)
+  if proc.returncode:
+    raise StageError(f"{Path(str(args[0])).name} exited {proc.returncode}: "
+                     f"{proc.stderr.decode(errors='replace').strip()[-500:]}")
+
+
+class Dataset:
+  """One study file and the setup its stages share, done outside the timings."""
+
+  def __init__(self, path: Path, workdir: Path):
+    self.path = path
+    self.kml = workdir / (path.stem + ".kml")
+    self._struct = None
+
+  def struct(self) -> dict:
+    if self._struct is None:
+      self._struct = load_ohmec_geojson(self.path.read_text(encoding="utf-8"))[0]
+    return self._struct
+
+  def stage(self, name: str) -> tuple[Callable | None, Callable]:
+    """(setup, timed) for a stage; setup runs before every timed call and
+    returns its argument."""
+    if name == "load":
+      return None, lambda _arg: load_ohmec_geojson(self.path.read_text(encoding="utf-8"))
+    if name == "resolve":
+      return self.struct, FeatureStore
+    if name == "shapes":
+      # a fresh store each time, since a store builds each shape once
+      return lambda: FeatureStore(self.struct()), lambda store: [store.shape(f["id"]) for f in store.polygons()]
+    if name == "check_boundaries":
+      return None, lambda _arg: _run([UTILITIES / "check_boundaries.py", self.path])
+    if name == "check_merges":
+      return None, lambda _arg: _run([UTILITIES / "check_merges.py", "--sweep", self.path])
+    if name == "geojson2kml":
+      return self._kml_file, lambda fh: _run([UTILITIES / "geojson2kml.py", self.path, "--all"], stdout=fh)
+    if name == "kml2geojson":
+      return self._kml_input, lambda _arg: _run([UTILITIES / "kml2geojson.py", self.kml])
+    raise ValueError(f"unknown stage {name!r}")
+
+  def _kml_file(self):
+    return open(self.kml, "wb")
+
+  def _kml_input(self) -> None:
+    if not self.kml.exists():
+      with self._kml_file() as fh:
+        _run([UTILITIES / "geojson2kml.py", self.path, "--all"], stdout=fh)
+
+
+def time_stage(dataset: Dataset, name: str, repeat: int) -> list[float]:
+  setup, timed = dataset.stage(name)
+  runs = []
+  for _n in range(repeat):
+    arg = setup() if setup else None
+    started = time.perf_counter()
+    try:
+      timed(arg)
+    finally:
+      if hasattr(arg, "close"):
+        arg.close()
+    runs.append(time.perf_counter() - started)
+  return runs
+
+
+def environment() -> dict:
+  import shapely.geometry
+  geos = getattr(shapely, "geos_version_string", None) or shapely.geos.geos_version_string
+  return {
+    "python": platform.python_version(),
+    "shapely": shapely.__version__,
+    "geos": geos,
+    "machine": f"{platform.node()} {platform.machine()} {os.cpu_count()} CPUs",
+  }
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta: float) -> list[str]:
+  """Stages slower than in baseline by more than threshold and min_delta."""
+  slower = []
+  for name, stages in results["datasets"].items():
+    for stage, entry in stages.items():
+      old = baseline.get("datasets", {}).get(name, {}).get(stage)
+      if not old:
+        continue
+      new_best, old_best = entry["best"], old["best"]
+      if new_best - old_best > min_delta and new_best > old_best * (1 + threshold):
+        slower.append(f"{name} {stage}: {old_best:.3f}s -> {new_best:.3f}s "
+                      f"(+{100 * (new_best / old_best - 1):.0f}%)")
+  return slower
+
+
+def write_json(path: Path, data: dict) -> None:
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp = path.with_name(path.name + ".tmp")
+  tmp.write_text(json.dumps(data, indent=1) + "\n", encoding="utf-8")
+  os.replace(tmp, path)
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Time the OHMEC utilities on the study datasets.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--repeat", "-n", type=int, default=3, metavar="N",
+                      help="time each stage N times and keep the best (default %(default)s)")
+  parser.add_argument("--stages", default=",".join(STAGES),
+                      help="comma-separated stages to run (default: all of %(default)s)")
+  parser.add_argument("--out", "-o", type=Path, default=DEFAULT_OUT,
+                      help="results file (default %(default)s)")
+  parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE,
+                      help="results to compare against, if the file exists (default %(default)s)")
+  parser.add_argument("--save-baseline", action="store_true",
+                      help="also write this run's results to the baseline file")
+  parser.add_argument("--threshold", type=float, default=0.2,
+                      help="relative slowdown to report, 0.2 being 20%% (default %(default)s)")
+  parser.add_argument("--min-delta", type=float, default=0.02, metavar="SECONDS",
+                      help="ignore slowdowns smaller than this (default %(default)s)")
+  args = parser.parse_args(argv[1:])
+  if args.repeat < 1:
+    parser.error("--repeat must be at least 1")
+  stages = [stage for stage in args.stages.split(",") if stage]
+  unknown = [stage for stage in stages if stage not in STAGES]
+  if unknown:
+    parser.error(f"unknown stage(s) {', '.join(unknown)}; choose from {', '.join(STAGES)}")
+  # the scripts run from the repo root
+  files = [path.resolve() for path in args.files] or sorted(ROOT.glob("ohmec_data_*.geojson"))
+
+  results = {"format": RESULTS_FORMAT, "repeat": args.repeat, "environment": environment(), "datasets": {}}
+  with tempfile.TemporaryDirectory() as workdir:
+    for path in files:
+      dataset = Dataset(path, Path(workdir))
+      entries = results["datasets"][path.name] = {}
+      for stage in stages:
+        try:
+          runs = time_stage(dataset, stage, args.repeat)
+        except StageError as err:
+          print(f"{path.name}: {stage}: {err}", file=sys.stderr)
+          return 2
+        entries[stage] = {"best": min(runs), "median": statistics.median(runs), "runs": runs}
+        print(f"{path.name:36s} {stage:17s} {min(runs):8.3f}s  (median {statistics.median(runs):.3f}s)")
+
+  write_json(args.out, results)
+  print(f"results written to {args.out}")
+
+  status = 0
+  if args.baseline.is_file() and not args.save_baseline:
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    if baseline.get("format") != RESULTS_FORMAT:
+      print(f"{args.baseline}: not a format {RESULTS_FORMAT} results file, not compared", file=sys.stderr)
+    else:
+      if baseline.get("environment") != results["environment"]:
+        print(f"note: baseline is from {baseline.get('environment')}", file=sys.stderr)
+      slower = compare(results, baseline, args.threshold, args.min_delta)
+      for line in slower:
+        print(f"SLOWER {line}", file=sys.stderr)
+      if slower:
+        print(f"{len(slower)} stage(s) more than {100 * args.threshold:.0f}% slower than {args.baseline}",
+              file=sys.stderr)
+        status = 1
+      else:
+        print(f"no stage more than {100 * args.threshold:.0f}% slower than {args.baseline}")
+  if args.save_baseline:
+    write_json(args.baseline, results)
+    print(f"baseline written to {args.baseline}")
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
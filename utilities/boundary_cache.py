@@ -0,0 +1,93 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Persistent pair-verdict cache for check_boundaries.py.
+
+Each feature gets a digest of everything compare_features looks at: its id,
+resolved geometry, dates and waiver properties. A pair verdict is stored
+under both digests plus the reported start date, so editing one feature
+only invalidates the pairs it takes part in. Entries that a run did not
+use are dropped when the cache is saved.
+
+The file is plain JSON with sorted keys and no paths or timestamps, so it
+can be committed or kept as a CI cache artifact. A different cache format,
+checker version or GEOS version discards it wholesale.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+CACHE_FORMAT = 1
+
+# feature properties that change a pair verdict
+VERDICT_PROPERTIES = ("startdatestr", "enddatestr", "waive_overlap", "waive_double", "waive_point")
+
+
+def feature_digest(feat: dict, geometry: dict) -> str:
+  """Digest of a feature's id, resolved geometry and verdict properties."""
+  props = feat["properties"]
+  key = {
+    "id": feat["id"],
+    "type": geometry["type"],
+    "coordinates": geometry["coordinates"],
+    "properties": {name: props[name] for name in VERDICT_PROPERTIES if name in props},
+  }
+  text = json.dumps(key, sort_keys=True, separators=(",", ":"))
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+
+class PairCache:
+  """Verdicts keyed by pair_key(); load() never fails, a bad file is a miss."""
+
+  def __init__(self, path: Path, engine: str):
+    self.path = Path(path)
+    self.engine = engine
+    self.entries: dict[str, list] = {}
+    self.used: dict[str, list] = {}
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def pair_key(digestA: str, digestB: str, first_date: str) -> str:
+    return digestA + ":" + digestB + ":" + first_date
+
+  def load(self) -> None:
+    try:
+      data = json.loads(self.path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+      return
+    if (isinstance(data, dict) and data.get("format") == CACHE_FORMAT
+        and data.get("engine") == self.engine and isinstance(data.get("pairs"), dict)):
+      self.entries = data["pairs"]
+
+  def get(self, key: str):
+    """Return (result, report lines) or None, marking the entry as live."""
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.used[key] = entry
+    return entry[0], entry[1]
+
+  def put(self, key: str, result: int, lines: list[str]) -> None:
+    self.used[key] = [result, lines]
+
+  def evicted(self) -> int:
+    return sum(1 for key in self.entries if key not in self.used)
+
+  def save(self) -> None:
+    """Write only the entries this run used, atomically, one pair per line
+    so that a committed cache diffs cleanly."""
+    pairs = [json.dumps(key) + ": " + json.dumps(self.used[key], separators=(",", ":"))
+             for key in sorted(self.used)]
+    tmp = self.path.with_name(self.path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fh:
+      fh.write('{"format": ' + json.dumps(CACHE_FORMAT) + ', "engine": ' + json.dumps(self.engine) + ', "pairs": {\n')
+      fh.write(",\n".join(pairs))
+      fh.write("\n}}\n")
+    os.replace(tmp, self.path)
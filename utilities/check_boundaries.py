@@ -8,7 +8,11 @@
    then indicate the intersection as a possible error. Allow an overlap
    or double intersection waiver to be in the properties of the database.
 
-   Usage: check_boundaries.py geojsonfile
+   --stats FILE writes a JSON report of the time spent per phase and of
+   the pair and GEOS call counts to FILE ("-" for stderr), see
+   run_stats.py; --profile FILE dumps a cProfile profile of the run.
+
+   Usage: check_boundaries.py [--jobs N] [--cache FILE] [--stats FILE] [--profile FILE] geojsonfile
 """
 
 __author__     = "OHMEC"
@@ -16,122 +20,119 @@ __copyright__  = "Copyright OHMEC contributors"
 __license__    = "Apache License, Version 2.0"
 
 import sys
+import time
 import json
+import argparse
+import collections
+import multiprocessing
 import geojson
 from functools import partial
 from ctypes.util import find_library
 find_library('geos_c')
 import shapely.geometry
 import shapely.ops
+import shapely.prepared
+from shapely.strtree import STRtree
 import re
+from feature_store import FeatureStore, FeatureStoreError, POLYGONAL
+from boundary_cache import PairCache, feature_digest
+from run_stats import RunStats
 
-geoms = {}
 shapes = {}
 borderless = {}
 overlap_waiver = {}
 double_waiver = {}
 point_waiver = {}
-already_handled = {}
-
-if(len(sys.argv) < 2):
-  sys.stderr.write("usage: check_boundaries.py filename\n")
-  sys.exit(2)
-filename = sys.argv[1]
+prepared = {}
+uses = collections.Counter()
+geos_calls = collections.Counter()
 
-filehandle = open(filename, mode='r')
-fullfile = filehandle.read()
-filehandle.close()
+# prepare a feature's geometry once it has been compared this many times
+PREPARE_AFTER = 3
 
+# candidate pairs handed to compare_features (or a worker) at a time
+BATCH_SIZE = 64
 
-from load_ohmec_geojson import load_ohmec_geojson
-fullstruct, _varname = load_ohmec_geojson(fullfile)
+# bump whenever compare_features changes a verdict or its report lines, so
+# that --cache files written by older versions are discarded
+CHECKER_VERSION = 1
 
-def get_first_date(startA, startB, strA, strB):
-  if startA <= startB:
-    return strB
-  return strA
+def predicate_shape(idA, idB):
+  '''Return (geometry, other geometry, call kind) to evaluate the
+  symmetric A-vs-B predicates with. A feature is prepared once it has
+  taken part in PREPARE_AFTER pairs in this process; its prepared form
+  then serves every later pair it shows up in.'''
+  uses[idA] += 1
+  uses[idB] += 1
+  for thisid, otherid in ((idA, idB), (idB, idA)):
+    if thisid not in prepared and uses[thisid] >= PREPARE_AFTER:
+      geos_calls["prepare"] += 1
+      prepared[thisid] = shapely.prepared.prep(shapes[thisid])
+    if thisid in prepared:
+      return prepared[thisid], shapes[otherid], "prepared_"
+  return shapes[idA], shapes[idB], ""
 
-def date_overlap(startA, endA, startB, endB):
-  if startA <= startB and endA >= startB:
-    return 1
-  if startA <= endB and endA >= endB:
-    return 1
-  if startB <= startA and endB >= startA:
-    return 1
-  if startB <= endA and endB >= endA:
-    return 1
-  return 0
-
-def compare_features(idA, idB, first_date):
+def compare_features(idA, idB, first_date, out):
   '''Check if features A and B have a) no intersection (skip);
   b) has "clean" intersection (defined as a single LineString); c) has
   a double intersection (>= 2 LineStrings), could be OK but most likely
   a seam; or d) overlap (most likely an error, though some are acceptable).
-  properties.borderless or Indigenous types are skipped'''
+  properties.borderless or Indigenous types are skipped. Error report lines
+  are appended to out rather than printed, so workers can hand them back.
+  The intersection itself is only computed on the paths that report or
+  classify it.'''
   if idA in borderless or idB in borderless:
     return 0
-  if not shapes[idA].intersects(shapes[idB]):
+  pred, other, kind = predicate_shape(idA, idB)
+  geos_calls[kind + "intersects"] += 1
+  if not pred.intersects(other):
     return 0
+  geos_calls[kind + "overlaps"] += 1
+  if pred.overlaps(other):
+    if idA in overlap_waiver or idB in overlap_waiver:
+      return 1
+    geos_calls["intersection"] += 1
+    intAB = shapes[idA].intersection(shapes[idB])
+    out.append("ERR:  intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in overlap")
+    out.append("  " + str(intAB))
+    return 2
+  geos_calls["intersection"] += 1
   intAB = shapes[idA].intersection(shapes[idB])
-  if shapes[idA].overlaps(shapes[idB]):
-    if not idA in overlap_waiver and not idB in overlap_waiver:
-      print("ERR:  intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in overlap")
-      print("  " + str(intAB))
-      return 2
-  else:
-    intABtype = intAB.geom_type
-    if intABtype == 'Point' or intABtype == 'MultiPoint':
-      if idA in point_waiver or idB in point_waiver:
-        return 1
-      else:
-        print("ERR: intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in " + intABtype + ":")
-        print("  " + str(intAB))
-        return 4
-    if intABtype == 'LineString':
+  intABtype = intAB.geom_type
+  if intABtype == 'Point' or intABtype == 'MultiPoint':
+    if idA in point_waiver or idB in point_waiver:
       return 1
-    if intABtype == 'MultiLineString':
-      # this coule be harmless, or could be a double-touch. the way to find out
-      # is to get its boundary, and check if length 2 or not
-      bound = intAB.boundary
-      if len(bound) == 2:
-        return 1
-      elif idA in double_waiver or idB in double_waiver:
-        return 1
-      else:
-        if len(bound) == 0:
-          return 1
-        print("ERR: intAB for " + idA + " with " + idB + " on date " + first_date + " is a MultiLine String. Here is its boundary")
-        print("  " + str(bound) + " of length " + str(len(bound)))
-        return 3
-    if intABtype == 'Polygon' or intABtype == 'MultiPolygon':
-      if idA in overlap_waiver or idB in overlap_waiver:
+    else:
+      out.append("ERR: intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in " + intABtype + ":")
+      out.append("  " + str(intAB))
+      return 4
+  if intABtype == 'LineString':
+    return 1
+  if intABtype == 'MultiLineString':
+    # this coule be harmless, or could be a double-touch. the way to find out
+    # is to get its boundary, and check if length 2 or not
+    geos_calls["boundary"] += 1
+    bound = intAB.boundary
+    bound_len = len(bound.geoms) if hasattr(bound, "geoms") else 1
+    if bound_len == 2:
+      return 1
+    elif idA in double_waiver or idB in double_waiver:
+      return 1
+    else:
+      if bound_len == 0:
         return 1
-    if not idA in double_waiver and not idB in double_waiver:
-      print("ERR:  intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in " + intABtype + ":")
-      print("  " + str(intAB))
+      out.append("ERR: intAB for " + idA + " with " + idB + " on date " + first_date + " is a MultiLine String. Here is its boundary")
+      out.append("  " + str(bound) + " of length " + str(bound_len))
       return 3
+  if intABtype == 'Polygon' or intABtype == 'MultiPolygon':
+    if idA in overlap_waiver or idB in overlap_waiver:
+      return 1
+  if not idA in double_waiver and not idB in double_waiver:
+    out.append("ERR:  intersection of " + idA + " with " + idB + " on date " + first_date + " resulted in " + intABtype + ":")
+    out.append("  " + str(intAB))
+    return 3
   return 1
 
-def conv_date(datestr,is_start):
-  fm = re.fullmatch("(\d+)BC", datestr)
-  if fm:
-    val = int(fm.group(1))*-1
-    if is_start:
-      return val
-    return val + 0.99999
-  if datestr == 'present':
-    return 2100
-  args = datestr.split(':')
-  if len(args) == 3:
-    return int(args[0]) + (int(args[1])-1)/12 + (int(args[2])-1)/366
-  if len(args) == 2:
-    if is_start:
-      return int(args[0]) + (int(args[1])-1)/12
-    return int(args[0]) + int(args[1])/12 - 0.0001
-  if is_start:
-    return int(datestr)
-  return int(datestr)+0.9999
-
 def check_props(feat):
   idf = feat["id"]
   propsf = feat["properties"]
@@ -143,90 +144,248 @@ def check_props(feat):
     point_waiver[idf] = 1
   if 'borderless' in propsf:
     borderless[idf] = propsf['borderless']
-  elif propsf['entity1name'] == 'Indigenous' and propsf['entity2type'] == 'tribe':
+  elif 'entity1name' not in propsf and 'Name' in propsf:
+    # native-land.ca features, which the viewer converts to Indigenous tribes
+    borderless[idf] = 1
+  elif propsf['entity1name'] == 'Indigenous' and propsf.get('entity2type') == 'tribe':
     borderless[idf] = 1
   elif propsf['entity1name'] == 'mountain range':
     borderless[idf] = 1
-  elif propsf['entity1type'] == 'tribe' or propsf['entity1type'] == 'reservation' or propsf['entity1type'] == 'pueblo':
+  elif propsf.get('entity1type') in ('tribe', 'reservation', 'pueblo'):
     borderless[idf] = 1
 
-# Go through each feature with other features. Only check one vs the other
-# if it shares a common date.
-boundary_count = 0
-overlap_count = 0
-gap_count = 0
-point_count = 0
-
-def get_geoms(thisfeat):
-  thisid = thisfeat["id"]
-  if "coordinate_copy" in thisfeat["geometry"]:
-    copyname = thisfeat["geometry"]["coordinate_copy"]
-    if copyname in geoms:
-      return geoms[copyname]
-    else:
-      sys.stderr.write("can't handle out of order coordinate copies at this time.\n")
-      sys.stderr.write(thisid + " needs copy from " + copyname + "\n")
-      sys.exit(2)
-  elif "coordinate_copies" in thisfeat["geometry"]:
-    thisfeat["geometry"]["coordinates"] = []
-    for copyname in thisfeat["geometry"]["coordinate_copies"]:
-      if geoms[copyname]["type"] == "Polygon":
-        thisfeat["geometry"]["coordinates"].append(geoms[copyname]["coordinates"])
-      if geoms[copyname]["type"] == "MultiPolygon":
-        for subarray in geoms[copyname]["coordinates"]:
-          thisfeat["geometry"]["coordinates"].append(subarray)
-    return thisfeat["geometry"]
-  else:
-    return thisfeat["geometry"]
-
-def get_shape(geoms):
-  return shapely.geometry.asShape(geoms)
-
-for feat1 in fullstruct["features"]:
-  id1 = feat1["id"]
-  props1 = feat1["properties"]
-  if feat1["geometry"]["type"] == "Polygon" or feat1["geometry"]["type"] == "MultiPolygon":
-    if id1 not in geoms:
-      geoms[id1] = get_geoms(feat1)
-      shapes[id1] = get_shape(geoms[id1])
-      check_props(feat1)
-      if not shapes[id1].is_valid:
-        print(id1 + " is not valid\n")
+def candidate_pairs(features, intervals, stats):
+  '''List the pairs worth comparing from the (start, end, index)
+  intervals: one STRtree over the bounding boxes of the features' shapes
+  is queried once per feature, and of the pairs whose boxes touch, those
+  whose closed date intervals overlap are kept. Returns (indexA, indexB,
+  first_index) tuples with indexA < indexB (file order) and first_index
+  the one whose start date is reported, sorted by the later of the two in
+  (start, end, index) order and then the earlier one, so the report comes
+  out in the same order however the tree answers. Counts the box-touching
+  pairs in stats["bbox_pairs"] and the ones dropped for their dates in
+  stats["date_pruned"].'''
+  order = sorted(intervals)
+  boxes = [shapely.geometry.box(*shapes[features[index]["id"]].bounds) for _start, _end, index in order]
+  slot = {id(bbox): n for n, bbox in enumerate(boxes)}
+  tree = STRtree(boxes)
+  found = []
+  for n, bbox in enumerate(boxes):
+    start, end, index = order[n]
+    for hit in tree.query(bbox):
+      # shapely 1.x returns the geometries, 2.x their positions in the tree
+      m = slot[id(hit)] if hasattr(hit, "geom_type") else int(hit)
+      if m <= n:
+        continue
+      stats["bbox_pairs"] += 1
+      other_start, _other_end, other = order[m]
+      if end < other_start:
+        stats["date_pruned"] += 1
+        continue
+      idxA = index if index < other else other
+      idxB = other if index < other else index
+      # report the later start date; ties report the feature later in the file
+      found.append((m, n, idxA, idxB, other if start < other_start else idxB))
+  found.sort()
+  return [(idxA, idxB, first) for _m, _n, idxA, idxB, first in found]
+
+def load_shapes(store, run_stats):
+  '''Look up the shape of every polygon feature and return the date
+  intervals of those that can produce a verdict.'''
+  intervals = []
+  for index, feat in enumerate(store.features):
+    if feat["geometry"]["type"] not in POLYGONAL:
+      continue
+    thisid = feat["id"]
+    if thisid not in shapes:
+      with run_stats.phase("shapes"):
+        shapes[thisid] = store.shape(thisid)
+      check_props(feat)
+      with run_stats.phase("is_valid"):
+        valid = shapes[thisid].is_valid
+      if not valid:
+        run_stats.count("invalid_features")
+        print(str(thisid) + " is not valid\n")
         print("buffer version:")
-        buf = shapes[id1].buffer(0)
+        buf = shapes[thisid].buffer(0)
         print(buf)
-    start1 = conv_date(props1["startdatestr"],1)
-    end1 = conv_date(props1["enddatestr"],0)
-    for feat2 in fullstruct["features"]:
-      id2 = feat2["id"]
-      if id1 != id2 and (feat2["geometry"]["type"] == "Polygon" or feat2["geometry"]["type"] == "MultiPolygon"):
-        idA = id1 if id1 < id2 else id2
-        idB = id1 if id1 > id2 else id2
-        idAB = idA + ':' + idB
-        if idAB not in already_handled:
-          props2 = feat2["properties"]
-          if id2 not in shapes:
-            geoms[id2] = get_geoms(feat2)
-            shapes[id2] = get_shape(geoms[id2])
-            check_props(feat2)
-            if not shapes[id2].is_valid:
-              print(id2 + " is not valid\n")
-              print("buffer version:")
-              buf = shapes[id2].buffer(0)
-              print(buf)
-          start2 = conv_date(props2["startdatestr"],1)
-          end2 = conv_date(props2["enddatestr"],0)
-          if date_overlap(start1,end1,start2,end2):
-            first_date = get_first_date(start1,start2,props1["startdatestr"],props2["startdatestr"])
-            res = compare_features(idA,idB,first_date)
-            if res >= 1:
-              boundary_count += 1
-            if res == 2:
-              overlap_count += 1
-            if res == 3:
-              gap_count += 1
-            if res == 4:
-              point_count += 1
-        already_handled[idAB] = 1
-
-print("completed checking " + str(boundary_count) + " boundaries, with " + str(overlap_count) + " overlaps, " + str(gap_count) + " gaps and " + str(point_count) + " points")
+    # borderless features never produce a verdict, so keep them out of the pair listing
+    if thisid not in borderless:
+      with run_stats.phase("dates"):
+        start, end = store.date_range(index)
+      intervals.append((start, end, index))
+  return intervals
+
+def check_pairs(batch):
+  '''Run compare_features over a batch of (idA, idB, first_date) and return
+  a (result, report lines) tuple per pair, in order, along with the GEOS
+  calls the batch made and the (wall, CPU) time it took'''
+  wall, cpu = time.perf_counter(), time.process_time()
+  geos_calls.clear()
+  results = []
+  for idA, idB, first_date in batch:
+    out = []
+    res = compare_features(idA, idB, first_date, out)
+    results.append((res, out))
+  return results, dict(geos_calls), (time.perf_counter() - wall, time.process_time() - cpu)
+
+def init_worker(worker_shapes, worker_borderless, worker_overlap, worker_double, worker_point):
+  '''Give a pool process the state compare_features reads'''
+  shapes.update(worker_shapes)
+  borderless.update(worker_borderless)
+  overlap_waiver.update(worker_overlap)
+  double_waiver.update(worker_double)
+  point_waiver.update(worker_point)
+
+def batched(pairs, size):
+  batch = []
+  for pair in pairs:
+    batch.append(pair)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def main():
+  parser = argparse.ArgumentParser(description="Check features that overlap in time for overlaps, gaps and point touches in space.")
+  parser.add_argument("filename", help="OHMEC geojson file to check")
+  parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N",
+                      help="check candidate pairs in N worker processes (default 1)")
+  parser.add_argument("--cache", metavar="FILE",
+                      help="reuse pair verdicts from FILE and rewrite it with this run's verdicts")
+  parser.add_argument("--stats", metavar="FILE",
+                      help="write a JSON report of per-phase times and counters to FILE (- for stderr)")
+  parser.add_argument("--profile", metavar="FILE",
+                      help="dump a cProfile profile of the run to FILE")
+  args = parser.parse_args()
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+  run_stats = RunStats("check_boundaries.py")
+  run_stats.start_profile(args.profile)
+
+  try:
+    store = FeatureStore.load(args.filename, stats=run_stats)
+    intervals = load_shapes(store, run_stats)
+  except FeatureStoreError as err:
+    sys.stderr.write(str(err) + "\n")
+    sys.exit(2)
+  features = store.features
+
+  stats = {"bbox_pairs": 0, "date_pruned": 0}
+  with run_stats.phase("candidate_pairs"):
+    pairs = candidate_pairs(features, intervals, stats)
+
+  cache = None
+  if args.cache:
+    geos_version = getattr(shapely, "geos_version_string", None) or shapely.geos.geos_version_string
+    cache = PairCache(args.cache, "check_boundaries/" + str(CHECKER_VERSION) + " geos/" + geos_version)
+    cache.load()
+    digests = {}
+    for _start, _end, index in intervals:
+      thisid = features[index]["id"]
+      digests[thisid] = feature_digest(features[index], store.geometry(thisid))
+
+  def pairs_to_check():
+    for idx1, idx2, first_idx in pairs:
+      id1 = features[idx1]["id"]
+      id2 = features[idx2]["id"]
+      if id1 == id2:
+        continue
+      idA = id1 if id1 < id2 else id2
+      idB = id1 if id1 > id2 else id2
+      yield idA, idB, features[first_idx]["properties"]["startdatestr"]
+
+  # Only check one feature vs the other if they share a common date and
+  # their bounding boxes touch. Results come back in pair order whether
+  # they're computed here or in a pool, so the report is identical.
+  # Cached verdicts are resolved here; only the misses of each batch are
+  # sent on, and pending keeps the whole batch to merge the answers back in.
+  pending = collections.deque()
+  def batches():
+    for batch in batched(run_stats.timed("pair_ids", pairs_to_check()), BATCH_SIZE):
+      entries = []
+      misses = []
+      for pair in batch:
+        key = None
+        known = None
+        if cache is not None:
+          key = cache.pair_key(digests[pair[0]], digests[pair[1]], pair[2])
+          known = cache.get(key)
+        if known is None:
+          misses.append(pair)
+        entries.append((key, known))
+      pending.append(entries)
+      yield misses
+
+  if args.jobs > 1:
+    sweep_shapes = {features[index]["id"]: shapes[features[index]["id"]] for _start, _end, index in intervals}
+    pool = multiprocessing.Pool(args.jobs, initializer=init_worker,
+                                initargs=(sweep_shapes, borderless, overlap_waiver, double_waiver, point_waiver))
+    results = pool.imap(check_pairs, batches())
+  else:
+    pool = None
+    results = map(check_pairs, batches())
+
+  boundary_count = 0
+  overlap_count = 0
+  gap_count = 0
+  point_count = 0
+  total_calls = collections.Counter()
+  checked = 0
+  for computed, calls, (wall, cpu) in results:
+    run_stats.add("geos", wall, cpu)
+    total_calls.update(calls)
+    checked += len(computed)
+    computed = iter(computed)
+    for key, known in pending.popleft():
+      if known is None:
+        res, out = next(computed)
+        if cache is not None:
+          cache.put(key, res, out)
+      else:
+        res, out = known
+      for line in out:
+        print(line)
+      if res >= 1:
+        boundary_count += 1
+      if res == 2:
+        overlap_count += 1
+      if res == 3:
+        gap_count += 1
+      if res == 4:
+        point_count += 1
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  sys.stderr.write("dates pruned " + str(stats["date_pruned"]) + " of " + str(stats["bbox_pairs"]) + " bbox-touching pairs\n")
+  sys.stderr.write("GEOS calls over " + str(checked) + " compared pairs: " +
+                   ", ".join(name + "=" + str(total_calls[name]) for name in sorted(total_calls)) +
+                   " (" + "%.2f" % (sum(total_calls.values()) / max(checked, 1)) + " per pair)\n")
+  if cache is not None:
+    sys.stderr.write("cache " + args.cache + ": " + str(cache.hits) + " hits, " + str(cache.misses) + " misses, " + str(cache.evicted()) + " evicted\n")
+    cache.save()
+  print("completed checking " + str(boundary_count) + " boundaries, with " + str(overlap_count) + " overlaps, " + str(gap_count) + " gaps and " + str(point_count) + " points")
+
+  polygons = len(intervals)
+  run_stats.count("features", len(features))
+  run_stats.count("swept_polygons", polygons)
+  run_stats.count("pairs_possible", polygons * (polygons - 1) // 2)
+  run_stats.count("pruned_by_bbox", polygons * (polygons - 1) // 2 - stats["bbox_pairs"])
+  run_stats.count("pairs_enumerated", stats["bbox_pairs"])
+  run_stats.count("pruned_by_date", stats["date_pruned"])
+  run_stats.count("pairs_compared", checked)
+  run_stats.count("boundaries", boundary_count)
+  run_stats.count("overlaps", overlap_count)
+  run_stats.count("gaps", gap_count)
+  run_stats.count("points", point_count)
+  if cache is not None:
+    run_stats.count("cache_hits", cache.hits)
+    run_stats.count("cache_misses", cache.misses)
+  for name in sorted(total_calls):
+    run_stats.count("geos_" + name, total_calls[name])
+  run_stats.finish(args.stats)
+
+if __name__ == "__main__":
+  main()
@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
 """check_merges.py: read in a geojson file and merge all polygons valid
-   during a given date, or for all dates. The output is the merged polygon/
+   during a given date, or for all start dates. The output is the merged polygon/
    multi-polygon for the date, or one per date, with error messages printed
    out if there are merge failures.
 
-   Usage: check_merges.py geojsonfile [yyyy:mm:dd]
+   With --sweep, all dates are merged in one pass over the timeline: the
+   features valid at a date are kept in small buckets whose unions are
+   cached, so moving to the next date only re-unions the buckets that a
+   feature dropped out of, and then combines the bucket unions.
+
+   A feature is valid from the start of its startdatestr to the end of its
+   enddatestr, as in the viewer (see ohmec_dates.py).
+
+   --stats FILE writes a JSON report of the time spent per phase and of
+   the union counts to FILE ("-" for stderr), see run_stats.py;
+   --profile FILE dumps a cProfile profile of the run.
+
+   Usage: check_merges.py [--sweep] [--stats FILE] [--profile FILE] geojsonfile [yyyy:mm:dd]
 """
 
 __author__     = "OHMEC"
@@ -21,19 +33,45 @@ find_library('geos_c')
 import shapely.geometry
 import shapely.ops
 import re
+import heapq
+from run_stats import RunStats
 
-if(len(sys.argv) < 2):
-  sys.stderr.write("usage: check_merges.py filename [yyyy:mm:dd]\n")
+USAGE = "usage: check_merges.py [--sweep] [--stats FILE] [--profile FILE] filename [yyyy:mm:dd]\n"
+
+args = sys.argv[1:]
+sweep = "--sweep" in args
+if sweep:
+  args.remove("--sweep")
+options = {}
+for option in ("--stats", "--profile"):
+  if option in args:
+    at = args.index(option)
+    if(at + 1 >= len(args)):
+      sys.stderr.write(USAGE)
+      sys.exit(2)
+    options[option] = args[at + 1]
+    del args[at:at + 2]
+if(len(args) < 1):
+  sys.stderr.write(USAGE)
   sys.exit(2)
+run_stats = RunStats("check_merges.py")
+run_stats.start_profile(options.get("--profile"))
 alldates = 1
-filename = sys.argv[1]
-if(len(sys.argv) >= 3):
-  datestr = sys.argv[2]
+filename = args[0]
+if(len(args) >= 2):
+  datestr = args[1]
   alldates = 0
 
-filehandle = open(filename, mode='r')
-fullfile = filehandle.read()
-filehandle.close()
+from ohmec_dates import str2date
+if not alldates:
+  try:
+    str2date(datestr)
+  except ValueError as err:
+    sys.stderr.write(str(err) + "\n")
+    sys.exit(2)
+
+# features per cached union in --sweep mode
+BUCKET_SIZE = 16
 
 entity = {}
 entity["features"] = []
@@ -42,20 +80,30 @@ entity["type"] = "FeatureCollection"
 def check_date(thisdate):
   sys.stderr.write("checking " + thisdate + "\n")
   first = 1
-  for feature in fullstruct["features"]:
+  merged_polygon = shapely.geometry.GeometryCollection()
+  with run_stats.phase("date_filter"):
+    indices = list(store.date_index().at(str2date(thisdate)))
+  for index in indices:
+    feature = fullstruct["features"][index]
     props = feature["properties"]
     idname = feature["id"]
-    if props["startdatestr"] <= thisdate and thisdate <= props["enddatestr"]:
-      sys.stderr.write("for " + thisdate + ": merging id " + idname + " with dates " + props["startdatestr"] + " -> " + props["enddatestr"] + "\n")
-      if first:
-        merged_polygon = geoms[idname]
-      else:
+    sys.stderr.write("for " + thisdate + ": merging id " + idname + " with dates " + props["startdatestr"] + " -> " + props["enddatestr"] + "\n")
+    if first:
+      merged_polygon = geoms[idname]
+    else:
+      with run_stats.phase("union"):
         merged_polygon = merged_polygon.union(geoms[idname])
-      first = 0
+      run_stats.count("unions")
+    first = 0
+  add_merger(thisdate, merged_polygon)
+
+def add_merger(thisdate, merged_polygon):
   merged_feature = geojson.Feature(geometry=merged_polygon, properties={})
   merged_feature.id = "merged" + thisdate
-  mergedGeoms = shapely.geometry.asShape(merged_feature["geometry"])
-  if not mergedGeoms.is_valid:
+  with run_stats.phase("is_valid"):
+    valid = merged_polygon.is_valid
+  if not valid:
+    run_stats.count("invalid_mergers")
     sys.stderr.write("merger for date " + thisdate + " is not valid\n")
   properties = {}
   properties["entity1type"] = "nation"
@@ -68,20 +116,97 @@ def check_date(thisdate):
   merged_feature["properties"] = properties
   entity["features"].append(merged_feature)
 
-from load_ohmec_geojson import load_ohmec_geojson
-fullstruct, _varname = load_ohmec_geojson(fullfile)
+class Bucket:
+  def __init__(self):
+    self.ids = set()
+    self.union = None
+
+  def merged(self):
+    if self.union is None:
+      self.union = shapely.ops.unary_union([geoms[i] for i in self.ids])
+      run_stats.count("bucket_unions")
+    return self.union
+
+def sweep_dates(wanted):
+  '''Merge every date in wanted in one pass, in date order, and return
+  the merged geometry per date, with the same features as check_date.'''
+  features = fullstruct["features"]
+  starts, ends = store.dates()
+  order = sorted((i for i in range(len(features)) if starts[i] <= ends[i]), key=lambda i: starts[i])
+  ending = []
+  buckets = []
+  where = {}
+  active = {}
+  merged = {}
+  nextfeat = 0
+  for thisdate in sorted(wanted, key=str2date):
+    sys.stderr.write("checking " + thisdate + "\n")
+    with run_stats.phase("date_filter"):
+      when = str2date(thisdate)
+      while nextfeat < len(order) and starts[order[nextfeat]] <= when:
+        index = order[nextfeat]
+        nextfeat += 1
+        idname = features[index]["id"]
+        if not buckets or len(buckets[-1].ids) >= BUCKET_SIZE:
+          buckets.append(Bucket())
+        buckets[-1].ids.add(idname)
+        buckets[-1].union = None
+        where[index] = buckets[-1]
+        active[index] = idname
+        heapq.heappush(ending, (ends[index], index))
+      while ending and ending[0][0] < when:
+        _end, index = heapq.heappop(ending)
+        bucket = where.pop(index)
+        bucket.ids.discard(active.pop(index))
+        bucket.union = None
+      buckets = [bucket for bucket in buckets if bucket.ids]
+    for index in sorted(active):
+      props = features[index]["properties"]
+      sys.stderr.write("for " + thisdate + ": merging id " + active[index] + " with dates " + props["startdatestr"] + " -> " + props["enddatestr"] + "\n")
+    with run_stats.phase("union"):
+      merged[thisdate] = shapely.ops.unary_union([bucket.merged() for bucket in buckets])
+    run_stats.count("unions")
+  return merged
+
+from feature_store import FeatureStore, FeatureStoreError
+try:
+  store = FeatureStore.load(filename, stats=run_stats)
+except FeatureStoreError as err:
+  sys.stderr.write(str(err) + "\n")
+  sys.exit(2)
+fullstruct = store.struct
 geoms = {}
 startdates = {}
 
 for feature in fullstruct["features"]:
-  geoms[feature["id"]] = shapely.geometry.asShape(feature["geometry"])
-  if not geoms[feature["id"]].is_valid:
-    sys.stderr.write(feature["id"] + " is not valid\n")
-  props = feature["properties"]
-  startdates[props["startdatestr"]] = 1
-
-for thisdate in startdates:
-  if alldates or thisdate == datestr:
+  with run_stats.phase("shapes"):
+    geoms[feature["id"]] = store.shape(feature["id"])
+  with run_stats.phase("is_valid"):
+    valid = geoms[feature["id"]].is_valid
+  if not valid:
+    run_stats.count("invalid_features")
+    sys.stderr.write(str(feature["id"]) + " is not valid\n")
+
+with run_stats.phase("dates"):
+  starts, _ends = store.dates()
+  for index, feature in enumerate(fullstruct["features"]):
+    if starts[index] == starts[index]:  # not NaN: a usable startdatestr
+      startdates[feature["properties"]["startdatestr"]] = 1
+
+if alldates:
+  wanted = list(startdates)
+else:
+  wanted = [datestr]
+if sweep:
+  merged = sweep_dates(wanted)
+  for thisdate in wanted:
+    add_merger(thisdate, merged[thisdate])
+else:
+  for thisdate in wanted:
     check_date(thisdate)
 
-json.dump(entity, sys.stdout, indent=2)
+with run_stats.phase("output"):
+  json.dump(entity, sys.stdout, indent=2)
+run_stats.count("features", len(fullstruct["features"]))
+run_stats.count("dates_merged", len(wanted))
+run_stats.finish(options.get("--stats"))
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Compact quantized coordinates for OHMEC study files.
+
+Study coordinates are written to 5 decimals, so each one is an integer
+number of 1e-5 degrees. encode_study() replaces a geometry's
+"coordinates" with "qcoords", a base64 string of varints:
+
+  parts, then for each part its rings, then for each ring
+  its vertices followed by the vertex values, each x, y (and z) a
+  zigzag varint of its difference from the ring's previous vertex
+  (the first one from 0), in units of 1e-5
+
+after one leading varint giving the number of values per vertex (2 or
+3). Points and LineStrings are one part of one ring, as in the sidecar.
+decode_study() gives back exactly what load_ohmec_geojson() read: q / 1e5
+is the double nearest to the decimal text, the same one the JSON parser
+makes. Geometries that wouldn't come back exactly (integer or
+off-grid values, mixed 2D/3D vertices) keep plain "coordinates", and
+so do copies (coordinate_copy / coordinate_copies).
+
+decode_study() uses numpy where it is installed (every varint and ring
+of the study in one pass) and plain Python otherwise.
+
+Usage:
+  compact_coords.py [--repeat N] [file ...]
+  Round-trips each study (default: all ohmec_data_*.geojson) and
+  compares size and load time with plain GeoJSON.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import gzip
+import math
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from load_ohmec_geojson import dump_ohmec_geojson, load_ohmec_geojson  # noqa: E402
+
+try:
+  import numpy as np
+except ImportError:  # numpy is optional; decode in Python
+  np = None
+
+SCALE = 100000
+# the largest |q| encoded: its zigzag deltas stay within MAX_VARINT bytes,
+# the int64 ring sums of _decode_batch() and the floats' exact integers
+MAX_QUANTUM = 2 ** 52
+# the longest varint decode_values() takes, enough for any |q| < 2**62
+MAX_VARINT = 9
+
+# nesting of "coordinates" relative to a list of parts, as in study_sidecar
+_PARTS = {
+  "Point": lambda c: [[[c]]],
+  "LineString": lambda c: [[c]],
+  "Polygon": lambda c: [c],
+  "MultiPolygon": lambda c: c,
+}
+
+
+class CompactError(ValueError):
+  """qcoords that don't decode."""
+
+
+def _varint(out: bytearray, value: int) -> None:
+  while value >= 0x80:
+    out.append(value & 0x7F | 0x80)
+    value >>= 7
+  out.append(value)
+
+
+def _quantized(vertex, dims: int) -> list[int] | None:
+  if not isinstance(vertex, list) or len(vertex) != dims:
+    return None
+  values = []
+  for x in vertex:
+    if type(x) is not float or not math.isfinite(x):
+      return None
+    q = round(x * SCALE)
+    if abs(q) > MAX_QUANTUM:
+      return None
+    if q / SCALE != x or math.copysign(1.0, x) < 0 and q == 0:  # off the grid, or -0.0
+      return None
+    values.append(q)
+  return values
+
+
+def encode_coordinates(gtype: str, coords) -> bytes | None:
+  """The varints of a geometry's coordinates; None if they wouldn't
+  decode to exactly coords."""
+  try:
+    parts = _PARTS[gtype](coords)
+    dims = len(parts[0][0][0])
+  except (KeyError, TypeError, IndexError):
+    return None
+  out = bytearray()
+  _varint(out, dims)
+  _varint(out, len(parts))
+  for part in parts:
+    if not isinstance(part, list):
+      return None
+    _varint(out, len(part))
+    for ring in part:
+      if not isinstance(ring, list):
+        return None
+      _varint(out, len(ring))
+      last = [0] * dims
+      for vertex in ring:
+        values = _quantized(vertex, dims)
+        if values is None:
+          return None
+        for k in range(dims):
+          delta = values[k] - last[k]
+          _varint(out, delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        last = values
+  return bytes(out)
+
+
+def _raw_values(data: bytes):
+  """The unsigned varints in data: an int64 array with numpy, else a list."""
+  if np is not None:
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)
+    if len(raw) and (not len(ends) or ends[-1] != len(raw) - 1):
+      raise CompactError("qcoords end inside a varint")
+    if not len(ends):
+      return ends
+    starts = np.zeros_like(ends)
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > MAX_VARINT:
+      raise CompactError("varint too long in qcoords")
+    shifts = 7 * (np.arange(len(raw)) - np.repeat(starts, lengths))
+    return np.add.reduceat((raw & 0x7F).astype(np.int64) << shifts, starts)
+  values = []
+  value = shift = 0
+  for byte in data:
+    value |= (byte & 0x7F) << shift
+    if byte < 0x80:
+      values.append(value)
+      value = shift = 0
+    else:
+      shift += 7
+      if shift >= 7 * MAX_VARINT:
+        raise CompactError("varint too long in qcoords")
+  if shift:
+    raise CompactError("qcoords end inside a varint")
+  return values
+
+
+def decode_values(data: bytes) -> list[int]:
+  """The unsigned varints in data."""
+  values = _raw_values(data)
+  return values if isinstance(values, list) else values.tolist()
+
+
+def _layout(values: list[int], pos: int) -> tuple[int, list, int]:
+  """(values per vertex, [[(first value, vertices) of each ring] of each
+  part], position after it) of the geometry whose varints start at pos."""
+  try:
+    dims = values[pos]
+    parts = []
+    pos += 2
+    for _p in range(values[pos - 1]):
+      rings = []
+      pos += 1
+      for _r in range(values[pos - 1]):
+        rings.append((pos + 1, values[pos]))
+        pos += 1 + values[pos] * dims
+      parts.append(rings)
+  except IndexError:
+    raise CompactError("qcoords end early") from None
+  if dims not in (2, 3) or pos > len(values):
+    raise CompactError("qcoords end inside a ring" if pos > len(values) else f"{dims} values per vertex")
+  return dims, parts, pos
+
+
+def _nest(gtype: str, parts: list):
+  if gtype == "Point":
+    return parts[0][0][0]
+  if gtype == "LineString":
+    return parts[0][0]
+  if gtype == "Polygon":
+    return parts[0]
+  return parts
+
+
+def _vertices(values: list[int], first: int, count: int, dims: int) -> list:
+  last = [0] * dims
+  vertices = []
+  for v in range(first, first + count * dims, dims):
+    vertex = []
+    for k in range(dims):
+      zz = values[v + k]
+      last[k] += (zz >> 1) ^ -(zz & 1)
+      vertex.append(last[k] / SCALE)
+    vertices.append(vertex)
+  return vertices
+
+
+def decode_coordinates(gtype: str, data: bytes):
+  """GeoJSON coordinates of the varints encode_coordinates() made."""
+  if gtype not in _PARTS:
+    raise CompactError(f"can't decode coordinates of a {gtype}")
+  values = decode_values(data)
+  dims, layout, end = _layout(values, 0)
+  if end != len(values):
+    raise CompactError("trailing values in qcoords")
+  return _nest(gtype, [[_vertices(values, first, count, dims) for first, count in rings] for rings in layout])
+
+
+def _decode_batch(geometries: list[dict], blobs: list[bytes]) -> list:
+  """decode_coordinates() of many geometries at once, with numpy: one
+  pass over all their varints, and one cumulative sum over all rings of
+  the same dimension."""
+  raw = _raw_values(b"".join(blobs))
+  values = raw.tolist()
+  layouts = []
+  pos = 0
+  for geometry in geometries:
+    if geometry.get("type") not in _PARTS:
+      raise CompactError(f"can't decode coordinates of a {geometry.get('type')}")
+    dims, layout, pos = _layout(values, pos)
+    layouts.append((dims, layout))
+  if pos != len(values):
+    raise CompactError("trailing values in qcoords")
+
+  deltas = (raw >> 1) ^ -(raw & 1)
+  vertices = {}
+  for dims in (2, 3):
+    rings = [ring for d, layout in layouts if d == dims for rings in layout for ring in rings]
+    if not rings:
+      continue
+    firsts = np.array([first for first, _count in rings], dtype=np.int64)
+    counts = np.array([count for _first, count in rings], dtype=np.int64)
+    ring_starts = np.cumsum(counts) - counts
+    # the value positions of every vertex, ring after ring
+    index = np.repeat(firsts - dims * ring_starts, counts * dims) + np.arange(int(counts.sum()) * dims)
+    sums = np.cumsum(deltas[index].reshape(-1, dims), axis=0)
+    before = np.zeros((len(rings), dims), dtype=np.int64)
+    nonempty = counts > 0
+    before[nonempty] = np.vstack([np.zeros((1, dims), dtype=np.int64), sums])[ring_starts[nonempty]]
+    sums -= np.repeat(before, counts, axis=0)
+    vertices[dims] = ((sums / SCALE).tolist(), ring_starts.tolist())
+
+  coordinates = []
+  taken = {2: 0, 3: 0}
+  for geometry, (dims, layout) in zip(geometries, layouts):
+    flat, starts = vertices[dims]
+    parts = []
+    for rings in layout:
+      part = []
+      for _first, count in rings:
+        start = starts[taken[dims]]
+        part.append(flat[start:start + count])
+        taken[dims] += 1
+      parts.append(part)
+    coordinates.append(_nest(geometry["type"], parts))
+  return coordinates
+
+
+def _replace_key(mapping: dict, old: str, new: str, value) -> dict:
+  """mapping with old replaced by new: value, in old's place."""
+  return {(new if key == old else key): (value if key == old else item) for key, item in mapping.items()}
+
+
+def encode_study(struct: dict) -> tuple[dict, int]:
+  """A copy of struct with qcoords where they decode exactly, and the
+  number of geometries left with plain coordinates."""
+  features = []
+  plain = 0
+  for feat in struct.get("features", []):
+    geometry = feat.get("geometry") if isinstance(feat, dict) else None
+    if isinstance(geometry, dict) and "coordinates" in geometry:
+      data = encode_coordinates(geometry.get("type"), geometry["coordinates"])
+      if data is None:
+        plain += 1
+      else:
+        qcoords = base64.b64encode(data).decode("ascii")
+        feat = dict(feat, geometry=_replace_key(geometry, "coordinates", "qcoords", qcoords))
+    features.append(feat)
+  return dict(struct, features=features), plain
+
+
+def decode_study(struct: dict) -> dict:
+  """struct as it was before encode_study()."""
+  features = list(struct.get("features", []))
+  positions = []
+  blobs = []
+  for n, feat in enumerate(features):
+    geometry = feat.get("geometry") if isinstance(feat, dict) else None
+    if isinstance(geometry, dict) and "qcoords" in geometry:
+      try:
+        blobs.append(base64.b64decode(geometry["qcoords"], validate=True))
+      except ValueError as err:
+        raise CompactError(f"feature {feat.get('id')}: {err}") from None
+      positions.append(n)
+  geometries = [features[n]["geometry"] for n in positions]
+  if np is not None and blobs:
+    coordinates = _decode_batch(geometries, blobs)
+  else:
+    coordinates = [decode_coordinates(geometry.get("type"), data) for geometry, data in zip(geometries, blobs)]
+  for n, geometry, coords in zip(positions, geometries, coordinates):
+    features[n] = dict(features[n], geometry=_replace_key(geometry, "qcoords", "coordinates", coords))
+  return dict(struct, features=features)
+
+
+def _best(repeat: int, call) -> float:
+  best = float("inf")
+  for _n in range(repeat):
+    started = time.perf_counter()
+    call()
+    best = min(best, time.perf_counter() - started)
+  return best
+
+
+def compare_file(path: Path, repeat: int) -> dict:
+  """Sizes and best-of-repeat load times of a study, plain and compact;
+  ValueError if it doesn't round-trip."""
+  text = path.read_text(encoding="utf-8")
+  struct, varname = load_ohmec_geojson(text)
+  encoded, plain = encode_study(struct)
+  compact = dump_ohmec_geojson(encoded, varname)
+  reference = dump_ohmec_geojson(struct, varname)
+  back = decode_study(load_ohmec_geojson(compact)[0])
+  if dump_ohmec_geojson(back, varname) != reference:
+    raise ValueError(f"{path.name} doesn't round-trip")
+  varint_bytes = sum(len(base64.b64decode(f["geometry"]["qcoords"]))
+                     for f in encoded["features"] if "qcoords" in f.get("geometry", {}))
+  return {
+    "bytes": len(text.encode("utf-8")),
+    "minified_bytes": len(reference.encode("utf-8")),
+    "compact_bytes": len(compact.encode("utf-8")),
+    "gz_bytes": len(gzip.compress(text.encode("utf-8"), 9, mtime=0)),
+    "compact_gz_bytes": len(gzip.compress(compact.encode("utf-8"), 9, mtime=0)),
+    "varint_bytes": varint_bytes,
+    "plain_geometries": plain,
+    "load": _best(repeat, lambda: load_ohmec_geojson(text)),
+    "compact_load": _best(repeat, lambda: decode_study(load_ohmec_geojson(compact)[0])),
+  }
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Compare compact quantized coordinates with plain GeoJSON.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--repeat", "-n", type=int, default=5, metavar="N",
+                      help="time each load N times and keep the best (default %(default)s)")
+  args = parser.parse_args(argv[1:])
+  if args.repeat < 1:
+    parser.error("--repeat must be at least 1")
+  files = args.files or sorted(ROOT.glob("ohmec_data_*.geojson"))
+
+  print(f"decoding with {'numpy' if np is not None else 'Python'}")
+  print(f"{'file':36s} {'bytes':>9s} {'minified':>9s} {'compact':>9s} {'ratio':>6s} {'gzip':>8s} {'gz comp':>8s} "
+        f"{'ratio':>6s} {'load':>8s} {'compact':>8s}  plain")
+  status = 0
+  for path in files:
+    try:
+      r = compare_file(path, args.repeat)
+    except ValueError as err:
+      print(f"{path.name}: {err}", file=sys.stderr)
+      status = 1
+      continue
+    # ratios are minified (plain gzipped) over compact; below 1 is larger
+    print(f"{path.name:36s} {r['bytes']:9d} {r['minified_bytes']:9d} {r['compact_bytes']:9d} "
+          f"{r['minified_bytes'] / r['compact_bytes']:5.2f}x {r['gz_bytes']:8d} {r['compact_gz_bytes']:8d} "
+          f"{r['gz_bytes'] / r['compact_gz_bytes']:5.2f}x {r['load']:7.3f}s {r['compact_load']:7.3f}s  "
+          f"{r['plain_geometries']}")
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,231 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Indexed feature store shared by the OHMEC utilities.
+
+Loads a study file once, indexes its features by id and resolves
+`coordinate_copy` / `coordinate_copies` geometry in dependency order, so
+copies may refer to features later in the file. A feature that copies
+another shares the very same coordinate array and Shapely object instead
+of duplicating them; a `coordinate_copies` MultiPolygon references the
+source polygons' rings rather than copying them.
+
+FeatureStore.load() goes through the compiled sidecar (study_sidecar.py)
+when numpy is available: coordinates then stay in the memory-mapped
+columns until a feature's geometry or shape is asked for.
+
+Usage:
+  store = FeatureStore.load(path)
+  for feat in store.polygons():
+    shape = store.shape(feat["id"])
+"""
+
+from __future__ import annotations
+
+import contextlib
+import math
+from pathlib import Path
+from typing import Iterator
+
+from load_ohmec_geojson import load_ohmec_geojson
+from ohmec_dates import IntervalIndex, feature_dates
+
+POLYGONAL = ("Polygon", "MultiPolygon")
+
+
+class FeatureStoreError(ValueError):
+  """Raised for unresolvable geometry: missing, cyclic or mistyped copies."""
+
+
+def _no_phase(_name: str):
+  return contextlib.nullcontext()
+
+
+def flatten_xy(coords):
+  """Drop any altitude values; some native-land.ca rings mix 2D and 3D points."""
+  if isinstance(coords[0], (int, float)):
+    return coords[:2]
+  return [flatten_xy(sub) for sub in coords]
+
+
+class FeatureStore:
+  def __init__(self, struct: dict, varname: str | None = None, columns=None):
+    self.struct = struct
+    self.varname = varname
+    self.columns = columns
+    self.features: list[dict] = struct.get("features", [])
+    self.by_id: dict = {}
+    self.index: dict = {}
+    for i, feat in enumerate(self.features):
+      fid = feat["id"]
+      if fid not in self.by_id:
+        self.by_id[fid] = feat
+        self.index[fid] = i
+    self._geometry: dict = {}
+    self._types: dict = {}
+    self._owner: dict = {}
+    self._shapes: dict = {}
+    self._dates = None
+    self._date_index = None
+    self._resolve_all()
+
+  @classmethod
+  def load(cls, path, sidecar: bool = True, stats=None) -> "FeatureStore":
+    """Store of a study file; a RunStats given as stats gets the time spent
+    reading it ("load") and resolving copies ("resolve")."""
+    phase = stats.phase if stats is not None else _no_phase
+    columns = None
+    with phase("load"):
+      if sidecar:
+        try:
+          from study_sidecar import load_sidecar
+        except ImportError:  # numpy is optional; parse the JSON instead
+          load_sidecar = None
+        columns = load_sidecar(path) if load_sidecar else None
+      if columns is not None:
+        struct, varname = columns.dataset()
+      else:
+        text = Path(path).read_text(encoding="utf-8")
+        struct, varname = load_ohmec_geojson(text)
+    with phase("resolve"):
+      return cls(struct, varname, columns)
+
+  def __len__(self) -> int:
+    return len(self.features)
+
+  def __contains__(self, fid) -> bool:
+    return fid in self.by_id
+
+  def __getitem__(self, fid) -> dict:
+    return self.by_id[fid]
+
+  def polygons(self) -> Iterator[dict]:
+    """Polygon and MultiPolygon features, in file order."""
+    for feat in self.features:
+      if feat["geometry"]["type"] in POLYGONAL:
+        yield feat
+
+  def geometry(self, fid) -> dict:
+    """Resolved {"type", "coordinates"} geometry of a feature."""
+    owner = self._owner[fid]
+    geometry = self._geometry.get(owner)
+    if geometry is None:
+      gtype = self._types[owner]
+      geometry = {"type": gtype, "coordinates": self.columns.coordinates(self.index[owner], gtype)}
+      self._geometry[owner] = geometry
+    return geometry
+
+  def dates(self) -> tuple[list[float], list[float]]:
+    """str2date() of every feature's start and end (see ohmec_dates), in
+    file order; NaN where a feature has no usable date."""
+    if self._dates is None:
+      if self.columns is not None:
+        self._dates = (self.columns.start.tolist(), self.columns.end.tolist())
+      else:
+        self._dates = feature_dates(self.features)
+    return self._dates
+
+  def date_range(self, index: int) -> tuple[float, float]:
+    starts, ends = self.dates()
+    if math.isnan(starts[index]) or math.isnan(ends[index]):
+      raise FeatureStoreError(f"{self.features[index]['id']} has no valid startdatestr/enddatestr")
+    return starts[index], ends[index]
+
+  def date_index(self) -> IntervalIndex:
+    """IntervalIndex over dates(); its positions index features."""
+    if self._date_index is None:
+      self._date_index = IntervalIndex(*self.dates())
+    return self._date_index
+
+  def owner(self, fid):
+    """Id of the feature whose coordinates fid ends up using."""
+    return self._owner[fid]
+
+  def shape(self, fid):
+    """Shapely geometry of a feature, built once per distinct coordinate array."""
+    owner = self._owner[fid]
+    shape = self._shapes.get(owner)
+    if shape is None:
+      import shapely.geometry
+      index = self.index[owner]
+      if owner not in self._geometry and not self.columns.has_z(index):
+        shape = self.columns.shape(index, self._types[owner])
+        self._shapes[owner] = shape
+        return shape
+      geometry = self.geometry(owner)
+      try:
+        shape = shapely.geometry.shape(geometry)
+      except ValueError:
+        shape = shapely.geometry.shape({"type": geometry["type"], "coordinates": flatten_xy(geometry["coordinates"])})
+      self._shapes[owner] = shape
+    return shape
+
+  def _sources(self, fid) -> list:
+    geometry = self.by_id[fid]["geometry"]
+    if "coordinate_copy" in geometry:
+      return [geometry["coordinate_copy"]]
+    if "coordinate_copies" in geometry:
+      return list(geometry["coordinate_copies"])
+    return []
+
+  def _resolve_all(self) -> None:
+    """Resolve every feature, sources first, with an explicit stack so long
+    copy chains don't hit the recursion limit."""
+    visiting = set()
+    for root in self.by_id:
+      if root in self._owner:
+        continue
+      stack = [(root, iter(self._sources(root)))]
+      visiting.add(root)
+      while stack:
+        fid, pending = stack[-1]
+        for src in pending:
+          if src in self._owner:
+            continue
+          if src not in self.by_id:
+            raise FeatureStoreError(f"{fid} needs copy from {src}, which does not exist")
+          if src in visiting:
+            chain = [entry[0] for entry in stack]
+            chain = chain[chain.index(src):] + [src]
+            raise FeatureStoreError("coordinate copy cycle: " + " -> ".join(str(c) for c in chain))
+          visiting.add(src)
+          stack.append((src, iter(self._sources(src))))
+          break
+        else:
+          stack.pop()
+          visiting.discard(fid)
+          self._resolve(fid)
+
+  def _resolve(self, fid) -> None:
+    geometry = self.by_id[fid]["geometry"]
+    if "coordinate_copy" in geometry:
+      src = geometry["coordinate_copy"]
+      if src == fid:
+        raise FeatureStoreError(f"{fid} copies coordinates from itself")
+      if self._types[src] != geometry["type"]:
+        raise FeatureStoreError(f"can't copy coordinates from {src} type {self._types[src]} "
+                                f"to {fid} type {geometry['type']}")
+      self._owner[fid] = self._owner[src]
+    elif "coordinate_copies" in geometry:
+      if geometry["type"] != "MultiPolygon":
+        raise FeatureStoreError(f"{fid} uses coordinate_copies but is a {geometry['type']}, not a MultiPolygon")
+      polygons = []
+      for src in geometry["coordinate_copies"]:
+        source = self.geometry(src)
+        if source["type"] == "Polygon":
+          polygons.append(source["coordinates"])
+        elif source["type"] == "MultiPolygon":
+          polygons.extend(source["coordinates"])
+        else:
+          raise FeatureStoreError(f"can't copy coordinates from {src} type {source['type']} into MultiPolygon {fid}")
+      self._geometry[fid] = {"type": "MultiPolygon", "coordinates": polygons}
+      self._owner[fid] = fid
+    elif "coordinates" in geometry:
+      self._geometry[fid] = geometry
+      self._owner[fid] = fid
+    elif self.columns is not None and self.columns.has_coordinates(self.index[fid]):
+      # materialized from the sidecar columns on first use
+      self._owner[fid] = fid
+    else:
+      raise FeatureStoreError(f"{fid} has no coordinates")
+    self._types[fid] = geometry["type"]
@@ -4,9 +4,13 @@
    format suitable for editing in Google Maps KML viewer. The user
    can provide one or more JSON feature IDs as arguments to the
    script, and each geometric entity will be exported into the KML
-   file.
+   file. Instead of IDs, --all exports every Polygon and MultiPolygon,
+   --date D those active at date D and --bbox W,S,E,N those whose bounds
+   meet the box; --date and --bbox can be combined. The document is
+   written out in large chunks.
 
    Usage: geojson2kml.py filename ID0 [ID1 ID2 ...]
+          geojson2kml.py filename [--all] [--date D] [--bbox W,S,E,N]
 """
 
 __author__     = "OHMEC"
@@ -18,34 +22,151 @@ import json
 import re
 import hashlib
 from hashlib import md5
+from xml.sax.saxutils import escape
 
-if(len(sys.argv) < 3):
-  sys.stderr.write("usage: geojson2kml.py filename ID0 [ID1 ID2 ...]\n")
+USAGE = "usage: geojson2kml.py filename (ID0 [ID1 ID2 ...] | --all | --date D | --bbox W,S,E,N ...)\n"
+# write the document out in chunks of about this many characters
+CHUNK = 1 << 20
+
+ids_to_print = []
+select_all = False
+select_date = None
+select_bbox = None
+args = sys.argv[2:]
+while args:
+  arg = args.pop(0)
+  if(arg == "--all"):
+    select_all = True
+  elif(arg in ("--date", "--bbox") and args):
+    if(arg == "--date"):
+      select_date = args.pop(0)
+    else:
+      try:
+        select_bbox = [float(v) for v in args.pop(0).split(",")]
+      except ValueError:
+        select_bbox = []
+      if(len(select_bbox) != 4):
+        sys.stderr.write("--bbox takes west,south,east,north\n")
+        sys.exit(2)
+  elif(arg.startswith("--")):
+    sys.stderr.write(USAGE)
+    sys.exit(2)
+  else:
+    ids_to_print.append(arg)
+selecting = select_all or select_date is not None or select_bbox is not None
+if(len(sys.argv) < 3 or (ids_to_print and selecting) or not (ids_to_print or selecting)):
+  sys.stderr.write(USAGE)
   sys.exit(2)
 filename = sys.argv[1]
-ids_to_print = sys.argv[2:]
 
-filehandle = open(filename, mode='r')
-fullfile = filehandle.read()
-filehandle.close()
+from feature_store import FeatureStore, FeatureStoreError
+from load_ohmec_geojson import open_ohmec_stream
+from ohmec_dates import str2date
+
+def load_selected(filename, wanted):
+  """Stream the file twice: first to learn which features the wanted ones
+  copy coordinates from, then to keep only those. Memory stays bounded by
+  the export rather than the dataset. Returns None without a features
+  array."""
+  sources = {}
+  with open_ohmec_stream(filename) as stream:
+    for feature in stream:
+      geometry = feature["geometry"]
+      if "coordinate_copy" in geometry:
+        sources[feature["id"]] = [geometry["coordinate_copy"]]
+      elif "coordinate_copies" in geometry:
+        sources[feature["id"]] = geometry["coordinate_copies"]
+  if not stream.has_features:
+    return None
+  needed = set(wanted)
+  todo = list(needed)
+  while todo:
+    for source in sources.get(todo.pop(), []):
+      if source not in needed:
+        needed.add(source)
+        todo.append(source)
+  with open_ohmec_stream(filename) as stream:
+    kept = [feature for feature in stream if feature["id"] in needed]
+  return FeatureStore({"features": kept})
+
+def bounds(coords):
+  """(west, south, east, north) of a Polygon or MultiPolygon's coordinates"""
+  xs = []
+  ys = []
+  stack = [coords]
+  while stack:
+    item = stack.pop()
+    if item and isinstance(item[0], (int, float)):
+      xs.append(item[0])
+      ys.append(item[1])
+    else:
+      stack.extend(item)
+  return min(xs), min(ys), max(xs), max(ys)
+
+def select_features(store):
+  """ids of the polygon features chosen by --all/--date/--bbox, in file order"""
+  if(select_date is not None):
+    try:
+      active = set(store.date_index().at(str2date(select_date)))
+    except ValueError as err:
+      sys.stderr.write(str(err) + "\n")
+      sys.exit(2)
+  selected = []
+  for index, feature in enumerate(store.features):
+    if(feature["geometry"]["type"] not in ("Polygon", "MultiPolygon")):
+      continue
+    if(select_date is not None and index not in active):
+      continue
+    thisid = feature["id"]
+    if(select_bbox is not None):
+      west, south, east, north = bounds(store.geometry(thisid)["coordinates"])
+      if(west > select_bbox[2] or east < select_bbox[0] or south > select_bbox[3] or north < select_bbox[1]):
+        continue
+    selected.append(thisid)
+  return selected
+
+try:
+  if(selecting):
+    store = FeatureStore.load(filename)
+    ids_to_print = select_features(store)
+  else:
+    store = load_selected(filename, ids_to_print)
+except FeatureStoreError as err:
+  sys.stderr.write(str(err) + "\n")
+  sys.exit(2)
+
+chunks = []
+chunk_len = 0
 
-from load_ohmec_geojson import load_ohmec_geojson
-fullstruct, _varname = load_ohmec_geojson(fullfile)
-geoms = {}
+def emit(text):
+  """queue text for stdout, writing it out in large chunks"""
+  global chunk_len
+  chunks.append(text)
+  chunk_len += len(text)
+  if(chunk_len >= CHUNK):
+    flush()
+
+def flush():
+  global chunk_len
+  sys.stdout.write("".join(chunks))
+  chunks.clear()
+  chunk_len = 0
 
 def export_header(ids):
   """print out the KML header for this conversion"""
   # for each ID, create its color, which is just the MD5 of the string.
   # this way it is somewhat random but repeatable
-  print("""<?xml version="1.0" encoding="UTF-8"?>
+  emit("""<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
   <Document>
-    <name>Imported KML</name>""")
+    <name>Imported KML</name>
+""")
   for idname in ids:
+    idname = escape(str(idname))
     obj = hashlib.md5(idname.encode())
     md5hash = obj.hexdigest()
     colorhex = md5hash[0:6]
-    print("""    <Style id="Style{}">')
+    emit("""    <Style id="Style{}">')
       <LineStyle>
         <color>ff{}</color>
         <width>2</width>
@@ -65,88 +186,63 @@ def export_header(ids):
         <key>highlight</key>
         <styleUrl>#Style{}</styleUrl>
       </Pair>
-    </StyleMap>""".format(idname,colorhex,colorhex,idname,idname,idname))
+    </StyleMap>
+""".format(idname,colorhex,colorhex,idname,idname,idname))
 
 def export_footer():
   """close the KML file"""
-  print("  </Document>")
-  print("</kml>")
-
-def get_geoms(thisfeat):
-  thisid = thisfeat["id"]
-  if "coordinate_copy" in thisfeat["geometry"]:
-    copyname = thisfeat["geometry"]["coordinate_copy"]
-    if copyname in geoms:
-      return geoms[copyname]
-    else:
-      sys.stderr.write("can't handle out of order coordinate copies at this time.\n")
-      sys.stderr.write(thisid + " needs copy from " + copyname + "\n")
-      sys.exit(2)
-  elif "coordinate_copies" in thisfeat["geometry"]:
-    thisfeat["geometry"]["coordinates"] = []
-    for copyname in thisfeat["geometry"]["coordinate_copies"]:
-      if geoms[copyname]["type"] == "Polygon":
-        thisfeat["geometry"]["coordinates"].append(geoms[copyname]["coordinates"])
-      if geoms[copyname]["type"] == "MultiPolygon":
-        for subarray in geoms[copyname]["coordinates"]:
-          thisfeat["geometry"]["coordinates"].append(subarray)
-    return thisfeat["geometry"]
-  else:
-    return thisfeat["geometry"]
+  emit("  </Document>\n")
+  emit("</kml>\n")
+  flush()
+
+def export_placemark(name, idname, ring):
+  """export one Placemark with the outer ring of a polygon"""
+  emit("    <Placemark>\n"
+       "      <name>" + name + "</name>\n"
+       "      <styleUrl>#StyleMap" + idname + "</styleUrl>\n"
+       "      <Polygon>\n"
+       "        <outerBoundaryIs>\n"
+       "          <LinearRing>\n"
+       "            <tessellate>1</tessellate>\n"
+       "            <coordinates>\n")
+  emit("".join(["              " + str(pair[0]) + "," + str(pair[1]) + ",0\n" for pair in ring]))
+  emit("            </coordinates>\n"
+       "          </LinearRing>\n"
+       "        </outerBoundaryIs>\n"
+       "      </Polygon>\n"
+       "    </Placemark>\n")
 
 def export_entity(idname, entity_name, geometry, coords):
   """export the KML for this entity given a geometry of Polygon or MultiPolygon"""
+  idname = escape(str(idname))
+  entity_name = escape(str(entity_name))
   if(geometry["type"] == "Polygon"):
-    print("    <Placemark>")
-    print("      <name>[" + idname + "] " + entity_name + "</name>")
-    print("      <styleUrl>#StyleMap" + idname + "</styleUrl>")
-    print("      <Polygon>")
-    print("        <outerBoundaryIs>")
-    print("          <LinearRing>")
-    print("            <tessellate>1</tessellate>")
-    print("            <coordinates>")
-    for pair in coords[0]:
-      print("              " + str(pair[0]) + "," + str(pair[1]) + ",0")
-    print("            </coordinates>")
-    print("          </LinearRing>")
-    print("        </outerBoundaryIs>")
-    print("      </Polygon>")
-    print("    </Placemark>")
+    export_placemark("[" + idname + "] " + entity_name, idname, coords[0])
   elif(geometry["type"] == "MultiPolygon"):
     pcnt = 0
     for polygon in coords:
-      print("    <Placemark>")
-      print("      <name>[" + idname + "] " + entity_name + " Polygon " + str(pcnt) + "</name>")
+      export_placemark("[" + idname + "] " + entity_name + " Polygon " + str(pcnt), idname, polygon[0])
       pcnt+=1
-      print("      <styleUrl>#StyleMap" + idname + "</styleUrl>")
-      print("      <Polygon>")
-      print("        <outerBoundaryIs>")
-      print("          <LinearRing>")
-      print("            <tessellate>1</tessellate>")
-      print("            <coordinates>")
-      for pair in polygon[0]:
-        print("              " + str(pair[0]) + "," + str(pair[1]) + ",0")
-      print("            </coordinates>")
-      print("          </LinearRing>")
-      print("        </outerBoundaryIs>")
-      print("      </Polygon>")
-      print("    </Placemark>")
-
-printed = {}
-if("features" in fullstruct):
+
+def entity_name(properties):
+  """the name a KML editor shows: entity2name, else entity1name, else the
+  native-land.ca Name"""
+  for key in ("entity2name", "entity1name", "Name"):
+    if(key in properties):
+      return properties[key]
+  return ""
+
+printed = set()
+wanted = set(ids_to_print)
+if(store is not None):
   export_header(ids_to_print)
-  for feature in fullstruct["features"]:
+  for feature in store.features:
     thisid = feature["id"]
-    geoms[thisid] = get_geoms(feature)
-    coords = geoms[thisid]["coordinates"]
-    if(thisid in ids_to_print):
-      properties = feature["properties"]
-      if("entity2name" in properties):
-        export_entity(thisid, properties["entity2name"], feature["geometry"], coords)
-      else:
-        export_entity(thisid, properties["entity1name"], feature["geometry"], coords)
-      printed[thisid] = 1
-      sys.stderr.write("exporting " + thisid + "\n")
+    if(thisid in wanted):
+      coords = store.geometry(thisid)["coordinates"]
+      export_entity(thisid, entity_name(feature["properties"]), feature["geometry"], coords)
+      printed.add(thisid)
+      sys.stderr.write("exporting " + str(thisid) + "\n")
   export_footer()
 else:
   sys.stderr.write("missing features in geojson\n")
@@ -155,7 +251,7 @@ else:
 failure = 0
 for thisid in ids_to_print:
   if thisid not in printed:
-    sys.stderr.write("Never found " + thisid + " to convert\n")
+    sys.stderr.write("Never found " + str(thisid) + " to convert\n")
     failure = 1
 
 if failure:
@@ -0,0 +1,145 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Vectorized geometry checks for validate_geojson.py.
+
+Every position of a study file goes into one flat (N, 2) array, with
+ring offsets next to it, and the checks run over the whole file at once:
+
+  errors    positions that aren't 2 or 3 numbers, non-finite values,
+            latitudes outside [-90, 90], longitudes outside [-360, 360]
+            (the viewer draws across the antimeridian, so up to one wrap
+            either way is fine), polygon rings with fewer than 4
+            positions once closed, LineStrings with fewer than 2
+  warnings  polygon rings whose last position isn't their first; Leaflet
+            closes them, but GeoJSON and most other tools expect it
+
+Self-intersections are left to check_boundaries.py.
+
+Usage:
+  checker = GeometryChecker()
+  for feat in features:
+    checker.add(feat["id"], feat["geometry"]["type"], feat["geometry"]["coordinates"])
+  errors, warnings = checker.check()
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+LAT_LIMIT = 90.0
+LON_LIMIT = 360.0
+
+POINT, LINE, RING = 0, 1, 2
+
+
+def _positions(items) -> np.ndarray | None:
+  """(n, 2) float array of a list of positions, None if any isn't one."""
+  if not isinstance(items, list):
+    return None
+  if not items:
+    return np.empty((0, 2))
+  try:
+    arr = np.array(items)
+  except ValueError:  # ragged: 2D and 3D positions mixed
+    arr = None
+  if arr is not None and arr.dtype.kind in "iuf" and arr.ndim == 2 and arr.shape[1] in (2, 3):
+    return arr[:, :2].astype(float)
+  out = []
+  for pos in items:
+    if (not isinstance(pos, list) or len(pos) not in (2, 3)
+        or not all(isinstance(c, (int, float)) and not isinstance(c, bool) for c in pos)):
+      return None
+    out.append(pos[:2])
+  return np.array(out, dtype=float)
+
+
+def _lines(gtype: str, coords) -> list | None:
+  """(kind, positions) of each ring or line of a geometry, None when the
+  nesting doesn't fit the type."""
+  if gtype == "Point":
+    return [(POINT, [coords])]
+  if gtype == "LineString":
+    return [(LINE, coords)]
+  if gtype == "Polygon":
+    return [(RING, ring) for ring in coords] if isinstance(coords, list) else None
+  if gtype == "MultiPolygon":
+    if not isinstance(coords, list) or not all(isinstance(polygon, list) for polygon in coords):
+      return None
+    return [(RING, ring) for polygon in coords for ring in polygon]
+  return []
+
+
+class GeometryChecker:
+  def __init__(self):
+    self.fids: list = []
+    self.parts: list[np.ndarray] = []
+    self.lengths: list[int] = []
+    self.kinds: list[int] = []
+    self.owners: list[int] = []
+    self.errors: list[str] = []
+
+  def add(self, fid, gtype: str, coords) -> None:
+    """Queue one geometry's coordinates; structural errors are noted now."""
+    lines = _lines(gtype, coords)
+    arrays = None if lines is None else [_positions(line) for _kind, line in lines]
+    if arrays is None or any(arr is None for arr in arrays):
+      self.errors.append(f"feature {fid!r} coordinates are not a valid {gtype}")
+      return
+    if not arrays and gtype in ("Polygon", "MultiPolygon"):
+      self.errors.append(f"feature {fid!r} {gtype} has no rings")
+      return
+    owner = len(self.fids)
+    self.fids.append(fid)
+    for (kind, _line), arr in zip(lines, arrays):
+      self.parts.append(arr)
+      self.lengths.append(len(arr))
+      self.kinds.append(kind)
+      self.owners.append(owner)
+
+  def _report(self, out: list, ring_mask: np.ndarray, message: str, owners: np.ndarray) -> None:
+    """One line per feature with rings in ring_mask."""
+    rings = np.flatnonzero(ring_mask)
+    if not len(rings):
+      return
+    # rings of a feature are consecutive, so its first ring is where its owner starts
+    first_ring = np.searchsorted(owners, owners[rings], side="left")
+    features, first, counts = np.unique(owners[rings], return_index=True, return_counts=True)
+    for owner, at, count in zip(features.tolist(), first.tolist(), counts.tolist()):
+      more = f" (and {count - 1} more)" if count > 1 else ""
+      out.append(f"feature {self.fids[owner]!r} ring {int(rings[at] - first_ring[at])} {message}{more}")
+
+  def check(self) -> tuple[list[str], list[str]]:
+    errors = list(self.errors)
+    warnings: list[str] = []
+    if not self.parts:
+      return errors, warnings
+    xy = np.concatenate(self.parts)
+    lengths = np.array(self.lengths)
+    kinds = np.array(self.kinds)
+    owners = np.array(self.owners)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    bad = ~(np.abs(xy[:, 0]) <= LON_LIMIT) | ~(np.abs(xy[:, 1]) <= LAT_LIMIT)
+    if bad.any():
+      where = np.flatnonzero(bad)
+      rings = np.searchsorted(offsets, where, side="right") - 1
+      features, first, counts = np.unique(owners[rings], return_index=True, return_counts=True)
+      for owner, at, count in zip(features.tolist(), first.tolist(), counts.tolist()):
+        lon, lat = xy[where[at]].tolist()
+        more = f" (and {count - 1} more)" if count > 1 else ""
+        errors.append(f"feature {self.fids[owner]!r} has position [{lon}, {lat}] outside lon "
+                      f"[-{LON_LIMIT:g}, {LON_LIMIT:g}] / lat [-{LAT_LIMIT:g}, {LAT_LIMIT:g}]{more}")
+
+    is_ring = kinds == RING
+    nonempty = lengths > 0
+    closed = np.zeros(len(lengths), dtype=bool)
+    if len(xy):
+      first = offsets[:-1][nonempty]
+      last = offsets[1:][nonempty] - 1
+      closed[nonempty] = (xy[first] == xy[last]).all(axis=1)
+    self._report(warnings, is_ring & nonempty & ~closed, "is not closed", owners)
+    self._report(errors, is_ring & (lengths + ~closed < 4), "has fewer than 4 positions", owners)
+    self._report(errors, (kinds == LINE) & (lengths < 2), "has fewer than 2 positions", owners)
+    return errors, warnings
@@ -10,9 +10,14 @@
    <name>[ID] entity2name {Polygon n}</name>. The {Polygon n} is optional,
    but indicates a MultiPolygon set of coordinates for the Placemark.
    If the <name> has any other format, it is used as the ID and the
-   entity2name is unknown.
+   entity2name is unknown. A Placemark holding several polygons is also
+   written as a MultiPolygon, and inner boundaries are kept as holes.
 
-   Usage: kml2geojson.py kmlfilename
+   The file is read with an incremental XML parser, so coordinates may be
+   laid out in any way KML allows, and a KMZ archive can be given in place
+   of the KML file.
+
+   Usage: kml2geojson.py [sigdig] kmlfilename
 """
 
 __author__     = "OHMEC"
@@ -22,6 +27,8 @@ __license__    = "Apache License, Version 2.0"
 import sys
 import json
 import re
+import zipfile
+import xml.etree.ElementTree as ET
 from datetime import date
 
 today = date.today()
@@ -42,53 +49,116 @@ coords = {}
 multicoords = {}
 entity2name = {}
 
+# Placemark <name> forms, tried in order; the first two are MultiPolygon parts
+NAME_ID_POLYGON = re.compile(r"\[(.*?)\].*Polygon.*")
+NAME_ID_ENTITY_POLYGON = re.compile(r"\[(.*)\]\s+(.*)\s+Polygon.*")
+NAME_POLYGON = re.compile(r"(.+?)\s+Polygon.*")
+NAME_ID_ENTITY = re.compile(r"\[(.*)\]\s+(.*)")
+
+def local_name(tag):
+  """strip the XML namespace from an ElementTree tag"""
+  return tag.rsplit("}", 1)[-1]
+
+def parse_name(name):
+  """return (ID, entity2name, ismulti) from a Placemark name"""
+  if(NAME_ID_POLYGON.fullmatch(name)):
+    fm = NAME_ID_ENTITY_POLYGON.fullmatch(name)
+    if(fm):
+      return fm.group(1), fm.group(2), 1
+    return NAME_ID_POLYGON.fullmatch(name).group(1), "", 1
+  fm = NAME_POLYGON.fullmatch(name)
+  if(fm):
+    return fm.group(1), "", 1
+  fm = NAME_ID_ENTITY.fullmatch(name)
+  if(fm):
+    return fm.group(1), fm.group(2), 0
+  return name, "", 0
+
+def parse_coordinates(text, idname):
+  """parse a KML coordinates string: lon,lat[,alt] tuples separated by
+  any whitespace, on one line or many"""
+  coordinates = []
+  for pair in text.split():
+    fields = pair.split(",")
+    try:
+      coordinates.append([round(float(fields[0]),SIGDIGITS), round(float(fields[1]),SIGDIGITS)])
+    except (IndexError, ValueError):
+      sys.stderr.write("bad coordinate " + pair + " in " + idname + "\n")
+      sys.exit(2)
+  return coordinates
+
+def placemark_polygons(placemark, idname):
+  """return the polygons of a Placemark, each [outer ring, inner rings...]"""
+  polygons = []
+  for elem in placemark.iter():
+    tag = local_name(elem.tag)
+    if(tag == "Polygon"):
+      outer = []
+      inner = []
+      for boundary in elem:
+        btag = local_name(boundary.tag)
+        if(btag in ("outerBoundaryIs", "innerBoundaryIs")):
+          for child in boundary.iter():
+            if(local_name(child.tag) == "coordinates"):
+              ring = parse_coordinates(child.text or "", idname)
+              (outer if btag == "outerBoundaryIs" else inner).append(ring)
+      polygons.append(outer + inner)
+    elif(tag in ("Point", "LineString")):
+      sys.stderr.write("skipping " + tag + " in " + idname + "\n")
+  return polygons
+
+def open_kml(filename):
+  """open a KML file, or the main KML document inside a KMZ archive"""
+  if(zipfile.is_zipfile(filename)):
+    kmz = zipfile.ZipFile(filename)
+    names = [name for name in kmz.namelist() if name.lower().endswith(".kml")]
+    if(not names):
+      sys.stderr.write("no KML document in " + filename + "\n")
+      sys.exit(2)
+    # the main document is doc.kml by convention, else the first at top level
+    main = "doc.kml" if "doc.kml" in names else min(names, key=lambda name: (name.count("/"), names.index(name)))
+    return kmz.open(main)
+  return open(filename, "rb")
+
+def add_placemark(placemark):
+  name = None
+  for child in placemark:
+    if(local_name(child.tag) == "name"):
+      name = (child.text or "").strip()
+      break
+  if(not name):
+    sys.stderr.write("skipping Placemark without a name\n")
+    return
+  idname, ename, ismulti = parse_name(name)
+  polygons = placemark_polygons(placemark, idname)
+  if(not polygons):
+    return
+  entity2name[idname] = ename
+  if(ismulti or len(polygons) > 1):
+    multicoords.setdefault(idname, []).extend(polygons)
+  else:
+    coords[idname] = polygons[0]
+
 def parse_kml(filename):
-  in_placemark = 0
-  with open(filename) as fp:
-    line = fp.readline()
-    while line:
-      if re.search("<Placemark>", line):
-        in_placemark = 1
-      elif re.search("</Placemark>", line):
-        in_placemark = 0
-      elif in_placemark:
-        if(re.search(r"<name>\[(.*?)\].*Polygon.*</name>", line)):
-          fm = re.search(r"<name>\[(.*)\]\s+(.*)\s+Polygon.*</name>", line)
-          idname = fm.group(1)
-          entity2name[idname] = fm.group(2)
-          ismulti = 1
-          if(idname not in multicoords):
-            multicoords[idname] = []
-        elif(re.search(r"<name>(.+?)\s+Polygon.*</name>", line)):
-          fm = re.search(r"<name>(.+?)\s+Polygon.*</name>", line)
-          idname = fm.group(1)
-          entity2name[idname] = ""
-          ismulti = 1
-          if(idname not in multicoords):
-            multicoords[idname] = []
-        elif(re.search(r"<name>\[(.*)\]\s+(.*)</name>", line)):
-          fm = re.search(r"<name>\[(.*)\]\s+(.*)</name>", line)
-          idname = fm.group(1)
-          entity2name[idname] = fm.group(2)
-          ismulti = 0
-        elif(re.search("<name>(.*)</name>", line)):
-          fm = re.search("<name>(.*)</name>", line)
-          idname = fm.group(1)
-          entity2name[idname] = ""
-          ismulti = 0
-        elif(re.search("<coordinates>", line)):
-          fm = re.search("<coordinates>", line)
-          coordinates = []
-        elif(re.search("^\s*([\d.-]+),([\d.-]+),0", line)):
-          fm = re.search("^\s*([\d.-]+),([\d.-]+),0", line)
-          coordinates.append([round(float(fm.group(1)),SIGDIGITS), round(float(fm.group(2)),SIGDIGITS)])
-        elif(re.search("</coordinates>", line)):
-          if(ismulti):
-            multicoords[idname].append([coordinates])
-          else:
-            coords[idname] = coordinates
-      line = fp.readline()
-  fp.close()
+  """Read the Placemarks of a KML or KMZ file with iterparse. Each
+  Placemark is dropped from the tree once read, as is everything outside
+  Placemarks, so memory stays bounded by the largest Placemark."""
+  stack = []
+  placemark_depth = 0
+  with open_kml(filename) as fp:
+    for event, elem in ET.iterparse(fp, events=("start", "end")):
+      if(event == "start"):
+        stack.append(elem)
+        if(local_name(elem.tag) == "Placemark"):
+          placemark_depth += 1
+        continue
+      stack.pop()
+      if(local_name(elem.tag) == "Placemark"):
+        placemark_depth -= 1
+        if(placemark_depth == 0):
+          add_placemark(elem)
+      if(placemark_depth == 0 and stack):
+        stack[-1].remove(elem)
 
 def export_coords(coords):
   for idname in coords:
@@ -97,7 +167,7 @@ def export_coords(coords):
       ename = entity2name[idname]
     else:
       ename = "XXXX"
-    cstr = str(coords[idname]).replace(" ","")
+    cstr = ",".join(str(ring).replace(" ","") for ring in coords[idname])
     print('''    { "type":"Feature",
       "id":"''' + idname + '''",
       "properties":{
@@ -15,7 +15,18 @@
    perfectly or the script will error out. If the given lat/lon are
    not found, the script will error out.
 
+   With --batch, the edge copies are read from a file (or - for stdin),
+   one "lon1 lat1 lon2 lat2 dir" per line, blank lines and # comments
+   skipped, and applied in order to the rings in memory: each copy
+   replaces its from polygon with the stitched one and uses up its to
+   polygon, so a later copy can extend an earlier result. The stitched
+   polygons come first in the output, in the order they were made.
+
+   Coordinates are matched at 5 decimals through a hash of quantized
+   vertices, built once per file and updated as rings change.
+
    Usage: kml_edge_copy.py from.kml to.kml [lon1 lat1 lon2 lat2 dir]
+          kml_edge_copy.py from.kml to.kml --batch edges.txt
 """
 
 __author__     = "OHMEC"
@@ -25,6 +36,11 @@ __license__    = "Apache License, Version 2.0"
 import sys
 import json
 import re
+from bisect import insort
+
+# coordinates match when equal at this many decimals
+PRECISION = 5
+SCALE = 10 ** PRECISION
 
 def parse_kml(filename):
   '''parse a KML file and return array of coordinate arrays'''
@@ -63,17 +79,44 @@ def parse_kml(filename):
   fp.close()
   return coord_array
 
+def vertex_key(lon, lat):
+  '''quantize to precision 5 in order to account for miniscule differences'''
+  return (round(float(lon) * SCALE), round(float(lat) * SCALE))
+
+def index_ring(index, ac, ring):
+  '''add ring number ac to a vertex index'''
+  for cc in range(len(ring)):
+    insort(index.setdefault(vertex_key(ring[cc][0], ring[cc][1]), []), (ac, cc))
+
+def unindex_ring(index, ac, ring):
+  '''remove ring number ac from a vertex index'''
+  for coord in ring:
+    key = vertex_key(coord[0], coord[1])
+    places = [place for place in index.get(key, []) if place[0] != ac]
+    if places:
+      index[key] = places
+    else:
+      index.pop(key, None)
+
+def build_index(arraya):
+  '''map each quantized vertex to all of its (ring, position) places, in
+  file order, so the first is what a scan of the file would find'''
+  index = {}
+  for ac in range(len(arraya)):
+    for cc, coord in enumerate(arraya[ac]):
+      index.setdefault(vertex_key(coord[0], coord[1]), []).append((ac, cc))
+  return index
+
 def find_common_points(array_from, array_to):
-  '''convert to precision 5 in order to account for miniscule differences'''
+  '''print the points of array_to that are also in array_from'''
   exists1 = set()
   for arrayf in array_from:
     for coord in arrayf:
-      comb = str(format(coord[0],'.5f')) + ',' + str(format(coord[1],'.5f'))
-      exists1.add(comb)
+      exists1.add(vertex_key(coord[0], coord[1]))
   for arrayt in array_to:
     for coord in arrayt:
-      comb = str(format(coord[0],'.5f')) + ',' + str(format(coord[1],'.5f'))
-      if comb in exists1:
+      if vertex_key(coord[0], coord[1]) in exists1:
+        comb = str(format(coord[0],'.5f')) + ',' + str(format(coord[1],'.5f'))
         print("found common point " + comb)
 
 def export_header():
@@ -129,11 +172,11 @@ def export_footer():
   print("  </Document>")
   print("</kml>")
 
-def stitch(array_from, array_to, lon1, lat1, lon2, lat2, direction):
-  acf1, ccf1 = find_coord(array_from, lon1, lat1)
-  acf2, ccf2 = find_coord(array_from, lon2, lat2)
-  act1, cct1 = find_coord(array_to,   lon1, lat1)
-  act2, cct2 = find_coord(array_to,   lon2, lat2)
+def stitch(array_from, array_to, index_from, index_to, lon1, lat1, lon2, lat2, direction):
+  acf1, ccf1 = find_coord(index_from, lon1, lat1)
+  acf2, ccf2 = find_coord(index_from, lon2, lat2)
+  act1, cct1 = find_coord(index_to,   lon1, lat1)
+  act2, cct2 = find_coord(index_to,   lon2, lat2)
   if acf1 != acf2:
     sys.stderr.write("odd that the coordinates are in different polygons, dying\n")
     sys.exit(2)
@@ -236,29 +279,43 @@ def stitch(array_from, array_to, lon1, lat1, lon2, lat2, direction):
   # were not touched, plus this new one as Polygon 0
   return new_array,acf1,act1
 
-def find_coord(arraya, lon, lat):
-  from_ac = -1
-  from_cc = -1
-  for ac in range(len(arraya)):
-    arrayc = arraya[ac]
-    for cc in range(len(arrayc)):
-      coord = arrayc[cc]
-      if str(format(coord[0],'.5f')) == format(float(lon),'.5f') and str(format(coord[1],'.5f')) == format(float(lat),'.5f'):
-        return (ac,cc)
+def find_coord(index, lon, lat):
+  '''(ring, position) of the first vertex matching lon/lat'''
+  try:
+    places = index.get(vertex_key(lon, lat))
+  except ValueError:
+    places = None
+  if places:
+    return places[0]
   sys.stderr.write("never found lon/lat " + lon + "/" + lat + " in kml\n")
   sys.exit(2)
 
-if(len(sys.argv) != 3 and len(sys.argv) != 8):
-  sys.stderr.write("usage: kml_edge_copy.py from.kml to.kml [lon1 lat1 lon2 lat2 dir]\n");
+def read_edges(filename):
+  '''read "lon1 lat1 lon2 lat2 dir" lines for --batch'''
+  edges = []
+  fp = sys.stdin if filename == '-' else open(filename)
+  for lineno, line in enumerate(fp, 1):
+    line = line.split('#', 1)[0].strip()
+    if not line:
+      continue
+    fields = line.split()
+    if len(fields) != 5 or fields[4] not in ('N', 'S', 'E', 'W'):
+      sys.stderr.write(filename + ":" + str(lineno) + ": expected lon1 lat1 lon2 lat2 N|S|E|W, got " + line + "\n")
+      sys.exit(2)
+    edges.append(fields)
+  if fp is not sys.stdin:
+    fp.close()
+  return edges
+
+if(len(sys.argv) not in (3, 5, 8) or (len(sys.argv) == 5 and sys.argv[3] != '--batch')):
+  sys.stderr.write("usage: kml_edge_copy.py from.kml to.kml [lon1 lat1 lon2 lat2 dir | --batch edges.txt]\n");
   sys.exit(2)
 filename_from = sys.argv[1]
 filename_to   = sys.argv[2]
 if(len(sys.argv) == 8):
-  lon1 = sys.argv[3]
-  lat1 = sys.argv[4]
-  lon2 = sys.argv[5]
-  lat2 = sys.argv[6]
-  direction = sys.argv[7]
+  edges = [sys.argv[3:8]]
+elif(len(sys.argv) == 5):
+  edges = read_edges(sys.argv[4])
 
 one_name  = ''
 one_color = ''
@@ -270,16 +327,32 @@ if(len(sys.argv) == 3):
   find_common_points(coord_array_from, coord_array_to)
   sys.exit(0)
 
-stitch_array,afptr,atptr = stitch(coord_array_from, coord_array_to, lon1, lat1, lon2, lat2, direction)
+index_from = build_index(coord_array_from)
+index_to   = build_index(coord_array_to)
+stitched = []
+used_to = set()
+for lon1, lat1, lon2, lat2, direction in edges:
+  stitch_array,afptr,atptr = stitch(coord_array_from, coord_array_to, index_from, index_to, lon1, lat1, lon2, lat2, direction)
+  # the stitched ring takes the place of its from ring; its to ring is used up
+  unindex_ring(index_from, afptr, coord_array_from[afptr])
+  coord_array_from[afptr] = stitch_array
+  index_ring(index_from, afptr, stitch_array)
+  unindex_ring(index_to, atptr, coord_array_to[atptr])
+  used_to.add(atptr)
+  if afptr not in stitched:
+    stitched.append(afptr)
+
 export_header()
-export_polygon(0,stitch_array)
-pnum = 1
+pnum = 0
+for afnum in stitched:
+  export_polygon(pnum,coord_array_from[afnum])
+  pnum += 1
 for afnum in range(len(coord_array_from)):
-  if afnum != afptr:
+  if afnum not in stitched:
     export_polygon(pnum,coord_array_from[afnum])
     pnum += 1
 for atnum in range(len(coord_array_to)):
-  if atnum != atptr:
+  if atnum not in used_to:
     export_polygon(pnum,coord_array_to[atnum])
     pnum += 1
 export_footer()
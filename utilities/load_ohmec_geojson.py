@@ -5,16 +5,175 @@
 
 Accepts either plain GeoJSON/JSON, or the older JS assignment form:
   dataRegion = { ... };
+
+load_ohmec_geojson() parses a whole file's text at once. OhmecStream reads
+from a file handle instead and yields one feature at a time, so tools that
+look at features independently run in memory bounded by the largest
+feature rather than the file:
+
+  with open_ohmec_stream(path) as stream:
+    for feat in stream:
+      ...
+    stream.header["popups"]
 """
 
 import json
 import re
 
+_ASSIGNMENT = re.compile(r"(\w+)\s*=\s*")
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
 
 def load_ohmec_geojson(text):
   """Return (struct, varname_or_None) from file text."""
   text = text.strip()
-  fm = re.fullmatch(r"(\w+)\s*=\s*(.*);\s*", text, re.MULTILINE | re.DOTALL)
-  if fm:
-    return json.loads(fm.group(2)), fm.group(1)
+  fm = _ASSIGNMENT.match(text)
+  if fm and text.endswith(";"):
+    return json.loads(text[fm.end():-1]), fm.group(1)
   return json.loads(text), None
+
+
+def dump_ohmec_geojson(struct, varname=None):
+  """File text for struct, compact, in the form load_ohmec_geojson() reads
+  back as (struct, varname)."""
+  text = json.dumps(struct, separators=(",", ":"), ensure_ascii=False)
+  if varname:
+    return varname + " = " + text + ";\n"
+  return text + "\n"
+
+
+class OhmecStream:
+  """Incremental reader for one study file.
+
+  Iterating yields the members of the top-level "features" array in order.
+  Every other top-level member (type, viewpoint, popups, styles, ...) is
+  collected in header: the ones written before "features" are available
+  as soon as the first feature is yielded, the rest once iteration ends.
+  varname is the JS assignment name, or None for plain GeoJSON, and
+  has_features tells whether a "features" array was found.
+  """
+
+  def __init__(self, fh, chunk_size=1 << 16):
+    self.fh = fh
+    self.chunk_size = chunk_size
+    self.header = {}
+    self.varname = None
+    self.has_features = False
+    self._buf = ""
+    self._pos = 0
+    self._eof = False
+    self._started = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.fh.close()
+
+  def __iter__(self):
+    if self._started:
+      raise RuntimeError("an OhmecStream can only be iterated once")
+    self._started = True
+    return self._members()
+
+  def read_header(self):
+    """Consume the whole stream, discarding features, and return header."""
+    for _feat in self:
+      pass
+    return self.header
+
+  def _fill(self, size=None):
+    """Append the next chunk, dropping what has already been parsed."""
+    if self._eof:
+      return False
+    chunk = self.fh.read(size or self.chunk_size)
+    if not chunk:
+      self._eof = True
+      return False
+    self._buf = self._buf[self._pos:] + chunk
+    self._pos = 0
+    return True
+
+  def _peek(self):
+    while True:
+      while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+        self._pos += 1
+      if self._pos < len(self._buf):
+        return self._buf[self._pos]
+      if not self._fill():
+        return ""
+
+  def _expect(self, chars):
+    char = self._peek()
+    if not char or char not in chars:
+      raise self._error("expected " + " or ".join(repr(c) for c in chars))
+    self._pos += 1
+    return char
+
+  def _value(self):
+    """Decode the JSON value at the cursor, reading more as needed. A
+    value that ends exactly at the end of the buffer might be a truncated
+    number, so it is only accepted once more text or EOF follows."""
+    self._peek()
+    while True:
+      try:
+        value, end = _decoder.raw_decode(self._buf, self._pos)
+        if end < len(self._buf) or self._eof:
+          self._pos = end
+          return value
+      except json.JSONDecodeError:
+        if self._eof:
+          raise
+      # grow geometrically so a huge feature isn't re-decoded per chunk
+      self._fill(max(self.chunk_size, len(self._buf) - self._pos))
+
+  def _error(self, msg):
+    return json.JSONDecodeError(msg, self._buf, self._pos)
+
+  def _members(self):
+    try:
+      self._peek()
+      while len(self._buf) - self._pos < 256 and self._fill():
+        pass
+      fm = _ASSIGNMENT.match(self._buf, self._pos)
+      if fm:
+        self.varname = fm.group(1)
+        self._pos = fm.end()
+      self._expect("{")
+      if self._peek() != "}":
+        while True:
+          key = self._value()
+          if not isinstance(key, str):
+            raise self._error("expected an object key")
+          self._expect(":")
+          if key == "features" and self._peek() == "[":
+            self.has_features = True
+            self._pos += 1
+            if self._peek() != "]":
+              while True:
+                yield self._value()
+                if self._expect(",]") == "]":
+                  break
+            else:
+              self._pos += 1
+          else:
+            self.header[key] = self._value()
+          if self._expect(",}") == "}":
+            break
+      else:
+        self._pos += 1
+      if self.varname is not None:
+        self._expect(";")
+      if self._peek():
+        raise self._error("extra data after the top-level object")
+    finally:
+      self.close()
+
+
+def open_ohmec_stream(path, chunk_size=1 << 16):
+  """Open a study file for streaming; see OhmecStream."""
+  return OhmecStream(open(path, encoding="utf-8"), chunk_size)
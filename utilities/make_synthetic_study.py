@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Generate large synthetic OHMEC study files for scaling tests.
+
+The map is a brick-laid tessellation of cells: odd rows are shifted by
+half a cell, so neighbours always share a stretch of border and never
+just a corner. Borders wiggle, and both cells along a border compute its
+vertices from the same lattice points, so they share them exactly.
+
+Each cell holds a lineage of --per-cell Polygon features following each
+other in time, from --start to --end (or "present"). The timeline is
+nested: era boundaries every cell shares, reigns split at random years
+inside the eras, and some splits falling inside a year, at month
+precision (BC included) or at day precision (AD years). BC years are
+written "1200BC". A feature copies its predecessor's coordinates with
+probability --copy-rate, so coordinate_copy chains form along lineages.
+
+--overlaps and --gaps features get their right-hand border broken: the
+midpoint pushed into the right neighbour (an overlap) or pulled back
+from it (a gap, i.e. a border that touches in two pieces). Their
+successors don't copy them. What check_boundaries.py and check_merges.py
+should then report is computed from the layout and the dates, and
+written next to the study as <name>.expected.json:
+
+  {"format": 1, "seed": ..., "features": ..., "cells": ..., "copies": ...,
+   "check_boundaries": {"boundaries": ..., "overlaps": ..., "gaps": ..., "points": 0},
+   "check_merges": {"dates": ...},
+   "injected": {"overlaps": [ids], "gaps": [ids]}}
+
+--verify runs both scripts on the new file and compares; check_merges.py
+unions every cell at every start date, so at 20k features and up
+--no-merges, leaving it out, is more practical.
+
+Usage:
+  make_synthetic_study.py [--features 20000] [--per-cell 8] [--overlaps 10]
+                          [--gaps 10] [--copy-rate 0.5] [--seed 1] [-o FILE]
+                          [--verify [--jobs N] [--no-merges]]
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import random
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+UTILITIES = Path(__file__).resolve().parent
+sys.path.insert(0, str(UTILITIES))
+from load_ohmec_geojson import dump_ohmec_geojson  # noqa: E402
+from ohmec_dates import PRESENT, str2date  # noqa: E402
+
+MANIFEST_FORMAT = 1
+# lattice segments along each cell edge; even, so a half-cell offset is a lattice point
+EDGE_STEPS = 4
+# how far interior border vertices wander, in lattice steps
+WIGGLE = 0.3
+# how far an injected overlap or gap moves a border's midpoint, in cells
+BREAK = 0.4
+WEST, SOUTH = -150.0, -80.0
+MAX_WIDTH, MAX_HEIGHT = 300.0, 160.0
+MAX_CELL = 2.0
+
+
+def expected_path(study: Path) -> Path:
+  study = Path(study)
+  return study.with_name(study.name.replace(".geojson", "") + ".expected.json")
+
+
+def _wiggle(m: int, n: int, seed: int) -> float:
+  """Deterministic value in [-1, 1) for lattice point (m, n)."""
+  h = (m * 0x9E3779B1 + n * 0x85EBCA77 + seed * 0xC2B2AE3D) & 0xFFFFFFFF
+  h ^= h >> 15
+  h = (h * 0x2C1B3C6D) & 0xFFFFFFFF
+  h ^= h >> 12
+  return h / 2 ** 31 - 1
+
+
+class Layout:
+  """Brick-laid cells on a lattice of EDGE_STEPS points per cell edge."""
+
+  def __init__(self, cells: int, seed: int):
+    self.cols = max(1, math.ceil(math.sqrt(cells)))
+    self.rows = math.ceil(cells / self.cols)
+    self.cells = [(i, j) for j in range(self.rows) for i in range(self.cols)][:cells]
+    self.seed = seed
+    self.width = min(MAX_CELL, MAX_WIDTH / (self.cols + 0.5))
+    self.height = min(MAX_CELL, MAX_HEIGHT / self.rows)
+
+  def offset(self, j: int) -> int:
+    return (j % 2) * EDGE_STEPS // 2
+
+  def point(self, m: int, n: int) -> list[float]:
+    """Position of lattice point (m, n); junctions and corners stay put."""
+    dx = dy = 0.0
+    if n % EDGE_STEPS:
+      dx = WIGGLE * _wiggle(m, n, self.seed)
+    elif m % (EDGE_STEPS // 2):
+      dy = WIGGLE * _wiggle(m, n, self.seed)
+    return [round(WEST + (m + dx) * self.width / EDGE_STEPS, 6),
+            round(SOUTH + (n + dy) * self.height / EDGE_STEPS, 6)]
+
+  def ring(self, i: int, j: int, broken: float = 0.0) -> list[list[float]]:
+    """Counter-clockwise closed ring of cell (i, j); broken moves the
+    midpoint of its right edge that many cells to the right."""
+    m0 = i * EDGE_STEPS + self.offset(j)
+    m1 = m0 + EDGE_STEPS
+    n0 = j * EDGE_STEPS
+    n1 = n0 + EDGE_STEPS
+    lattice = ([(m, n0) for m in range(m0, m1)] + [(m1, n) for n in range(n0, n1)]
+               + [(m, n1) for m in range(m1, m0, -1)] + [(m0, n) for n in range(n1, n0, -1)])
+    ring = [self.point(m, n) for m, n in lattice]
+    if broken:
+      mid = EDGE_STEPS + EDGE_STEPS // 2
+      ring[mid][0] = round(ring[mid][0] + broken * self.width, 6)
+    ring.append(list(ring[0]))
+    return ring
+
+  def neighbours(self, i: int, j: int) -> list[tuple[int, int]]:
+    """Cells after (i, j) in row-major order that share a border with it."""
+    up = [(i - 1, j + 1), (i, j + 1)] if j % 2 == 0 else [(i, j + 1), (i + 1, j + 1)]
+    return [(a, b) for a, b in [(i + 1, j)] + up if 0 <= a < self.cols and b < self.rows]
+
+
+def _year(year: int) -> str:
+  return f"{-year}BC" if year < 0 else str(year)
+
+
+def lineage_dates(rng: random.Random, count: int, start: int, end: int, eras: list[int], inside: list[int],
+                  present: bool) -> list[tuple[str, str]]:
+  """(startdatestr, enddatestr) of count features following each other:
+  split at the shared era boundaries first, then at random years from
+  inside, a third of the splits inside the year."""
+  splits = sorted(eras[:count - 1] + rng.sample(inside, max(0, count - 1 - len(eras))))
+  starts = [_year(start)]
+  ends = []
+  for year in splits:
+    kind = rng.random()
+    if kind < 1 / 3 or year <= 0 and kind < 2 / 3:
+      month = rng.randint(2, 12)
+      ends.append(f"{_year(year)}:{month - 1:02d}")
+      starts.append(f"{_year(year)}:{month:02d}")
+    elif kind < 2 / 3:
+      day = datetime.date(year, 1, 1) + datetime.timedelta(days=rng.randint(0, 363))
+      ends.append(f"{_year(year)}:{day.month:02d}:{day.day:02d}")
+      following = day + datetime.timedelta(days=1)
+      starts.append(f"{_year(year)}:{following.month:02d}:{following.day:02d}")
+    else:
+      ends.append(_year(year - 1))
+      starts.append(_year(year))
+  ends.append(PRESENT if present else _year(end))
+  return list(zip(starts, ends))
+
+
+def _overlapping(first: tuple[float, float], intervals: list[tuple[float, float]]) -> int:
+  """How many of the sorted, disjoint intervals meet first (ends included)."""
+  starts = [start for start, _end in intervals]
+  hi = bisect.bisect_right(starts, first[1])
+  return sum(1 for start, end in intervals[:hi] if end >= first[0])
+
+
+def generate(features: int, per_cell: int, overlaps: int, gaps: int, copy_rate: float, seed: int,
+             start: int, end: int, eras: int) -> tuple[dict, dict]:
+  """(study, manifest); see the module doc."""
+  rng = random.Random(seed)
+  cells = max(1, math.ceil(features / per_cell))
+  layout = Layout(cells, seed)
+  if per_cell - 1 > end - start - 1:
+    raise ValueError(f"can't split {end - start} years into {per_cell} features")
+  era_years = [start + (end - start) * n // eras for n in range(1, eras)]
+  inside = [year for year in range(start + 1, end + 1) if year not in era_years]
+
+  lineages = {}
+  for i, j in layout.cells:
+    lineages[(i, j)] = lineage_dates(rng, per_cell, start, end, era_years, inside, rng.random() < 0.5)
+  breakable = [(cell, k) for cell in layout.cells if (cell[0] + 1, cell[1]) in lineages
+               for k in range(per_cell)]
+  if overlaps + gaps > len(breakable):
+    raise ValueError(f"only {len(breakable)} features have a right-hand neighbour to overlap or leave a gap to")
+  picked = rng.sample(breakable, overlaps + gaps)
+  broken = {entry: BREAK for entry in picked[:overlaps]}
+  broken.update({entry: -BREAK for entry in picked[overlaps:]})
+
+  out = []
+  copies = 0
+  for (i, j), dates in lineages.items():
+    for k, (startdatestr, enddatestr) in enumerate(dates):
+      fid = f"syn{i}_{j}_{k}"
+      if k and ((i, j), k) not in broken and ((i, j), k - 1) not in broken and rng.random() < copy_rate:
+        geometry = {"type": "Polygon", "coordinate_copy": f"syn{i}_{j}_{k - 1}"}
+        copies += 1
+      else:
+        geometry = {"type": "Polygon", "coordinates": [layout.ring(i, j, broken.get(((i, j), k), 0.0))]}
+      out.append({"type": "Feature", "id": fid, "properties": {
+        "entity1type": "nation",
+        "entity1name": f"Synthetica {i},{j}",
+        "entity2type": "reign",
+        "entity2name": f"reign {k + 1}",
+        "fidelity": 1 + (i + j + k) % 5,
+        "startdatestr": startdatestr,
+        "enddatestr": enddatestr,
+        "source": "synthetic",
+      }, "geometry": geometry})
+  # copies refer to features earlier in the file, which the viewer requires
+  out.sort(key=lambda feat: str2date(feat["properties"]["startdatestr"]))
+
+  spans = {cell: [(str2date(s), str2date(e, True)) for s, e in dates] for cell, dates in lineages.items()}
+  boundaries = 0
+  for (i, j), intervals in spans.items():
+    for other in layout.neighbours(i, j):
+      if other in spans:
+        boundaries += sum(_overlapping(span, spans[other]) for span in intervals)
+  errors = {"overlaps": 0, "gaps": 0}
+  for ((i, j), k), shift in broken.items():
+    errors["overlaps" if shift > 0 else "gaps"] += _overlapping(spans[(i, j)][k], spans[(i + 1, j)])
+
+  study = {"type": "FeatureCollection", "features": out}
+  manifest = {
+    "format": MANIFEST_FORMAT,
+    "seed": seed,
+    "features": len(out),
+    "cells": len(layout.cells),
+    "copies": copies,
+    "check_boundaries": {"boundaries": boundaries, "overlaps": errors["overlaps"], "gaps": errors["gaps"],
+                         "points": 0},
+    "check_merges": {"dates": len({feat["properties"]["startdatestr"] for feat in out})},
+    "injected": {
+      "overlaps": sorted(f"syn{i}_{j}_{k}" for ((i, j), k), shift in broken.items() if shift > 0),
+      "gaps": sorted(f"syn{i}_{j}_{k}" for ((i, j), k), shift in broken.items() if shift < 0),
+    },
+  }
+  return study, manifest
+
+
+COMPLETED = re.compile(r"completed checking (\d+) boundaries, with (\d+) overlaps, (\d+) gaps and (\d+) points")
+
+
+def verify(path: Path, manifest: dict, jobs: int, merges: bool = True) -> list[str]:
+  """Differences between what the checkers report on path and manifest."""
+  problems = []
+  proc = subprocess.run([sys.executable, str(UTILITIES / "check_boundaries.py"), "--jobs", str(jobs), str(path)],
+                        capture_output=True, text=True)
+  found = COMPLETED.search(proc.stdout)
+  if proc.returncode or not found:
+    return [f"check_boundaries.py failed: {proc.stderr.strip()[-500:]}"]
+  got = dict(zip(("boundaries", "overlaps", "gaps", "points"), (int(n) for n in found.groups())))
+  for key, want in manifest["check_boundaries"].items():
+    if got[key] != want:
+      problems.append(f"check_boundaries.py: {got[key]} {key}, expected {want}")
+  if "is not valid" in proc.stdout:
+    problems.append("check_boundaries.py: found invalid features")
+  if not merges:
+    return problems
+
+  proc = subprocess.run([sys.executable, str(UTILITIES / "check_merges.py"), "--sweep", str(path)],
+                        capture_output=True, text=True)
+  if proc.returncode:
+    return problems + [f"check_merges.py failed: {proc.stderr.strip()[-500:]}"]
+  dates = len(json.loads(proc.stdout)["features"])
+  if dates != manifest["check_merges"]["dates"]:
+    problems.append(f"check_merges.py: merged {dates} dates, expected {manifest['check_merges']['dates']}")
+  if " is not valid" in proc.stderr:
+    problems.append("check_merges.py: found invalid features or mergers")
+  return problems
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Generate a large synthetic study file with known check results.")
+  parser.add_argument("--features", "-n", type=int, default=20000, help="about this many features (default %(default)s)")
+  parser.add_argument("--per-cell", type=int, default=8, help="features per cell lineage (default %(default)s)")
+  parser.add_argument("--overlaps", type=int, default=10, help="features to break into an overlap (default %(default)s)")
+  parser.add_argument("--gaps", type=int, default=10, help="features to break into a gap (default %(default)s)")
+  parser.add_argument("--copy-rate", type=float, default=0.5,
+                      help="chance a feature copies its predecessor's coordinates (default %(default)s)")
+  parser.add_argument("--start", type=int, default=-3000, help="first year, negative for BC (default %(default)s)")
+  parser.add_argument("--end", type=int, default=1900, help="last year (default %(default)s)")
+  parser.add_argument("--eras", type=int, default=5, help="eras every cell changes at (default %(default)s)")
+  parser.add_argument("--seed", type=int, default=1, help="random seed (default %(default)s)")
+  parser.add_argument("--out", "-o", type=Path, help="study file (default synthetic/synthetic_<features>_s<seed>.geojson)")
+  parser.add_argument("--verify", action="store_true",
+                      help="run check_boundaries.py and check_merges.py on the result and compare")
+  parser.add_argument("--jobs", "-j", type=int, default=1, metavar="N", help="check_boundaries.py --jobs for --verify")
+  parser.add_argument("--no-merges", action="store_true", help="leave check_merges.py out of --verify")
+  args = parser.parse_args(argv[1:])
+  if args.per_cell < 1 or args.features < 1 or args.eras < 1:
+    parser.error("--features, --per-cell and --eras must be at least 1")
+  if args.overlaps < 0 or args.gaps < 0 or not 0 <= args.copy_rate <= 1:
+    parser.error("--overlaps and --gaps can't be negative, and --copy-rate is between 0 and 1")
+  out = args.out or ROOT / "synthetic" / f"synthetic_{args.features}_s{args.seed}.geojson"
+
+  try:
+    study, manifest = generate(args.features, args.per_cell, args.overlaps, args.gaps, args.copy_rate,
+                               args.seed, args.start, args.end, args.eras)
+  except ValueError as err:
+    sys.stderr.write(f"{err}\n")
+    return 2
+  out.parent.mkdir(parents=True, exist_ok=True)
+  out.write_text(dump_ohmec_geojson(study), encoding="utf-8")
+  expected_path(out).write_text(json.dumps(manifest, indent=1) + "\n", encoding="utf-8")
+  bounds = manifest["check_boundaries"]
+  print(f"{out}: {manifest['features']} features in {manifest['cells']} cells, {manifest['copies']} copies; "
+        f"expect {bounds['boundaries']} boundaries, {bounds['overlaps']} overlaps, {bounds['gaps']} gaps, "
+        f"{manifest['check_merges']['dates']} merge dates")
+
+  if args.verify:
+    problems = verify(out, manifest, args.jobs, not args.no_merges)
+    for problem in problems:
+      print(problem, file=sys.stderr)
+    if problems:
+      return 1
+    print("check_boundaries.py" + ("" if args.no_merges else " and check_merges.py") + " report what was expected")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
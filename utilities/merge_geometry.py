@@ -28,49 +28,30 @@ if(len(sys.argv) < 3):
 filename = sys.argv[1]
 ids_to_merge = sys.argv[2:]
 
-filehandle = open(filename, mode='r')
-fullfile = filehandle.read()
-filehandle.close()
-
-from load_ohmec_geojson import load_ohmec_geojson
-fullstruct, _varname = load_ohmec_geojson(fullfile)
-geoms = {}
-
-def get_geoms(thisfeat):
-  thisid = thisfeat["id"]
-  if "coordinate_copy" in thisfeat["geometry"]:
-    copyname = thisfeat["geometry"]["coordinate_copy"]
-    if copyname in geoms:
-      return geoms[copyname]
-    else:
-      sys.stderr.write("can't handle out of order coordinate copies at this time.\n")
-      sys.stderr.write(thisid + " needs copy from " + copyname + "\n")
-      sys.exit(2)
-  elif "coordinate_copies" in thisfeat["geometry"]:
-    thisfeat["geometry"]["coordinates"] = []
-    for copyname in thisfeat["geometry"]["coordinate_copies"]:
-      if geoms[copyname]["type"] == "Polygon":
-        thisfeat["geometry"]["coordinates"].append(geoms[copyname]["coordinates"])
-      if geoms[copyname]["type"] == "MultiPolygon":
-        for subarray in geoms[copyname]["coordinates"]:
-          thisfeat["geometry"]["coordinates"].append(subarray)
-    return thisfeat["geometry"]
-  else:
-    return thisfeat["geometry"]
+from feature_store import FeatureStore, FeatureStoreError
+try:
+  store = FeatureStore.load(filename)
+except FeatureStoreError as err:
+  sys.stderr.write(str(err) + "\n")
+  sys.exit(2)
 
-for feature in fullstruct["features"]:
-  geoms[feature["id"]] = get_geoms(feature)
-  shape = shapely.geometry.asShape(geoms[feature["id"]])
+for feature in store.features:
+  shape = store.shape(feature["id"])
   if not shape.is_valid:
     sys.stderr.write(feature["id"] + " is not valid\n")
 
+for idname in ids_to_merge:
+  if idname not in store:
+    sys.stderr.write("Never found " + idname + " to merge\n")
+    sys.exit(2)
+
 first = 1
 for idname in ids_to_merge:
   sys.stderr.write("merging " + idname + "\n")
   if first:
-    merged_polygon = shapely.geometry.asShape(geoms[idname])
+    merged_polygon = store.shape(idname)
   else:
-    merged_polygon = merged_polygon.union(shapely.geometry.asShape(geoms[idname]))
+    merged_polygon = merged_polygon.union(store.shape(idname))
   first = 0
 
 feature = geojson.Feature(geometry=merged_polygon, properties={})
@@ -0,0 +1,228 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Date model shared by the OHMEC utilities.
+
+str2date() follows str2date() in ohmec-dates.js step for step, including
+its JavaScript Date arithmetic: month/day overflow, the setFullYear() fix
+for years 0-99 and "rounding late" of partial end dates to 23:59:59 of
+their last day. Dates are milliseconds since 1970-01-01 in the proleptic
+Gregorian calendar, i.e. what the viewer computes in a UTC time zone.
+
+"present" is not a date to str2date() in the viewer: features ending
+"present" stay active at every later date, and one starting "present"
+never is. Both are +inf here, which gives the same answers.
+
+Features are active at D when start <= D <= end, with start rounded early
+and end rounded late, as in the viewer's idsPerDOI. IntervalIndex answers
+that, and "active anywhere in [D1, D2]", in logarithmic time plus the
+size of the answer.
+
+Usage:
+  starts = parse_dates(props["startdatestr"] for props in ..., False)
+  ends = parse_dates(props["enddatestr"] for props in ..., True)
+  index = IntervalIndex(starts, ends)
+  index.at(str2date("1492:10:12"))
+"""
+
+from __future__ import annotations
+
+import bisect
+import math
+import re
+from typing import Iterable
+
+PRESENT = "present"
+MS_PER_DAY = 86400000
+# setHours(23); setMinutes(59); setSeconds(59)
+_LATE = ((23 * 60 + 59) * 60 + 59) * 1000
+
+# what JavaScript's Number() accepts from these strings, less hex/octal/binary
+_NUMBER = re.compile(r"[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|[+-]?Infinity")
+
+
+def _number(text: str) -> float:
+  text = text.strip()
+  if not text:
+    return 0.0
+  if not _NUMBER.fullmatch(text):
+    return math.nan
+  return float(text.replace("Infinity", "inf"))
+
+
+def _integer(value: float) -> int:
+  """ToIntegerOrInfinity(), for the finite values that make a valid Date."""
+  if not math.isfinite(value):
+    raise ValueError("not a finite date component")
+  return int(value)
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+  """Days since 1970-01-01 of a proleptic Gregorian date; month is 1-12."""
+  year -= month <= 2
+  era = year // 400
+  yoe = year - era * 400
+  doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+  return era * 146097 + yoe * 365 + yoe // 4 - yoe // 100 + doy - 719468
+
+
+def _civil_from_days(days: int) -> tuple[int, int, int]:
+  days += 719468
+  era = days // 146097
+  doe = days - era * 146097
+  yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+  doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+  mp = (5 * doy + 2) // 153
+  day = doy - (153 * mp + 2) // 5 + 1
+  month = mp + 3 if mp < 10 else mp - 9
+  return yoe + era * 400 + (month <= 2), month, day
+
+
+def _make_day(year: float, month: float, day: float) -> int:
+  """MakeDay() from the ECMAScript spec; month is 0-based and may overflow."""
+  year, month, day = _integer(year), _integer(month), _integer(day)
+  return _days_from_civil(year + month // 12, month % 12 + 1, 1) + day - 1
+
+
+def str2date(datestr: str, round_late: bool = False) -> float:
+  """Milliseconds since the epoch of a startdatestr/enddatestr value;
+  ValueError where the viewer would get an Invalid Date."""
+  if datestr == PRESENT:
+    return math.inf
+  strip_bc = datestr.replace("BC", "", 1)
+  is_bc = strip_bc != datestr
+  info = strip_bc.split(":")
+  sign = -1 if is_bc else 1
+  yr = _number(info[0]) * sign
+  if len(info) == 3:
+    mo = _number(info[1]) - 1
+    dy = _number(info[2])
+  elif len(info) == 2:
+    mo = _number(info[1]) - 1
+    dy = 1
+    if round_late:
+      if _number(info[1]) == 12:
+        mo = 0
+        yr += 1
+      else:
+        mo += 1
+  elif len(info) == 1:
+    mo = 0
+    dy = 1
+    if round_late:
+      yr += 1
+  else:
+    raise ValueError("bad date format for date: " + datestr)
+  if math.isnan(yr) or math.isnan(mo) or math.isnan(dy):
+    raise ValueError("bad date format for date: " + datestr)
+  # new Date(yr, mo, dy) reads years 0-99 as 1900-1999 ...
+  full_year = _integer(yr)
+  if 0 <= full_year <= 99:
+    full_year += 1900
+  _year, month, day = _civil_from_days(_make_day(full_year, mo, dy))
+  # ... and setFullYear(yr) then puts back the year, keeping month and day
+  days = _make_day(yr, month - 1, day)
+  if round_late:
+    if len(info) != 3:
+      days -= 1
+    return days * MS_PER_DAY + _LATE
+  return float(days * MS_PER_DAY)
+
+
+def parse_dates(values: Iterable, round_late: bool) -> list[float]:
+  """str2date() over a column of date strings, parsing each distinct
+  string once; NaN for missing or malformed entries."""
+  seen: dict = {}
+  column = []
+  for value in values:
+    parsed = seen.get(value)
+    if parsed is None:
+      try:
+        parsed = str2date(value, round_late)
+      except (AttributeError, TypeError, ValueError):
+        parsed = math.nan
+      if isinstance(value, str):
+        seen[value] = parsed
+    column.append(parsed)
+  return column
+
+
+def feature_dates(features: Iterable[dict]) -> tuple[list[float], list[float]]:
+  """(starts, ends) of a feature list, NaN where a feature has no date."""
+  props = [feat.get("properties") or {} for feat in features]
+  return (parse_dates((p.get("startdatestr") for p in props), False),
+          parse_dates((p.get("enddatestr") for p in props), True))
+
+
+class _Node:
+  __slots__ = ("center", "starts", "by_start", "ends", "by_end", "left", "right")
+
+
+class IntervalIndex:
+  """Static centered interval tree over closed intervals [starts[i], ends[i]].
+
+  Queries return positions into the columns it was built from, in
+  ascending order. Intervals with a NaN bound are left out.
+  """
+
+  def __init__(self, starts: list[float], ends: list[float]):
+    items = [(start, end, pos) for pos, (start, end) in enumerate(zip(starts, ends))
+             if start <= end]
+    self.size = len(items)
+    self._root = self._build(items)
+
+  def __len__(self) -> int:
+    return self.size
+
+  def _build(self, items):
+    if not items:
+      return None
+    points = sorted([start for start, _end, _pos in items] + [end for _start, end, _pos in items])
+    center = points[len(points) // 2]
+    here, left, right = [], [], []
+    for item in items:
+      if item[1] < center:
+        left.append(item)
+      elif item[0] > center:
+        right.append(item)
+      else:
+        here.append(item)
+    node = _Node()
+    node.center = center
+    here.sort(key=lambda item: item[0])
+    node.starts = [item[0] for item in here]
+    node.by_start = [item[2] for item in here]
+    here.sort(key=lambda item: -item[1])
+    node.ends = [-item[1] for item in here]
+    node.by_end = [item[2] for item in here]
+    node.left = self._build(left)
+    node.right = self._build(right)
+    return node
+
+  def overlapping(self, first: float, last: float) -> list[int]:
+    """Positions of the intervals that share at least one instant with
+    [first, last]."""
+    found = []
+    if not first <= last:  # also a NaN bound
+      return found
+    stack = [self._root]
+    while stack:
+      node = stack.pop()
+      if node is None:
+        continue
+      if last < node.center:
+        found.extend(node.by_start[:bisect.bisect_right(node.starts, last)])
+        stack.append(node.left)
+      elif first > node.center:
+        found.extend(node.by_end[:bisect.bisect_right(node.ends, -first)])
+        stack.append(node.right)
+      else:
+        found.extend(node.by_start)
+        stack.append(node.left)
+        stack.append(node.right)
+    found.sort()
+    return found
+
+  def at(self, date: float) -> list[int]:
+    """Positions of the intervals active at date."""
+    return self.overlapping(date, date)
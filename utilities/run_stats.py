@@ -0,0 +1,129 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Per-phase timings, counters and profiling for the OHMEC utilities.
+
+A RunStats collects wall and CPU time per named phase (a phase entered
+several times adds up) and named counters. Collecting is cheap enough to
+be always on; the tools only write the report when asked to (--stats):
+
+  {"format": 1, "tool": "check_boundaries.py",
+   "wall": 1.23, "cpu": 1.20,
+   "phases": {"load": {"wall": 0.10, "cpu": 0.09}, ...},
+   "counters": {"pairs_date_overlapping": 1526, ...},
+   "peak_rss_bytes": ..., "peak_rss_children_bytes": ...}
+
+Phases are listed in the order they were first entered. Time handed back
+from worker processes (add()) is their own, so with several workers a
+phase can add up to more than the run's wall time. peak_rss_children_bytes
+is the largest worker, and null where the resource module is missing.
+
+--profile FILE runs the tool under cProfile and dumps the profile to FILE
+for pstats or snakeviz; worker processes are not profiled.
+
+Usage:
+  stats = RunStats("tool.py")
+  stats.start_profile(profile_path)   # None: no profiling
+  with stats.phase("load"):
+    ...
+  stats.count("pairs", n)
+  stats.finish(stats_path)            # "-" writes to stderr, None nothing
+"""
+
+from __future__ import annotations
+
+import collections
+import contextlib
+import json
+import sys
+import time
+from typing import Iterable, Iterator
+
+STATS_FORMAT = 1
+
+
+def peak_rss() -> tuple[int | None, int | None]:
+  """Peak resident set size of this process and of its largest child, in bytes."""
+  try:
+    import resource
+  except ImportError:  # not on Windows
+    return None, None
+  # ru_maxrss is in KiB on Linux and in bytes on macOS
+  scale = 1 if sys.platform == "darwin" else 1024
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class RunStats:
+  def __init__(self, tool: str):
+    self.tool = tool
+    self.phases: dict[str, list[float]] = {}
+    self.counters: collections.Counter = collections.Counter()
+    self.started = (time.perf_counter(), time.process_time())
+    self.profile = None
+    self.profile_path = None
+
+  def add(self, name: str, wall: float, cpu: float) -> None:
+    entry = self.phases.setdefault(name, [0.0, 0.0])
+    entry[0] += wall
+    entry[1] += cpu
+
+  @contextlib.contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+  def timed(self, name: str, items: Iterable) -> Iterator:
+    """items, with the time spent producing them added to phase name."""
+    it = iter(items)
+    while True:
+      wall, cpu = time.perf_counter(), time.process_time()
+      try:
+        item = next(it)
+      except StopIteration:
+        self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+        return
+      self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+      yield item
+
+  def count(self, name: str, n: int = 1) -> None:
+    self.counters[name] += n
+
+  def start_profile(self, path) -> None:
+    if path:
+      import cProfile
+      self.profile_path = path
+      self.profile = cProfile.Profile()
+      self.profile.enable()
+
+  def report(self) -> dict:
+    rss, children = peak_rss()
+    return {
+      "format": STATS_FORMAT,
+      "tool": self.tool,
+      "wall": round(time.perf_counter() - self.started[0], 6),
+      "cpu": round(time.process_time() - self.started[1], 6),
+      "phases": {name: {"wall": round(wall, 6), "cpu": round(cpu, 6)}
+                 for name, (wall, cpu) in self.phases.items()},
+      "counters": dict(self.counters),
+      "peak_rss_bytes": rss,
+      "peak_rss_children_bytes": children,
+    }
+
+  def finish(self, path) -> None:
+    """Stop profiling and dump the profile, then write the report to path."""
+    if self.profile is not None:
+      self.profile.disable()
+      self.profile.dump_stats(self.profile_path)
+      self.profile = None
+    if not path:
+      return
+    text = json.dumps(self.report(), indent=1) + "\n"
+    if path == "-":
+      sys.stderr.write(text)
+    else:
+      with open(path, "w", encoding="utf-8") as fh:
+        fh.write(text)
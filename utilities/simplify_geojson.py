@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Write per-zoom-level simplified variants of OHMEC study files.
+
+Simplification works on shared arcs (topology.py) rather than on each
+polygon: every border is simplified once, with Douglas-Peucker at the
+size of a map pixel at that zoom, and all polygons along it get the very
+same vertices. Neighbours therefore still meet exactly, and
+check_boundaries.py sees no new overlaps or gaps along shared borders.
+Arc ends (junctions) are never moved. Coordinates are then rounded to
+the precision the zoom level can show.
+
+Arcs are relaxed (simplified less, down to not at all) where a ring
+would collapse (that ring's arcs), where a feature would turn invalid
+(its arcs near where GEOS finds it invalid), and where a pair of
+neighbours that share a date (the pairs check_boundaries.py compares)
+would get another check_boundaries.py verdict (apart,
+boundary, overlap, gap/double touch, point touch): the arcs of the two
+near where they meet, with or without simplification, shared ones
+first. Only if that doesn't help are all arcs of the feature or pair
+relaxed. No feature disappears, and check_boundaries.py reports the same
+overlaps, gaps and point touches as on the full data.
+
+coordinate_copy / coordinate_copies references are kept as they are,
+and all other content is written unchanged. Output goes to
+<out>/z<level>/<study file name>.
+
+Usage:
+  simplify_geojson.py [--zooms 4,6,8] [--pixels 1] [--out DIR] [file ...]
+  With no files, simplifies all ohmec_data_*.geojson in the repo root.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import re
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import shapely.geometry  # noqa: E402
+import shapely.validation  # noqa: E402
+
+from feature_store import flatten_xy  # noqa: E402
+from load_ohmec_geojson import dump_ohmec_geojson, load_ohmec_geojson  # noqa: E402
+from ohmec_dates import feature_dates  # noqa: E402
+from topology import LINE_DEPTH, extract_arcs, geometry_lines, join_arcs, map_lines  # noqa: E402
+
+DEFAULT_ZOOMS = (4, 6, 8)
+TILE_SIZE = 256
+
+
+def pixel_degrees(zoom: int) -> float:
+  """Width of one Web Mercator pixel at the equator, in degrees."""
+  return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+def zoom_decimals(zoom: int) -> int:
+  """Decimal places that resolve a quarter pixel at zoom."""
+  return max(0, math.ceil(-math.log10(pixel_degrees(zoom) / 4)))
+
+
+def douglas_peucker(points: list, tolerance: float) -> list[int]:
+  """Indices of the points kept at tolerance; both ends are always kept."""
+  last = len(points) - 1
+  if last < 2 or tolerance <= 0:
+    return list(range(len(points)))
+  keep = [False] * len(points)
+  keep[0] = keep[last] = True
+  tol2 = tolerance * tolerance
+  stack = [(0, last)]
+  while stack:
+    first, end = stack.pop()
+    ax, ay = points[first][0], points[first][1]
+    dx, dy = points[end][0] - ax, points[end][1] - ay
+    seg2 = dx * dx + dy * dy
+    worst, worst_d2 = -1, tol2
+    for i in range(first + 1, end):
+      px, py = points[i][0] - ax, points[i][1] - ay
+      if seg2:
+        cross = px * dy - py * dx
+        d2 = cross * cross / seg2
+      else:
+        d2 = px * px + py * py
+      if d2 > worst_d2:
+        worst, worst_d2 = i, d2
+    if worst >= 0:
+      keep[worst] = True
+      stack.append((first, worst))
+      stack.append((worst, end))
+  return [i for i, kept in enumerate(keep) if kept]
+
+
+def _round_vertex(vertex: list, decimals: int) -> list:
+  return [round(c, decimals) if type(c) is float else c for c in vertex]
+
+
+def simplify_arc(arc: list, tolerance: float, decimals: int | None) -> list:
+  """Simplify one arc; tolerance 0 returns it untouched."""
+  if tolerance <= 0:
+    return arc
+  points = [arc[i] for i in douglas_peucker(arc, tolerance)]
+  if decimals is None:
+    return points
+  rounded = [_round_vertex(v, decimals) for v in points]
+  out = [rounded[0]]
+  for vertex in rounded[1:-1]:
+    if vertex[:2] != out[-1][:2]:
+      out.append(vertex)
+  if len(rounded) > 1:
+    if len(out) > 1 and out[-1][:2] == rounded[-1][:2]:
+      out.pop()
+    out.append(rounded[-1])
+  return out
+
+
+def _collapsed(ring: list) -> bool:
+  return len(ring) < 4 or len({(v[0], v[1]) for v in ring}) < 3
+
+
+def _shape(gtype: str, coords):
+  try:
+    return shapely.geometry.shape({"type": gtype, "coordinates": coords})
+  except ValueError:
+    return shapely.geometry.shape({"type": gtype, "coordinates": flatten_xy(coords)})
+
+
+def boundary_verdict(a, b) -> int:
+  """What compare_features() in check_boundaries.py makes of two shapes,
+  waivers aside: 0 apart, 1 a clean boundary, 2 overlap, 3 gap or double
+  touch, 4 touching at points."""
+  if not a.intersects(b):
+    return 0
+  if a.overlaps(b):
+    return 2
+  inter = a.intersection(b)
+  if inter.geom_type in ("Point", "MultiPoint"):
+    return 4
+  if inter.geom_type == "LineString":
+    return 1
+  if inter.geom_type == "MultiLineString":
+    bound = inter.boundary
+    return 1 if (len(bound.geoms) if hasattr(bound, "geoms") else 1) in (0, 2) else 3
+  return 3
+
+
+def _boxes_meet(a: tuple, b: tuple, margin: float) -> bool:
+  return (a[0] - margin <= b[2] and b[0] - margin <= a[2]
+          and a[1] - margin <= b[3] and b[1] - margin <= a[3])
+
+
+def _pieces(geom) -> list:
+  return [piece for piece in getattr(geom, "geoms", [geom]) if not piece.is_empty]
+
+
+def _invalid_at(shape) -> tuple | None:
+  """The point explain_validity() gives for an invalid shape, as a box."""
+  found = re.search(r"\[([-+0-9.eE]+) ([-+0-9.eE]+)\]", shapely.validation.explain_validity(shape))
+  if not found:
+    return None
+  x, y = float(found.group(1)), float(found.group(2))
+  return x, y, x, y
+
+
+def _neighbour_pairs(shapes: list, margin: float) -> list[tuple[int, int]]:
+  """Pairs of shapes whose bounding boxes, grown by margin, meet."""
+  boxes = sorted((shape.bounds, n) for n, shape in enumerate(shapes) if not shape.is_empty)
+  pairs = []
+  active: list = []
+  for (minx, miny, maxx, maxy), n in boxes:
+    active = [entry for entry in active if entry[0][2] + margin >= minx - margin]
+    for (_ominx, ominy, _omaxx, omaxy), other in active:
+      if ominy - margin <= maxy + margin and miny - margin <= omaxy + margin:
+        pairs.append((min(n, other), max(n, other)))
+    active.append(((minx, miny, maxx, maxy), n))
+  return pairs
+
+
+class _Owner:
+  """A feature with its own coordinates, and where its lines are."""
+
+  def __init__(self, feat: dict, first_line: int):
+    self.feat = feat
+    self.gtype = feat["geometry"]["type"]
+    self.lines = range(first_line, first_line + sum(1 for _l in geometry_lines(self.gtype, feat["geometry"]["coordinates"])))
+
+
+def simplify_struct(struct: dict, zoom: int, pixels: float = 1.0) -> tuple[dict, int]:
+  """A copy of struct simplified for zoom, and its vertex count. Arcs are
+  relaxed by a factor 4 a round, only rechecking the features they touch."""
+  features = struct.get("features", [])
+  owners = []
+  lines = []
+  for feat in features:
+    geometry = feat.get("geometry") or {}
+    if geometry.get("type") in LINE_DEPTH and "coordinates" in geometry:
+      owners.append(_Owner(feat, len(lines)))
+      lines.extend(geometry_lines(geometry["type"], geometry["coordinates"]))
+
+  tolerance = pixel_degrees(zoom) * pixels
+  decimals = zoom_decimals(zoom)
+  arcs, refs = extract_arcs(lines)
+  arc_owners: list[set] = [set() for _arc in arcs]
+  owner_arcs: list[set] = [set() for _owner in owners]
+  for n, owner in enumerate(owners):
+    for line in owner.lines:
+      for ref in refs[line]:
+        arc_owners[ref if ref >= 0 else ~ref].add(n)
+        owner_arcs[n].add(ref if ref >= 0 else ~ref)
+  arc_boxes = [(min(v[0] for v in arc), min(v[1] for v in arc), max(v[0] for v in arc), max(v[1] for v in arc))
+               for arc in arcs]
+  arc_tolerance = [tolerance] * len(arcs)
+  simplified = [simplify_arc(arc, tolerance, decimals) for arc in arcs]
+
+  def rebuild(owner):
+    it = iter(owner.lines)
+    return map_lines(owner.gtype, owner.feat["geometry"]["coordinates"],
+                     lambda _line: join_arcs(simplified, refs[next(it)]))
+
+  original = [_shape(o.gtype, o.feat["geometry"]["coordinates"]) for o in owners]
+  was_valid = [shape.is_valid for shape in original]
+  # how invalid input relates to anything is not well defined (GEOS may give up)
+  # features that never coexist aren't compared; unreadable dates are, to be safe
+  starts, ends = feature_dates([owner.feat for owner in owners])
+  pairs = [(a, b) for a, b in _neighbour_pairs(original, 2 * tolerance)
+           if was_valid[a] and was_valid[b] and not (ends[a] < starts[b] or ends[b] < starts[a])]
+  verdict = {(a, b): boundary_verdict(original[a], original[b]) for a, b in pairs}
+  partners: list[list] = [[] for _owner in owners]
+  for pair in pairs:
+    partners[pair[0]].append(pair)
+    partners[pair[1]].append(pair)
+
+  def live(*tiers) -> set:
+    """The arcs of the first tier that can still be relaxed."""
+    for candidates in tiers:
+      arcs_left = {arc for arc in candidates if arc_tolerance[arc] > 0}
+      if arcs_left:
+        return arcs_left
+    return set()
+
+  def arcs_near(features, boxes: list) -> set:
+    return {arc for n in features for arc in owner_arcs[n]
+            if any(_boxes_meet(arc_boxes[arc], box, 2 * tolerance) for box in boxes)}
+
+  def pair_arcs(a: int, b: int) -> set:
+    """Arcs to relax for a pair whose verdict changed: theirs near where
+    they meet now or met before, shared ones first."""
+    contact = _pieces(original[a].intersection(original[b])) + _pieces(shapes[a].intersection(shapes[b]))
+    near = arcs_near((a, b), [piece.bounds for piece in contact])
+    shared = owner_arcs[a] & owner_arcs[b]
+    return live(near & shared, near, shared, owner_arcs[a] | owner_arcs[b])
+
+  coords = [None] * len(owners)
+  shapes = [None] * len(owners)
+  dirty = set(range(len(owners)))
+  floor = tolerance / 1024
+  while dirty:
+    broken = set()
+    relax = set()
+    for n in dirty:
+      owner = owners[n]
+      coords[n] = rebuild(owner)
+      collapsed = [line for line, ring in zip(owner.lines, geometry_lines(owner.gtype, coords[n]))
+                   if owner.gtype != "LineString" and _collapsed(ring)]
+      if collapsed:
+        shapes[n] = original[n]
+        broken.add(n)
+        relax |= live({ref if ref >= 0 else ~ref for line in collapsed for ref in refs[line]}, owner_arcs[n])
+        continue
+      shapes[n] = _shape(owner.gtype, coords[n])
+      if was_valid[n] and not shapes[n].is_valid:
+        broken.add(n)
+        where = _invalid_at(shapes[n])
+        relax |= live(arcs_near((n,), [where]) if where else (), owner_arcs[n])
+    # a broken side is relaxed and so checked again next round
+    checked = {pair for n in dirty for pair in partners[n]}
+    for a, b in checked:
+      if a not in broken and b not in broken and boundary_verdict(shapes[a], shapes[b]) != verdict[(a, b)]:
+        relax |= pair_arcs(a, b)
+    dirty = set()
+    for arc in relax:
+      arc_tolerance[arc] = arc_tolerance[arc] / 4 if arc_tolerance[arc] > floor else 0
+      simplified[arc] = simplify_arc(arcs[arc], arc_tolerance[arc], decimals)
+      dirty.update(arc_owners[arc])
+
+  replaced = {}
+  for n, owner in enumerate(owners):
+    replaced[id(owner.feat)] = dict(owner.feat, geometry=dict(owner.feat["geometry"], coordinates=coords[n]))
+  out = dict(struct)
+  out["features"] = [replaced.get(id(feat), feat) for feat in features]
+  return out, count_vertices(out)
+
+
+def count_vertices(struct: dict) -> int:
+  total = 0
+  for feat in struct.get("features", []):
+    geometry = feat.get("geometry") or {}
+    if geometry.get("type") in LINE_DEPTH and "coordinates" in geometry:
+      total += sum(len(line) for line in geometry_lines(geometry["type"], geometry["coordinates"]))
+  return total
+
+
+def _percent(new: int, old: int) -> str:
+  return f"{100 * (1 - new / old):5.1f}%" if old else "    -"
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Write per-zoom-level simplified study files.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--zooms", default=",".join(str(z) for z in DEFAULT_ZOOMS),
+                      help="comma-separated zoom levels (default %(default)s)")
+  parser.add_argument("--pixels", type=float, default=1.0,
+                      help="simplification tolerance in screen pixels (default %(default)s)")
+  parser.add_argument("--out", type=Path, default=ROOT / "simplified",
+                      help="output directory (default %(default)s)")
+  args = parser.parse_args(argv[1:])
+  try:
+    zooms = [int(z) for z in args.zooms.split(",")]
+  except ValueError:
+    parser.error("--zooms takes comma-separated integers")
+  files = args.files or sorted(ROOT.glob("ohmec_data_*.geojson"))
+
+  for path in files:
+    struct, varname = load_ohmec_geojson(path.read_text(encoding="utf-8"))
+    full_vertices = count_vertices(struct)
+    full_bytes = len(dump_ohmec_geojson(struct, varname).encode("utf-8"))
+    print(f"{path.name}: {path.stat().st_size} bytes as written")
+    print("  level   vertices  reduction       bytes  reduction")
+    print(f"  full  {full_vertices:9d}      -     {full_bytes:9d}      -")
+    for zoom in zooms:
+      simple, vertices = simplify_struct(struct, zoom, args.pixels)
+      text = dump_ohmec_geojson(simple, varname)
+      target = args.out / f"z{zoom}" / path.name
+      target.parent.mkdir(parents=True, exist_ok=True)
+      target.write_text(text, encoding="utf-8")
+      size = len(text.encode("utf-8"))
+      print(f"  z{zoom:<3d} {vertices:9d}  {_percent(vertices, full_vertices)}  "
+            f"{size:11d}  {_percent(size, full_bytes)}")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Split OHMEC study files into era chunks the viewer can fetch as needed.
+
+The timeline is cut into eras at feature start dates. Every feature the
+viewer keeps (timeline_index.viewer_features(), so geo_lint()'s checks
+and dates) is written once, to the chunk of the era it starts in; one
+still active in later eras is not repeated there, instead those eras
+list its chunk among the ones they need. Showing any date in an era
+takes the chunks its "needs" lists, concatenated in that (ascending)
+order.
+
+A copy (coordinate_copy / coordinate_copies) keeps its reference when
+what it copies is in the same chunk or an earlier one, and that chunk
+is then needed wherever the copy is; only a copy of a feature in a later
+chunk gets the coordinates written out. The cuts are placed to keep the
+gzipped bytes the costliest era needs as low as possible, for at most
+--buckets eras (estimated from each feature gzipped on its own, then
+measured). If an era still needs more than the whole study file
+gzipped, the split is redone with fewer eras, down to one chunk.
+
+The study's other top-level members (viewpoint, popups, styles, ...)
+go into the manifest, <out>/<study>.eras.json:
+
+  {"format": 2, "source": ..., "source_sha256": ..., "source_gz_bytes": n,
+   "header": {...},
+   "chunks": [{"file": "<study>.00.geojson", "first": ms, "last": ms,
+               "features": n, "bytes": n, "sha256": ...,
+               "gz_bytes": n, "gz_sha256": ..., "needs": [0, ...],
+               "needs_gz_bytes": n}, ...]}
+
+Dates are ms since the epoch as ohmec_dates.str2date() gives them; an
+era runs from its first up to the next era's first, and the last one has
+no end ("last": null). needs lists chunk indices, its own included, and
+needs_gz_bytes what they add up to gzipped. Chunks are written next to
+a gzip -9 copy (<file>.gz), through temp files renamed into place, and
+the manifest after them. native-land.ca studies (ohmec_data_nl) have
+one era, 700-1768, for all of their features, so they come out as a
+single chunk.
+
+Usage:
+  split_eras.py [--buckets N] [--out DIR] [file ...]
+  With no files, splits all ohmec_data_*.geojson in the repo root.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import gzip
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import zlib
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from feature_store import FeatureStore  # noqa: E402
+from load_ohmec_geojson import dump_ohmec_geojson  # noqa: E402
+from timeline_index import NATIVE_LANDS_FILES, viewer_features  # noqa: E402
+
+MANIFEST_FORMAT = 2
+DEFAULT_BUCKETS = 8
+
+
+def manifest_path(out: Path, source: Path) -> Path:
+  return out / (source.name.replace(".geojson", "") + ".eras.json")
+
+
+def _sources(geometry: dict) -> list:
+  if "coordinate_copy" in geometry:
+    return [geometry["coordinate_copy"]]
+  return list(geometry.get("coordinate_copies", []))
+
+
+def _packed_size(feat: dict) -> int:
+  return len(zlib.compress(json.dumps(feat, separators=(",", ":"), ensure_ascii=False).encode("utf-8"), 9))
+
+
+def _closures(deps: list[set]) -> list[set]:
+  """Each chunk with the chunks its copies need, transitively; deps only
+  point to earlier chunks."""
+  closures: list[set] = []
+  for n, chunk_deps in enumerate(deps):
+    closures.append({n}.union(*(closures[m] for m in chunk_deps)))
+  return closures
+
+
+class _Planner:
+  """Greedy cuts under a budget of estimated gzipped bytes per era."""
+
+  def __init__(self, store: FeatureStore, entries: list):
+    self.entries = entries
+    kept = {fid for fid, _start, _end in entries}
+    self.sources = [_sources(store[fid]["geometry"]) for fid, _start, _end in entries]
+    self.copy_size = []
+    self.full_size = []
+    for (fid, _start, _end), sources in zip(entries, self.sources):
+      self.copy_size.append(_packed_size(store[fid]))
+      if sources:
+        geometry = {key: value for key, value in store[fid]["geometry"].items()
+                    if key not in ("coordinate_copy", "coordinate_copies")}
+        geometry["coordinates"] = store.geometry(fid)["coordinates"]
+        self.full_size.append(_packed_size(dict(store[fid], geometry=geometry)))
+      else:
+        self.full_size.append(self.copy_size[-1])
+      if any(src not in kept for src in sources):
+        self.copy_size[-1] = self.full_size[-1]
+    self.groups: dict[float, list[int]] = {}
+    for n, (_fid, start, _end) in enumerate(entries):
+      self.groups.setdefault(start, []).append(n)
+    self.dates = sorted(self.groups)
+
+  def total(self) -> int:
+    return sum(self.full_size)
+
+  def cuts(self, budget: int) -> list[float]:
+    """First dates of the eras, each cut before the era would need more
+    than budget; an era with a single start date may still go over."""
+    chunk_of: dict = {}
+    weights: list[int] = []
+    latest: list[float] = []
+    closures: list[set] = []
+    firsts: list[float] = []
+    here: set = set()
+    weight = 0
+    end = -math.inf
+    deps: set = set()
+    alive: set = set()
+    for date in self.dates:
+      if firsts:
+        group_weight, group_deps = self._group(date, chunk_of, here)
+        cost = weight + group_weight + sum(weights[m] for m in deps | group_deps | alive)
+        if cost <= budget:
+          weight += group_weight
+          deps |= group_deps
+          here.update(self.entries[n][0] for n in self.groups[date])
+          end = max([end] + [self.entries[n][2] for n in self.groups[date]])
+          continue
+        n = len(weights)
+        for fid in here:
+          chunk_of[fid] = n
+        weights.append(weight)
+        latest.append(end)
+        closures.append({n}.union(*(closures[m] for m in deps)))
+      firsts.append(date)
+      here = set()
+      alive = set().union(*(closures[m] for m in range(len(weights)) if latest[m] >= date))
+      weight, deps = self._group(date, chunk_of, here)
+      here.update(self.entries[n][0] for n in self.groups[date])
+      end = max(self.entries[n][2] for n in self.groups[date])
+    return firsts
+
+  def _group(self, date: float, chunk_of: dict, here: set) -> tuple[int, set]:
+    group_ids = {self.entries[n][0] for n in self.groups[date]}
+    weight = 0
+    deps = set()
+    for n in self.groups[date]:
+      sources = self.sources[n]
+      if all(src in chunk_of or src in here or src in group_ids for src in sources):
+        weight += self.copy_size[n]
+        deps.update(chunk_of[src] for src in sources if src in chunk_of)
+      else:
+        weight += self.full_size[n]
+    return weight, deps
+
+
+def plan_cuts(store: FeatureStore, entries: list, buckets: int) -> list[float]:
+  """First dates of at most buckets eras, for the lowest budget of
+  estimated gzipped bytes per era that fits."""
+  planner = _Planner(store, entries)
+  if not planner.dates:
+    return []
+  low, high = 0, planner.total()
+  while low < high:
+    budget = (low + high) // 2
+    if len(planner.cuts(budget)) <= buckets:
+      high = budget
+    else:
+      low = budget + 1
+  return planner.cuts(high)
+
+
+def _chunk_features(store: FeatureStore, ids: list, chunk_of: dict, n: int) -> tuple[list[dict], set]:
+  """The features of chunk n, in file order, and the earlier chunks its
+  copies refer to. Copies from later chunks, or from features no chunk
+  has, are written out."""
+  features = []
+  deps = set()
+  for fid in ids:
+    feat = store[fid]
+    geometry = feat["geometry"]
+    sources = _sources(geometry)
+    if all(chunk_of.get(src, n + 1) <= n for src in sources):
+      deps.update(chunk_of[src] for src in sources if chunk_of[src] < n)
+    else:
+      resolved = store.geometry(fid)
+      geometry = {key: value for key, value in geometry.items()
+                  if key not in ("coordinate_copy", "coordinate_copies", "coordinates")}
+      geometry["coordinates"] = resolved["coordinates"]
+      feat = dict(feat, geometry=geometry)
+    features.append(feat)
+  return features, deps
+
+
+def _build(store: FeatureStore, entries: list, firsts: list[float], stem: str) -> tuple[list[dict], list[tuple]]:
+  """The manifest entries of the chunks and their (name, body, gzipped body)."""
+  homes: list[list] = [[] for _first in firsts]
+  latest = [-math.inf for _first in firsts]
+  chunk_of = {}
+  for fid, start, end in entries:
+    n = bisect.bisect_right(firsts, start) - 1
+    homes[n].append(fid)
+    chunk_of[fid] = n
+    latest[n] = max(latest[n], end)
+
+  files = []
+  deps = []
+  for n, ids in enumerate(homes):
+    ids.sort(key=store.index.__getitem__)
+    features, chunk_deps = _chunk_features(store, ids, chunk_of, n)
+    deps.append(chunk_deps)
+    body = dump_ohmec_geojson({"type": "FeatureCollection", "features": features}).encode("utf-8")
+    files.append((f"{stem}.{n:02d}.geojson", body, gzip.compress(body, 9, mtime=0)))
+  closures = _closures(deps)
+
+  chunks = []
+  for n, (name, body, packed) in enumerate(files):
+    # every feature of an earlier chunk started before this era
+    needs = sorted(set().union(*(closures[m] for m in range(n + 1) if m == n or latest[m] >= firsts[n])))
+    chunks.append({
+      "file": name,
+      "first": int(firsts[n]),
+      "last": int(firsts[n + 1]) - 1 if n + 1 < len(firsts) else None,
+      "features": len(homes[n]),
+      "bytes": len(body),
+      "sha256": hashlib.sha256(body).hexdigest(),
+      "gz_bytes": len(packed),
+      "gz_sha256": hashlib.sha256(packed).hexdigest(),
+      "needs": needs,
+      "needs_gz_bytes": sum(len(files[m][2]) for m in needs),
+    })
+  return chunks, files
+
+
+def _write_temp(target: Path, data: bytes) -> Path:
+  """data in a temp file of its own next to target, to be renamed over it."""
+  with tempfile.NamedTemporaryFile("wb", dir=target.parent, prefix=target.name + ".",
+                                   suffix=".tmp", delete=False) as fh:
+    try:
+      fh.write(data)
+    except BaseException:
+      fh.close()
+      os.unlink(fh.name)
+      raise
+  return Path(fh.name)
+
+
+def split_file(path: Path, out: Path, buckets: int, warnings: list | None = None,
+               notes: list | None = None) -> dict:
+  """Write the chunks and manifest of one study file; returns the manifest.
+  Splits given up for needing more than the whole file go to notes."""
+  path = Path(path)
+  data = path.read_bytes()
+  source_gz = len(gzip.compress(data, 9, mtime=0))
+  # chunks are written from the parsed features, coordinates and all
+  store = FeatureStore.load(path, sidecar=False)
+  entries = list(viewer_features(store.features, path.name in NATIVE_LANDS_FILES, warnings))
+  stem = path.name.replace(".geojson", "")
+
+  while True:
+    firsts = plan_cuts(store, entries, buckets)
+    chunks, files = _build(store, entries, firsts, stem)
+    worst = max((chunk["needs_gz_bytes"] for chunk in chunks), default=0)
+    if worst <= source_gz or len(chunks) <= 1:
+      break
+    if notes is not None:
+      notes.append(f"{len(chunks)} eras: one needs {worst} bytes gzipped, more than the "
+                   f"{source_gz} of the whole file; trying fewer")
+    buckets = len(chunks) - 1
+
+  manifest = {
+    "format": MANIFEST_FORMAT,
+    "source": path.name,
+    "source_sha256": hashlib.sha256(data).hexdigest(),
+    "source_gz_bytes": source_gz,
+    "header": {key: value for key, value in store.struct.items() if key != "features"},
+    "chunks": chunks,
+  }
+  # chunks are renamed into place together and the manifest last, so it
+  # never lists checksums of chunks still being written
+  out.mkdir(parents=True, exist_ok=True)
+  written = []
+  try:
+    for name, body, packed in files:
+      written.append((_write_temp(out / name, body), out / name))
+      written.append((_write_temp(out / (name + ".gz"), packed), out / (name + ".gz")))
+  except BaseException:
+    for tmp, _target in written:
+      tmp.unlink()
+    raise
+  for tmp, target in written:
+    os.replace(tmp, target)
+  target = manifest_path(out, path)
+  tmp = _write_temp(target, (json.dumps(manifest, indent=1, ensure_ascii=False) + "\n").encode("utf-8"))
+  os.replace(tmp, target)
+  return manifest
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Split study files into era chunks with a manifest.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--buckets", "-n", type=int, default=DEFAULT_BUCKETS,
+                      help="number of eras to aim for (default %(default)s)")
+  parser.add_argument("--out", type=Path, default=ROOT / "eras",
+                      help="output directory (default %(default)s)")
+  args = parser.parse_args(argv[1:])
+  if args.buckets < 1:
+    parser.error("--buckets must be at least 1")
+  files = args.files or sorted(ROOT.glob("ohmec_data_*.geojson"))
+
+  for path in files:
+    warnings: list[str] = []
+    notes: list[str] = []
+    manifest = split_file(path, args.out, args.buckets, warnings, notes)
+    for warning in warnings:
+      print(f"{path.name}: skipped: {warning}", file=sys.stderr)
+    for note in notes:
+      print(f"{path.name}: {note}", file=sys.stderr)
+    chunks = manifest["chunks"]
+    print(f"{path.name}: {path.stat().st_size} bytes, {manifest['source_gz_bytes']} gzipped, "
+          f"{len(chunks)} chunk(s) in {args.out}")
+    for chunk in chunks:
+      print(f"  {chunk['file']:32s} {chunk['features']:5d} features {chunk['bytes']:9d} bytes "
+            f"{chunk['gz_bytes']:8d} gzipped, {chunk['needs_gz_bytes']:8d} gzipped to show")
+    worst = max((chunk["needs_gz_bytes"] for chunk in chunks), default=0)
+    print(f"  costliest era: {worst} bytes gzipped, "
+          f"{100 * worst / manifest['source_gz_bytes']:.0f}% of the whole file")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Local HTTP server for the viewer that answers date and bbox queries.
+
+A stand-in for `python3 -m http.server`, standard library only, that
+serves the repository the same way, plus queries on study files:
+
+  GET /ohmec_data_meso.geojson?date=1519:04:21&bbox=-100,15,-90,22
+
+returns the study with only the features the viewer shows at date
+(the ones geo_lint() keeps, timeline_index.viewer_features(), with
+startdatestr <= date <= enddatestr; for native-land.ca studies the North
+American ones, all 700-1768) whose bounding box meets bbox
+(west,south,east,north, in the file's longitudes). Either parameter can
+be left out. Copied coordinates come already resolved, so features
+can be picked independently of the ones they copy from.
+
+Each study is indexed on first use and again whenever its file changes;
+every feature is serialized once. Responses, query and static alike,
+get a gzip copy made up front, carry a content ETag and answer
+If-None-Match with 304; the most recently used are cached, up to
+CACHE_BYTES of bodies and gzip copies together. A study file fetched
+whole is not cached once the study is indexed, as the index already
+holds its features. gzip is sent to clients whose Accept-Encoding
+allows it with a q-value above 0. Indexing and building responses run in
+worker threads, so a cache miss on a large study doesn't hold up the
+other connections. Nothing is fetched from the network.
+
+Usage:
+  study_server.py [--bind 127.0.0.1] [--port 8000] [--directory DIR]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import collections
+import gzip
+import hashlib
+import json
+import math
+import mimetypes
+import sys
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from feature_store import FeatureStore, FeatureStoreError  # noqa: E402
+from ohmec_dates import IntervalIndex, str2date  # noqa: E402
+from timeline_index import NATIVE_LANDS_FILES, viewer_features  # noqa: E402
+
+STUDY_GLOB = "ohmec_data_*.geojson"
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_HEADER = 64 * 1024
+COMPRESSIBLE = ("text/", "application/json", "application/geo+json", "application/javascript", "image/svg+xml")
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 500: "Internal Server Error"}
+
+mimetypes.add_type("application/geo+json", ".geojson")
+mimetypes.add_type("application/javascript", ".js")
+
+
+class QueryError(ValueError):
+  """A query parameter the server can't use; answered with 400."""
+
+
+class Response:
+  """A body, its gzip copy and ETag, ready to be sent any number of times."""
+
+  def __init__(self, body: bytes, content_type: str):
+    self.body = body
+    self.content_type = content_type
+    self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    self.gzipped = None
+    if content_type.startswith(COMPRESSIBLE) and len(body) > 1024:
+      self.gzipped = gzip.compress(body, 6, mtime=0)
+    self.size = len(body) + len(self.gzipped or b"")
+
+
+def accepts_gzip(header: str) -> bool:
+  """Whether an Accept-Encoding header allows gzip: listed, or covered by
+  "*", with a q-value above 0."""
+  quality = {}
+  for item in header.split(","):
+    coding, *params = (part.strip() for part in item.split(";"))
+    q = 1.0
+    for param in params:
+      name, _sep, value = param.partition("=")
+      if name.strip().lower() == "q":
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    if coding:
+      quality[coding.lower()] = q
+  for coding in ("gzip", "x-gzip", "*"):
+    if coding in quality:
+      return quality[coding] > 0
+  return False
+
+
+def _bounds(coords) -> tuple[float, float, float, float]:
+  xs, ys = [], []
+  stack = [coords]
+  while stack:
+    item = stack.pop()
+    if item and isinstance(item[0], (int, float)):
+      xs.append(item[0])
+      ys.append(item[1])
+    else:
+      stack.extend(item)
+  return (min(xs), min(ys), max(xs), max(ys)) if xs else (math.nan,) * 4
+
+
+def parse_bbox(text: str) -> tuple[float, float, float, float]:
+  try:
+    west, south, east, north = (float(value) for value in text.split(","))
+  except ValueError:
+    raise QueryError(f"bbox takes west,south,east,north, got {text!r}") from None
+  if not (west <= east and south <= north):
+    raise QueryError(f"bbox {text!r} is empty")
+  return west, south, east, north
+
+
+class StudyIndex:
+  """One study file: features serialized, indexed by date and by bounds."""
+
+  def __init__(self, path: Path):
+    self.path = path
+    self.mtime = path.stat().st_mtime_ns
+    # viewer_features() looks at the coordinates of native-land.ca features
+    store = FeatureStore.load(path, sidecar=False)
+    entries = list(viewer_features(store.features, path.name in NATIVE_LANDS_FILES))
+    self.dates = IntervalIndex([start for _fid, start, _end in entries], [end for _fid, _start, end in entries])
+    self.json = []
+    self.bounds = []
+    for fid, _start, _end in entries:
+      geometry = store.geometry(fid)
+      resolved = dict(store[fid], geometry={"type": geometry["type"], "coordinates": geometry["coordinates"]})
+      self.json.append(json.dumps(resolved, separators=(",", ":"), ensure_ascii=False))
+      self.bounds.append(_bounds(geometry["coordinates"]))
+    header = {key: value for key, value in store.struct.items() if key != "features"}
+    head = json.dumps(header, separators=(",", ":"), ensure_ascii=False)
+    self.head = head[:-1] + ("," if header else "") + '"features":['
+
+  def select(self, date: float | None, bbox: tuple | None) -> list[int]:
+    positions = self.dates.at(date) if date is not None else range(len(self.json))
+    if bbox is None:
+      return list(positions)
+    west, south, east, north = bbox
+    return [n for n in positions
+            if self.bounds[n][0] <= east and west <= self.bounds[n][2]
+            and self.bounds[n][1] <= north and south <= self.bounds[n][3]]
+
+  def body(self, positions: list[int]) -> bytes:
+    return (self.head + ",".join(self.json[n] for n in positions) + "]}").encode("utf-8")
+
+
+class StudyServer:
+  def __init__(self, directory: Path):
+    self.directory = directory.resolve()
+    self.studies: dict[str, StudyIndex] = {}
+    self.cache: collections.OrderedDict = collections.OrderedDict()
+    self.cache_bytes = 0
+    # respond() runs in worker threads
+    self._cache_lock = threading.Lock()
+    self._study_locks: dict[str, threading.Lock] = {}
+
+  def _cached(self, key, build) -> Response:
+    with self._cache_lock:
+      response = self.cache.get(key)
+      if response is not None:
+        self.cache.move_to_end(key)
+        return response
+    # built outside the lock; two threads may both build a missing entry
+    response = build()
+    if response.size > CACHE_BYTES:
+      return response
+    with self._cache_lock:
+      old = self.cache.pop(key, None)
+      if old is not None:
+        self.cache_bytes -= old.size
+      self.cache[key] = response
+      self.cache_bytes += response.size
+      while self.cache_bytes > CACHE_BYTES:
+        _key, evicted = self.cache.popitem(last=False)
+        self.cache_bytes -= evicted.size
+    return response
+
+  def _file(self, url_path: str) -> Path | None:
+    path = (self.directory / urllib.parse.unquote(url_path).lstrip("/")).resolve()
+    if path != self.directory and self.directory not in path.parents:
+      return None
+    if path.is_dir():
+      path = path / "index.html"
+    return path if path.is_file() else None
+
+  def study(self, path: Path) -> StudyIndex:
+    with self._study_locks.setdefault(path.name, threading.Lock()):
+      index = self.studies.get(path.name)
+      if index is None or index.mtime != path.stat().st_mtime_ns:
+        index = self.studies[path.name] = StudyIndex(path)
+        # from now on the whole file is served uncached
+        with self._cache_lock:
+          static = self.cache.pop((str(path), index.mtime), None)
+          if static is not None:
+            self.cache_bytes -= static.size
+      return index
+
+  def respond(self, url: str) -> Response:
+    """The response to a GET of url; FileNotFoundError and QueryError
+    for 404 and 400."""
+    parts = urllib.parse.urlsplit(url)
+    path = self._file(parts.path)
+    if path is None:
+      raise FileNotFoundError(parts.path)
+    query = urllib.parse.parse_qs(parts.query)
+    mtime = path.stat().st_mtime_ns
+    if not (path.match(STUDY_GLOB) and ("date" in query or "bbox" in query)):
+      content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+      index = self.studies.get(path.name)
+      if index is not None and index.mtime == mtime:
+        return Response(path.read_bytes(), content_type)
+      return self._cached((str(path), mtime), lambda: Response(path.read_bytes(), content_type))
+
+    date = bbox = None
+    if "date" in query:
+      try:
+        date = str2date(query["date"][0])
+      except ValueError as err:
+        raise QueryError(str(err)) from None
+      if math.isinf(date):
+        raise QueryError("date must be a date, not present")
+    if "bbox" in query:
+      bbox = parse_bbox(query["bbox"][0])
+    index = self.study(path)
+    return self._cached((str(path), index.mtime, date, bbox),
+                        lambda: Response(index.body(index.select(date, bbox)), "application/geo+json"))
+
+  async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    peer = writer.get_extra_info("peername")
+    try:
+      while True:
+        try:
+          head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+          return
+        lines = head.decode("latin-1").split("\r\n")
+        request = lines[0]
+        headers = {}
+        for line in lines[1:]:
+          name, _sep, value = line.partition(":")
+          headers[name.strip().lower()] = value.strip()
+        fields = request.split()
+        if len(fields) != 3:
+          await self.send(writer, request, peer, 400, b"malformed request line\n", close=True)
+          return
+        method, url, version = fields
+        keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                      or headers.get("connection", "").lower() == "keep-alive")
+        if method not in ("GET", "HEAD"):
+          await self.send(writer, request, peer, 405, b"only GET and HEAD\n", close=not keep_alive)
+        else:
+          await self.answer(writer, request, peer, method, url, headers, keep_alive)
+        if not keep_alive:
+          return
+    finally:
+      writer.close()
+
+  async def answer(self, writer, request, peer, method, url, headers, keep_alive) -> None:
+    try:
+      response = await asyncio.to_thread(self.respond, url)
+    except FileNotFoundError:
+      await self.send(writer, request, peer, 404, b"not found\n", close=not keep_alive)
+      return
+    except QueryError as err:
+      await self.send(writer, request, peer, 400, f"{err}\n".encode(), close=not keep_alive)
+      return
+    except (FeatureStoreError, ValueError, OSError) as err:
+      await self.send(writer, request, peer, 500, f"{err}\n".encode(), close=not keep_alive)
+      return
+    extra = {"ETag": response.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if response.etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+      await self.send(writer, request, peer, 304, b"", extra, close=not keep_alive, head=True)
+      return
+    body = response.body
+    if response.gzipped is not None and accepts_gzip(headers.get("accept-encoding", "")):
+      body = response.gzipped
+      extra["Content-Encoding"] = "gzip"
+    await self.send(writer, request, peer, 200, body, extra, response.content_type,
+                    close=not keep_alive, head=method == "HEAD")
+
+  async def send(self, writer, request, peer, status, body, extra=None, content_type="text/plain; charset=utf-8",
+                 close=False, head=False) -> None:
+    lines = [f"HTTP/1.1 {status} {REASONS[status]}", f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}", f"Connection: {'close' if close else 'keep-alive'}"]
+    lines.extend(f"{name}: {value}" for name, value in (extra or {}).items())
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if not head:
+      writer.write(body)
+    await writer.drain()
+    host = peer[0] if peer else "-"
+    sys.stderr.write(f'{host} - - [{time.strftime("%d/%b/%Y %H:%M:%S")}] "{request}" {status} {len(body)}\n')
+
+
+async def serve(server: StudyServer, bind: str, port: int) -> None:
+  listener = await asyncio.start_server(server.handle, bind, port, limit=MAX_HEADER)
+  host, port = listener.sockets[0].getsockname()[:2]
+  print(f"Serving HTTP on {host} port {port} (http://{host}:{port}/) ...", flush=True)
+  async with listener:
+    await listener.serve_forever()
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Serve the viewer, with date/bbox queries on study files.")
+  parser.add_argument("--bind", "-b", default="127.0.0.1", help="address to listen on (default %(default)s)")
+  parser.add_argument("--port", "-p", type=int, default=8000, help="port (default %(default)s)")
+  parser.add_argument("--directory", "-d", type=Path, default=ROOT, help="directory to serve (default: the repo)")
+  args = parser.parse_args(argv[1:])
+  try:
+    asyncio.run(serve(StudyServer(args.directory), args.bind, args.port))
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,312 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Compiled columnar sidecar for OHMEC study files.
+
+Reparsing a multi-MB study file is most of the startup time of every
+utility. The sidecar keeps the parsed dataset as flat columns in one
+binary file under .ohmec_cache/ next to the study file:
+
+  coords          float64 (N, 2)  every vertex, in file order
+  z_index/z_value                 the altitude of the few 3D vertices
+  ring_offsets    int64 (R + 1)   first vertex of each ring
+  part_offsets    int64 (P + 1)   first ring of each polygon/part
+  geom_offsets    int64 (F + 1)   first part of each feature's geometry
+  start/end       float64 (F)     str2date of startdatestr/enddatestr
+  table           uint8           JSON: ids, properties, geometry types,
+                                  copy references and top-level keys
+
+Points and LineStrings are stored as one part of one ring. The file is
+memory-mapped on load, so coordinates are only touched when a feature's
+geometry or shape is asked for. It is keyed by the SHA-256 of the source
+file and rebuilt whenever that changes.
+
+Usage:
+  study_sidecar.py [file ...]   build/refresh sidecars (default: all studies)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from load_ohmec_geojson import load_ohmec_geojson
+from ohmec_dates import feature_dates
+
+MAGIC = b"OHMECSC\0"
+SIDECAR_VERSION = 2
+CACHE_DIR = ".ohmec_cache"
+ALIGN = 8
+
+# geometry types whose coordinates are stored in columns, with the nesting
+# depth of their "coordinates" relative to a list of parts
+_PARTS = {
+  "Point": lambda c: [[[c]]],
+  "LineString": lambda c: [[c]],
+  "Polygon": lambda c: [c],
+  "MultiPolygon": lambda c: c,
+}
+
+
+def source_digest(data: bytes) -> str:
+  return hashlib.sha256(data).hexdigest()
+
+
+def sidecar_path(source: Path) -> Path:
+  source = Path(source)
+  return source.parent / CACHE_DIR / (source.name + ".bin")
+
+
+class _Columns:
+  """Accumulates flattened geometry while a sidecar is being built."""
+
+  def __init__(self):
+    self.xy: list[float] = []
+    self.z_index: list[int] = []
+    self.z_value: list[float] = []
+    self.ring_offsets = [0]
+    self.part_offsets = [0]
+    self.geom_offsets = [0]
+
+  def add(self, gtype: str, coords) -> bool:
+    """Flatten one geometry; False (and nothing added) if it doesn't fit.
+    Integer coordinates don't, so that they read back exactly as written;
+    such features keep their coordinates in the JSON table."""
+    try:
+      parts = _PARTS[gtype](coords)
+      rings = [ring for part in parts for ring in part]
+      for ring in rings:
+        for v in ring:
+          if not isinstance(v, list) or len(v) not in (2, 3) or not all(type(x) is float for x in v):
+            return False
+    except (KeyError, TypeError):
+      return False
+    nvert = len(self.xy) // 2
+    for part in parts:
+      for ring in part:
+        for vertex in ring:
+          self.xy.append(vertex[0])
+          self.xy.append(vertex[1])
+          if len(vertex) == 3:
+            self.z_index.append(nvert)
+            self.z_value.append(vertex[2])
+          nvert += 1
+        self.ring_offsets.append(nvert)
+      self.part_offsets.append(len(self.ring_offsets) - 1)
+    self.geom_offsets.append(len(self.part_offsets) - 1)
+    return True
+
+  def skip(self) -> None:
+    self.geom_offsets.append(self.geom_offsets[-1])
+
+
+def build_sidecar(source: Path, target: Path | None = None) -> Path:
+  """Parse a study file and write its sidecar; returns the sidecar path."""
+  source = Path(source)
+  raw = source.read_bytes()
+  struct_, varname = load_ohmec_geojson(raw.decode("utf-8"))
+  features = struct_.get("features", [])
+
+  columns = _Columns()
+  records = []
+  for feat in features:
+    geometry = dict(feat.get("geometry") or {})
+    if "coordinates" in geometry and columns.add(geometry.get("type"), geometry["coordinates"]):
+      del geometry["coordinates"]
+      geometry["columns"] = True
+    else:
+      columns.skip()
+    record = {key: value for key, value in feat.items() if key != "geometry"}
+    record["geometry"] = geometry
+    records.append(record)
+  start, end = feature_dates(features)
+
+  top = {key: value for key, value in struct_.items() if key != "features"}
+  table = json.dumps({"varname": varname, "top": top, "features": records},
+                     separators=(",", ":")).encode("utf-8")
+  arrays = {
+    "coords": np.asarray(columns.xy, dtype=np.float64).reshape(-1, 2),
+    "z_index": np.asarray(columns.z_index, dtype=np.int64),
+    "z_value": np.asarray(columns.z_value, dtype=np.float64),
+    "ring_offsets": np.asarray(columns.ring_offsets, dtype=np.int64),
+    "part_offsets": np.asarray(columns.part_offsets, dtype=np.int64),
+    "geom_offsets": np.asarray(columns.geom_offsets, dtype=np.int64),
+    "start": np.asarray(start, dtype=np.float64),
+    "end": np.asarray(end, dtype=np.float64),
+    "table": np.frombuffer(table, dtype=np.uint8),
+  }
+
+  layout = {}
+  offset = 0
+  for name, array in arrays.items():
+    layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+    offset += -(-array.nbytes // ALIGN) * ALIGN
+  header = json.dumps({"version": SIDECAR_VERSION, "source_sha256": source_digest(raw),
+                       "columns": layout}).encode("utf-8")
+  header += b" " * (-(len(MAGIC) + 4 + len(header)) % ALIGN)
+
+  target = Path(target) if target else sidecar_path(source)
+  target.parent.mkdir(parents=True, exist_ok=True)
+  # a temp file of its own, as other processes may be building the same sidecar
+  with tempfile.NamedTemporaryFile("wb", dir=target.parent, prefix=target.name + ".",
+                                   suffix=".tmp", delete=False) as fh:
+    try:
+      fh.write(MAGIC)
+      fh.write(struct.pack("<I", len(header)))
+      fh.write(header)
+      for name, array in arrays.items():
+        data = array.tobytes()
+        fh.write(data)
+        fh.write(b"\0" * (-len(data) % ALIGN))
+    except BaseException:
+      fh.close()
+      os.unlink(fh.name)
+      raise
+  os.replace(fh.name, target)
+  return target
+
+
+class Sidecar:
+  """A memory-mapped sidecar; columns are numpy views into the file."""
+
+  def __init__(self, path: Path):
+    self.path = Path(path)
+    self._map = np.memmap(self.path, dtype=np.uint8, mode="r")
+    if bytes(self._map[:len(MAGIC)]) != MAGIC:
+      raise ValueError(f"{self.path} is not an OHMEC sidecar")
+    (hlen,) = struct.unpack("<I", bytes(self._map[len(MAGIC):len(MAGIC) + 4]))
+    base = len(MAGIC) + 4
+    self.header = json.loads(bytes(self._map[base:base + hlen]))
+    base += hlen
+    self.columns = {}
+    for name, spec in self.header["columns"].items():
+      dtype = np.dtype(spec["dtype"])
+      count = int(np.prod(spec["shape"])) if spec["shape"] else 1
+      start = base + spec["offset"]
+      view = self._map[start:start + count * dtype.itemsize].view(dtype)
+      self.columns[name] = view.reshape(spec["shape"])
+    self.coords = self.columns["coords"]
+    self.ring_offsets = self.columns["ring_offsets"]
+    self.part_offsets = self.columns["part_offsets"]
+    self.geom_offsets = self.columns["geom_offsets"]
+    self.start = self.columns["start"]
+    self.end = self.columns["end"]
+    self._z_index = self.columns["z_index"]
+    self._z_value = self.columns["z_value"]
+
+  @property
+  def source_sha256(self) -> str:
+    return self.header["source_sha256"]
+
+  def dataset(self) -> tuple[dict, str | None]:
+    """Return (struct, varname) like load_ohmec_geojson(), except that
+    column-backed geometries have no "coordinates"; ask coordinates() or
+    shape() for those."""
+    table = json.loads(self.columns["table"].tobytes())
+    self.backed = []
+    for record in table["features"]:
+      self.backed.append(record["geometry"].pop("columns", False))
+    struct_ = dict(table["top"])
+    struct_["features"] = table["features"]
+    return struct_, table["varname"]
+
+  def has_coordinates(self, index: int) -> bool:
+    return self.backed[index]
+
+  def has_z(self, index: int) -> bool:
+    r0 = self.part_offsets[self.geom_offsets[index]]
+    r1 = self.part_offsets[self.geom_offsets[index + 1]]
+    lo, hi = np.searchsorted(self._z_index, [self.ring_offsets[r0], self.ring_offsets[r1]])
+    return hi > lo
+
+  def _ring(self, v0: int, v1: int) -> list:
+    ring = self.coords[v0:v1].tolist()
+    if len(self._z_index):
+      lo, hi = np.searchsorted(self._z_index, [v0, v1])
+      for k in range(lo, hi):
+        ring[self._z_index[k] - v0].append(float(self._z_value[k]))
+    return ring
+
+  def _parts(self, index: int) -> list:
+    parts = []
+    for p in range(self.geom_offsets[index], self.geom_offsets[index + 1]):
+      rings = []
+      for r in range(self.part_offsets[p], self.part_offsets[p + 1]):
+        rings.append(self._ring(self.ring_offsets[r], self.ring_offsets[r + 1]))
+      parts.append(rings)
+    return parts
+
+  def coordinates(self, index: int, gtype: str):
+    """Rebuild the GeoJSON coordinates of feature index."""
+    parts = self._parts(index)
+    if gtype == "Point":
+      return parts[0][0][0]
+    if gtype == "LineString":
+      return parts[0][0]
+    if gtype == "Polygon":
+      return parts[0]
+    return parts
+
+  def shape(self, index: int, gtype: str):
+    """Build the (2D) Shapely geometry straight from the coordinate columns."""
+    import shapely.geometry
+    polygons = []
+    for p in range(self.geom_offsets[index], self.geom_offsets[index + 1]):
+      r0 = self.part_offsets[p]
+      r1 = self.part_offsets[p + 1]
+      rings = [self.coords[self.ring_offsets[r]:self.ring_offsets[r + 1]] for r in range(r0, r1)]
+      if gtype == "Point":
+        return shapely.geometry.Point(rings[0][0])
+      if gtype == "LineString":
+        return shapely.geometry.LineString(rings[0])
+      polygons.append(shapely.geometry.Polygon(rings[0], rings[1:]) if rings else shapely.geometry.Polygon())
+    if gtype == "Polygon":
+      return polygons[0]
+    return shapely.geometry.MultiPolygon(polygons)
+
+
+def load_sidecar(source: Path, build: bool = True) -> Sidecar | None:
+  """Return the up-to-date sidecar of a study file, (re)building it if
+  needed and allowed. None if it can't be used, e.g. a read-only tree."""
+  source = Path(source)
+  target = sidecar_path(source)
+  digest = source_digest(source.read_bytes())
+  try:
+    sidecar = Sidecar(target)
+    if sidecar.header.get("version") == SIDECAR_VERSION and sidecar.source_sha256 == digest:
+      return sidecar
+    del sidecar
+  except (OSError, ValueError, KeyError):
+    pass
+  if not build:
+    return None
+  try:
+    build_sidecar(source, target)
+  except OSError:
+    return None
+  try:
+    return Sidecar(target)
+  except (OSError, ValueError, KeyError):
+    return None
+
+
+def main(argv: list[str]) -> int:
+  if len(argv) > 1:
+    files = [Path(a) for a in argv[1:]]
+  else:
+    files = sorted(Path(__file__).resolve().parents[1].glob("ohmec_data_*.geojson"))
+  for path in files:
+    target = build_sidecar(path)
+    print(f"{path.name}: {target} ({target.stat().st_size} bytes)")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
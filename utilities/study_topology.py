@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Shared-arc (TopoJSON-like) encoding of OHMEC study files.
+
+Neighbouring polities store their common border twice. encode() keeps
+every border stretch of the Polygon and MultiPolygon features once, in a
+top-level "arcs" list (see topology.py), and replaces each such
+geometry's "coordinates" with "arcs": the same nesting of rings, each
+ring a list of arc references, ~n (i.e. -n - 1) for arc n walked
+backwards. Moving a shared border is then a change to a single arc.
+
+  {"type": "OhmecTopology", "format": 1, "varname": "dataRegion",
+   "arcs": [[[lon, lat], ...], ...],
+   "study": {the study, with "arcs" in place of polygon "coordinates"}}
+
+decode() gives back the very dataset encode() was given: same keys in the
+same order, same integer or float coordinates, coordinate_copy /
+coordinate_copies references and LineString/Point geometry untouched,
+and the JS variable name of the file. encode() checks that before it
+returns. The file's own layout (indentation, spacing) is not kept;
+decoded files are written compact.
+
+Usage:
+  study_topology.py encode [-o OUT] file ...   writes <study>.topo.json
+  study_topology.py decode [-o OUT] file       writes to OUT or stdout
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from load_ohmec_geojson import dump_ohmec_geojson, load_ohmec_geojson  # noqa: E402
+from topology import extract_arcs, geometry_lines, join_arcs, map_lines  # noqa: E402
+
+TOPOLOGY_TYPE = "OhmecTopology"
+TOPOLOGY_FORMAT = 1
+POLYGONAL = ("Polygon", "MultiPolygon")
+
+
+class TopologyError(ValueError):
+  """Raised for a study that can't be encoded, or a malformed topology."""
+
+
+def topology_path(source: Path) -> Path:
+  source = Path(source)
+  return source.with_name(source.name.replace(".geojson", "") + ".topo.json")
+
+
+def _replace_member(geometry: dict, old: str, new: str, value) -> dict:
+  """geometry with member old renamed to new and set to value, in place."""
+  return {(new if key == old else key): (value if key == old else item) for key, item in geometry.items()}
+
+
+def _encodable(feat) -> bool:
+  geometry = feat.get("geometry") if isinstance(feat, dict) else None
+  return isinstance(geometry, dict) and geometry.get("type") in POLYGONAL and "coordinates" in geometry
+
+
+def _canonical(value) -> str:
+  return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode(struct: dict, varname: str | None = None) -> dict:
+  """The topology of a study dataset; see the module doc."""
+  features = struct.get("features", [])
+  lines = []
+  for feat in features:
+    if _encodable(feat):
+      geometry = feat["geometry"]
+      if "arcs" in geometry:
+        raise TopologyError(f"feature {feat.get('id')} already has an \"arcs\" member in its geometry")
+      lines.extend(geometry_lines(geometry["type"], geometry["coordinates"]))
+  arcs, refs = extract_arcs(lines)
+
+  it = iter(refs)
+  encoded = []
+  for feat in features:
+    if _encodable(feat):
+      geometry = feat["geometry"]
+      topo = map_lines(geometry["type"], geometry["coordinates"], lambda _line: next(it))
+      feat = dict(feat, geometry=_replace_member(geometry, "coordinates", "arcs", topo))
+    encoded.append(feat)
+  study = dict(struct)
+  if "features" in struct:
+    study["features"] = encoded
+  topology = {
+    "type": TOPOLOGY_TYPE,
+    "format": TOPOLOGY_FORMAT,
+    "varname": varname,
+    "arcs": arcs,
+    "study": study,
+  }
+  if _canonical(decode(topology)[0]) != _canonical(struct):
+    raise TopologyError("shared-arc round trip does not reproduce the study")
+  return topology
+
+
+def decode(topology: dict) -> tuple[dict, str | None]:
+  """(struct, varname) of a topology, as load_ohmec_geojson() returns them."""
+  if topology.get("type") != TOPOLOGY_TYPE or topology.get("format") != TOPOLOGY_FORMAT:
+    raise TopologyError(f"not an {TOPOLOGY_TYPE} format {TOPOLOGY_FORMAT} file")
+  arcs = topology["arcs"]
+  study = topology["study"]
+  decoded = []
+  for feat in study.get("features", []):
+    geometry = feat.get("geometry") if isinstance(feat, dict) else None
+    if isinstance(geometry, dict) and "arcs" in geometry:
+      try:
+        coords = map_lines(geometry["type"], geometry["arcs"], lambda line: join_arcs(arcs, line))
+      except (IndexError, KeyError, TypeError) as err:
+        raise TopologyError(f"bad arc references in feature {feat.get('id')}: {err}") from err
+      feat = dict(feat, geometry=_replace_member(geometry, "arcs", "coordinates", coords))
+    decoded.append(feat)
+  struct = dict(study)
+  if "features" in study:
+    struct["features"] = decoded
+  return struct, topology.get("varname")
+
+
+def _vertices(struct: dict) -> int:
+  return sum(len(line) for feat in struct.get("features", []) if _encodable(feat)
+             for line in geometry_lines(feat["geometry"]["type"], feat["geometry"]["coordinates"]))
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Encode study files as shared arcs, or decode them back.")
+  sub = parser.add_subparsers(dest="command", required=True)
+  enc = sub.add_parser("encode", help="write <study>.topo.json for each study file")
+  enc.add_argument("files", nargs="+", type=Path)
+  enc.add_argument("-o", "--out", type=Path, help="output file (one input only)")
+  dec = sub.add_parser("decode", help="write the study file a topology was made from")
+  dec.add_argument("file", type=Path)
+  dec.add_argument("-o", "--out", type=Path, help="output file (default stdout)")
+  args = parser.parse_args(argv[1:])
+
+  if args.command == "decode":
+    try:
+      struct, varname = decode(json.loads(args.file.read_text(encoding="utf-8")))
+    except (TopologyError, KeyError, ValueError) as err:
+      sys.stderr.write(f"{args.file}: {err}\n")
+      return 2
+    text = dump_ohmec_geojson(struct, varname)
+    if args.out:
+      args.out.write_text(text, encoding="utf-8")
+    else:
+      sys.stdout.write(text)
+    return 0
+
+  if args.out and len(args.files) > 1:
+    parser.error("-o/--out takes a single input file")
+  for path in args.files:
+    struct, varname = load_ohmec_geojson(path.read_text(encoding="utf-8"))
+    try:
+      topology = encode(struct, varname)
+    except TopologyError as err:
+      sys.stderr.write(f"{path}: {err}\n")
+      return 2
+    target = args.out or topology_path(path)
+    text = _canonical(topology) + "\n"
+    target.write_text(text, encoding="utf-8")
+    compact = len(dump_ohmec_geojson(struct, varname).encode("utf-8"))
+    vertices = sum(len(arc) for arc in topology["arcs"])
+    print(f"{path.name}: {len(topology['arcs'])} arcs, {vertices} of {_vertices(struct)} polygon vertices, "
+          f"{len(text.encode('utf-8'))} bytes ({compact} compact GeoJSON, {path.stat().st_size} as written)")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
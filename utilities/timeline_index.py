@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Precompute the viewer's timeline index for OHMEC study files.
+
+On load, ohmec.js collects its "dates of interest" (every feature's start
+and the first second after every feature's end), then works out which
+feature ids appear and disappear at each of them. This does the same
+offline, with the viewer's date semantics (ohmec_dates.str2date) and
+the feature checks of geo_lint() in ohmec-lint.js, and writes
+<study>.timeline.json next to the study file:
+
+  {"format": 1, "source": ..., "source_sha256": ...,
+   "ids":   [feature ids, in the viewer's default sort order],
+   "dates": [dates of interest, ms since the epoch, ascending],
+   "adds":  [[positions in ids appearing at dates[i]], ...],
+   "subs":  [[positions in ids disappearing at dates[i]], ...]}
+
+adds[0] is everything visible at dates[0]; replaying adds and subs gives
+idsPerDOISorted. Dates that depend on when the page is loaded (today, and
+the end of features ending "present") are left out: nothing appears or
+disappears at them, so the viewer can insert them with empty deltas. A
+feature starting "present" is in ids but never in adds, as the viewer
+never shows it.
+
+--verify replays each index written and checks it against the features
+active at every one of its dates.
+
+Usage:
+  timeline_index.py [--verify] [file ...]
+  With no files, indexes all ohmec_data_*.geojson in the repo root.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from load_ohmec_geojson import open_ohmec_stream  # noqa: E402
+from ohmec_dates import IntervalIndex, str2date  # noqa: E402
+
+INDEX_FORMAT = 1
+# studies.js hands this file to geo_lint() with convertFromNativeLands set
+NATIVE_LANDS_FILES = ("ohmec_data_nl.geojson",)
+VIEWER_TYPES = ("Polygon", "MultiPolygon", "Point", "LineString")
+REQUIRED = ("entity1type", "entity1name", "fidelity", "startdatestr", "enddatestr")
+TEXTURES = ("crosshatch", "diagonal", "horizontal", "vertical", "dot", "x")
+# a native-land.ca feature's dates, as set by geo_lint()
+NATIVE_LANDS_DATES = ("700", "1768")
+
+
+class LintError(ValueError):
+  """A feature geo_lint() would skip."""
+
+
+def index_path(source: Path) -> Path:
+  source = Path(source)
+  return source.with_name(source.name.replace(".geojson", "") + ".timeline.json")
+
+
+def _bounds(coords) -> tuple[float, float, float, float]:
+  """(min, max) of the first and second coordinate, as L.polygon().getBounds()
+  sees them: GeoJSON's [lon, lat] is read as [lat, lng]."""
+  firsts, seconds = [], []
+  stack = [coords]
+  while stack:
+    item = stack.pop()
+    if item and isinstance(item[0], (int, float)):
+      firsts.append(item[0])
+      seconds.append(item[1])
+    else:
+      stack.extend(item)
+  return min(firsts), max(firsts), min(seconds), max(seconds)
+
+
+def _in_north_america(geometry: dict) -> bool:
+  south, north, west, east = _bounds(geometry["coordinates"])
+  # roughly Panama in the south and Greenland on the east, less NW South America
+  is_na = south <= -21 and west >= 7
+  if is_na and east < 12.68 and north > -77:
+    is_na = False
+  return is_na
+
+
+def _fidelity_ok(fidelity) -> bool:
+  try:
+    value = float(fidelity)
+  except (TypeError, ValueError):
+    return True  # NaN compares false both ways in JavaScript
+  return not (value < 1 or value > 5)
+
+
+def lint_feature(feat, geometry_types: dict, native_lands: bool):
+  """(startdatestr, enddatestr) of a feature the viewer shows, None for one
+  it drops; LintError for one geo_lint() rejects."""
+  fid = feat.get("id")
+  if "geometry" not in feat:
+    raise LintError(f"no geometry in feature {fid}")
+  geometry = feat["geometry"]
+  if geometry.get("type") not in VIEWER_TYPES:
+    raise LintError(f"feature {fid} should have geometry of Polygon, MultiPolygon, LineString or Point, got {geometry.get('type')}")
+  if "properties" not in feat:
+    raise LintError(f"no properties in feature {fid}")
+  props = feat["properties"]
+  if native_lands:
+    if not _in_north_america(geometry):
+      return None
+    for required in ("Name", "color"):
+      if required not in props:
+        raise LintError(f"feature {fid} missing property {required}")
+    return NATIVE_LANDS_DATES
+  for required in REQUIRED:
+    if required not in props:
+      raise LintError(f"feature {fid} missing property {required}")
+  if "source" not in props and "sources" not in props:
+    raise LintError(f"feature {fid} requires either `source` or `sources` property")
+  if not _fidelity_ok(props["fidelity"]):
+    raise LintError(f"fidelity for {fid} should be between 1 (lowest) and 5 (highest), got {props['fidelity']}")
+  if "texture" in props and props["texture"] not in TEXTURES:
+    raise LintError(f"feature {fid} has unknown texture {props['texture']!r}")
+  drop = props["entity1type"] == "tribe" and re.search("Cherokee", str(props["entity1name"]))
+  if "coordinate_copy" in geometry:
+    src = geometry["coordinate_copy"]
+    if src not in geometry_types:
+      raise LintError(f"can't copy coordinates from {src} for {fid}")
+    if src == fid:
+      raise LintError(f"can't copy coordinates from self (id {fid})")
+    if geometry_types[src] != geometry["type"]:
+      raise LintError(f"can't copy coordinates from {src} type {geometry_types[src]} to {fid} type {geometry['type']}")
+  if "coordinate_copies" in geometry:
+    for src in geometry["coordinate_copies"]:
+      if src not in geometry_types:
+        raise LintError(f"can't copy coordinates from {src} for {fid}")
+      if geometry["type"] != "MultiPolygon":
+        raise LintError(f"can't copy multiple coordinates to {fid} type {geometry['type']}")
+      if geometry_types[src] not in ("Polygon", "MultiPolygon"):
+        raise LintError(f"can't copy coordinates from {src} type {geometry_types[src]}")
+  if drop:
+    return None
+  return props["startdatestr"], props["enddatestr"]
+
+
+def viewer_features(features, native_lands: bool = False, warnings: list | None = None):
+  """(id, start, end) of every feature the viewer keeps, in file order.
+  Like geo_lint(), a rejected feature only frees its id again; copies
+  can only refer to features earlier in the file."""
+  ids = set()
+  geometry_types: dict = {}
+  for feat in features:
+    fid = feat.get("id")
+    try:
+      if feat.get("type") != "Feature":
+        raise LintError(f"feature type not Feature, got {feat.get('type')}")
+      if fid in ids:
+        raise LintError(f"got duplicate dataset ID {fid}")
+      ids.add(fid)
+      geometry_types[fid] = (feat.get("geometry") or {}).get("type")
+      try:
+        dates = lint_feature(feat, geometry_types, native_lands)
+        if dates is not None:
+          start = str2date(dates[0], False)
+          end = str2date(dates[1], True)
+      except LintError:
+        ids.discard(fid)
+        del geometry_types[fid]
+        raise
+      except ValueError as err:
+        ids.discard(fid)
+        del geometry_types[fid]
+        raise LintError(f"feature {fid}: {err}") from err
+    except LintError as err:
+      if warnings is not None:
+        warnings.append(str(err))
+      continue
+    if dates is not None:
+      yield fid, start, end
+
+
+def build_index(entries: list) -> dict:
+  """The timeline index of (id, start, end) entries: see the module doc."""
+  # a start of "present" is never reached
+  dates = {start for _fid, start, _end in entries if math.isfinite(start)}
+  dates.update(end + 1000 for _fid, _start, end in entries if math.isfinite(end))
+  dates = sorted(dates)
+  ids = sorted({fid for fid, _start, _end in entries}, key=str)
+  position = {fid: n for n, fid in enumerate(ids)}
+  adds = [[] for _date in dates]
+  subs = [[] for _date in dates]
+  for fid, start, end in entries:
+    first = bisect.bisect_left(dates, start)
+    after = bisect.bisect_right(dates, end)
+    if first >= after:
+      continue
+    adds[first].append(position[fid])
+    if after < len(dates):
+      subs[after].append(position[fid])
+  return {
+    "ids": ids,
+    "dates": [int(date) for date in dates],
+    "adds": [sorted(entry) for entry in adds],
+    "subs": [sorted(entry) for entry in subs],
+  }
+
+
+def verify_index(index: dict, entries: list) -> list[str]:
+  """Problems found replaying the adds and subs of index against the
+  (id, start, end) entries it was built from."""
+  problems = []
+  if index["dates"] != sorted(set(index["dates"])):
+    problems.append("dates are not ascending and distinct")
+  active = IntervalIndex([start for _fid, start, _end in entries], [end for _fid, _start, end in entries])
+  shown: set = set()
+  for date, adds, subs in zip(index["dates"], index["adds"], index["subs"]):
+    shown.difference_update(index["ids"][n] for n in subs)
+    shown.update(index["ids"][n] for n in adds)
+    expected = {entries[n][0] for n in active.at(date)}
+    if shown != expected:
+      problems.append(f"at {date}: {len(shown - expected)} shown that are not active, "
+                      f"{len(expected - shown)} active that are not shown")
+  return problems
+
+
+def index_file(path: Path, warnings: list | None = None, problems: list | None = None) -> Path:
+  """Write the timeline index of one study file; returns its path. With
+  problems given, the index is verified and what fails goes there."""
+  path = Path(path)
+  with open_ohmec_stream(path) as stream:
+    entries = list(viewer_features(stream, path.name in NATIVE_LANDS_FILES, warnings))
+  index = {
+    "format": INDEX_FORMAT,
+    "source": path.name,
+    "source_sha256": hashlib.sha256(path.read_bytes()).hexdigest(),
+  }
+  index.update(build_index(entries))
+  target = index_path(path)
+  tmp = target.with_name(target.name + ".tmp")
+  with open(tmp, "w", encoding="utf-8") as fh:
+    json.dump(index, fh, separators=(",", ":"))
+    fh.write("\n")
+  os.replace(tmp, target)
+  if problems is not None:
+    problems.extend(verify_index(json.loads(target.read_text(encoding="utf-8")), entries))
+  return target
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Precompute the viewer's timeline index for study files.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--verify", action="store_true", help="check each index by replaying it")
+  args = parser.parse_args(argv[1:])
+  files = args.files or sorted(ROOT.glob("ohmec_data_*.geojson"))
+  status = 0
+  for path in files:
+    warnings: list[str] = []
+    problems: list[str] | None = [] if args.verify else None
+    target = index_file(path, warnings, problems)
+    for warning in warnings:
+      print(f"{path.name}: skipped: {warning}", file=sys.stderr)
+    print(f"{path.name}: {target.name} ({target.stat().st_size} bytes)")
+    for problem in problems or []:
+      print(f"{path.name}: {problem}", file=sys.stderr)
+      status = 1
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,135 @@
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Shared-arc topology of OHMEC geometry.
+
+Neighbouring polities store their common border twice, once in each
+polygon. extract_arcs() cuts every ring and line at its junctions and
+keeps each distinct stretch once, in the spirit of TopoJSON: a line
+becomes a list of arc references, ~n (i.e. -n - 1) standing for arc n
+walked backwards. A junction is a vertex where lines meet or part ways,
+the end of an open line, or the first vertex of a ring.
+
+Cutting rings at their first vertex too means join_arcs() rebuilds every
+line exactly: same start, same direction, and the very vertex values of
+the input (integer and float coordinates are told apart, as are 0.0 and
+-0.0), so a round trip through arcs is lossless.
+
+Usage:
+  lines = list(geometry_lines(geometry["type"], geometry["coordinates"]))
+  arcs, refs = extract_arcs(lines)
+  assert join_arcs(arcs, refs[0]) == lines[0]
+"""
+
+from __future__ import annotations
+
+from typing import Callable, Iterator
+
+# depth of the lines (rings or line strings) inside "coordinates"
+LINE_DEPTH = {"LineString": 0, "Polygon": 1, "MultiPolygon": 2}
+
+
+def vertex_key(vertex: list) -> tuple:
+  """Hashable identity of a vertex that keeps what JSON would write."""
+  key = tuple(vertex)
+  for c in vertex:
+    if type(c) is not float or not c:
+      return tuple((type(c).__name__, repr(c)) for c in vertex)
+  return key
+
+
+def geometry_lines(gtype: str, coords) -> Iterator[list]:
+  """The rings or line strings of a geometry, in order."""
+  depth = LINE_DEPTH[gtype]
+  if depth == 0:
+    yield coords
+  elif depth == 1:
+    yield from coords
+  else:
+    for polygon in coords:
+      yield from polygon
+
+
+def map_lines(gtype: str, coords, fn: Callable):
+  """coords with each of its lines replaced by fn(line), nesting kept."""
+  depth = LINE_DEPTH[gtype]
+  if depth == 0:
+    return fn(coords)
+  if depth == 1:
+    return [fn(ring) for ring in coords]
+  return [[fn(ring) for ring in polygon] for polygon in coords]
+
+
+def _closed(keys: list) -> bool:
+  return len(keys) > 2 and keys[0] == keys[-1]
+
+
+def _junctions(lines_keys: list[list]) -> set:
+  junctions = set()
+  neighbours: dict = {}
+  for keys in lines_keys:
+    if len(keys) < 2:
+      continue
+    if _closed(keys):
+      ring = keys[:-1]
+      count = len(ring)
+      junctions.add(ring[0])
+      for i, key in enumerate(ring):
+        pair = frozenset((ring[i - 1], ring[(i + 1) % count]))
+        if neighbours.setdefault(key, pair) != pair:
+          junctions.add(key)
+    else:
+      junctions.add(keys[0])
+      junctions.add(keys[-1])
+      for i in range(1, len(keys) - 1):
+        pair = frozenset((keys[i - 1], keys[i + 1]))
+        if neighbours.setdefault(keys[i], pair) != pair:
+          junctions.add(keys[i])
+  return junctions
+
+
+def extract_arcs(lines: list[list]) -> tuple[list[list], list[list[int]]]:
+  """Split lines (rings repeat their first vertex at the end) into shared
+  arcs. Returns (arcs, refs): refs[i] rebuilds lines[i] via join_arcs()."""
+  lines_keys = [[vertex_key(v) for v in line] for line in lines]
+  junctions = _junctions(lines_keys)
+  arcs: list[list] = []
+  index: dict = {}
+  all_refs = []
+  for line, keys in zip(lines, lines_keys):
+    refs = []
+    if len(keys) < 2:
+      arcs.append(list(line))
+      all_refs.append([len(arcs) - 1])
+      continue
+    start = 0
+    for i in range(1, len(keys)):
+      if i < len(keys) - 1 and keys[i] not in junctions:
+        continue
+      arc_key = tuple(keys[start:i + 1])
+      ref = index.get(arc_key)
+      if ref is None:
+        ref = index.get(arc_key[::-1])
+        if ref is not None:
+          ref = ~ref
+        else:
+          ref = len(arcs)
+          arcs.append(line[start:i + 1])
+          index[arc_key] = ref
+      refs.append(ref)
+      start = i
+    all_refs.append(refs)
+  return arcs, all_refs
+
+
+def arc_points(arcs: list[list], ref: int) -> list:
+  return arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+
+
+def join_arcs(arcs: list[list], refs: list[int]) -> list:
+  """Concatenate arcs back into a line; consecutive arcs share an end."""
+  line: list = []
+  for ref in refs:
+    points = arc_points(arcs, ref)
+    line.extend(points[1:] if line else points)
+  return line
@@ -4,93 +4,283 @@
 # SPDX-License-Identifier: Apache-2.0
 """Validate OHMEC study GeoJSON files parse and have basic structure.
 
+With numpy installed, the geometry itself is checked too, vectorized
+over the whole file (geometry_checks.py): positions, ring closure and
+vertex counts. Warnings, such as an unclosed ring, are reported but don't
+fail the run. animateTo links are checked the way prepare_animations()
+in ohmec-lint.js does: the target exists, has the same geometry type
+and, for polygons, the same number of outer-ring vertices; a LineString
+may only grow.
+
+Files are checked in a process pool. The SHA-256 of every file that
+passes is remembered in .ohmec_cache/validate.json, so an unchanged file
+is not read again. The cache is tied to the validator's own source, and
+any change to that discards it.
+
 Usage:
-  validate_geojson.py [file ...]
-  With no args, validates all ohmec_data_*.geojson in the repo root.
+  validate_geojson.py [--jobs N] [--no-cache] [file ...]
+  With no files, validates all ohmec_data_*.geojson in the repo root.
 """
 
 from __future__ import annotations
 
+import argparse
+import hashlib
 import json
+import multiprocessing
+import os
 import sys
+import time
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parents[1]
 sys.path.insert(0, str(Path(__file__).resolve().parent))
-from load_ohmec_geojson import load_ohmec_geojson  # noqa: E402
+from feature_store import FeatureStore, FeatureStoreError  # noqa: E402
+from load_ohmec_geojson import open_ohmec_stream  # noqa: E402
+
+try:
+  from geometry_checks import GeometryChecker  # noqa: E402
+except ImportError:  # numpy is optional; only the structure is checked then
+  GeometryChecker = None
+
+CACHE_FORMAT = 1
+CACHE_PATH = ROOT / ".ohmec_cache" / "validate.json"
+# passing digests kept across runs, most recent last
+CACHE_ENTRIES = 64
+# a change to any of these can change a verdict
+VALIDATOR_SOURCES = ("validate_geojson.py", "geometry_checks.py", "feature_store.py",
+                     "load_ohmec_geojson.py", "ohmec_dates.py")
+
+
+def _sizes(coords):
+  """coords with each ring or line replaced by its length."""
+  if not isinstance(coords, list) or not coords or not isinstance(coords[0], list):
+    return coords
+  if coords[0] and isinstance(coords[0][0], list):
+    return [_sizes(sub) for sub in coords]
+  return len(coords)
+
+
+def geometry_stub(feat: dict) -> dict:
+  """Feature reduced to what coordinate copy resolution and the animateTo
+  checks look at: the coordinates keep their nesting, but each ring or
+  line is just its number of positions."""
+  geometry = feat["geometry"]
+  stub = {key: geometry[key] for key in ("type", "coordinate_copy", "coordinate_copies") if key in geometry}
+  if "coordinates" in geometry:
+    stub["coordinates"] = _sizes(geometry["coordinates"]) if geometry["type"] != "Point" else 1
+  return {"id": feat["id"], "geometry": stub}
+
 
+def _outer(sizes) -> int | None:
+  return sizes[0] if isinstance(sizes, list) and sizes and isinstance(sizes[0], int) else None
 
-def validate_file(path: Path) -> list[str]:
+
+def animation_error(store: FeatureStore, fid, target) -> str | None:
+  """Why prepare_animations() would drop fid's animateTo link, if it would."""
+  if target not in store:
+    return f"animateTo target {target!r} does not exist"
+  gtype = store.geometry(fid)["type"]
+  target_type = store.geometry(target)["type"]
+  if gtype != target_type:
+    return f"can't animate {gtype} to {target!r} type {target_type}"
+  sizes = store.geometry(fid)["coordinates"]
+  target_sizes = store.geometry(target)["coordinates"]
+  if gtype == "Polygon":
+    if _outer(sizes) != _outer(target_sizes):
+      return f"outer ring has {_outer(sizes)} positions, animateTo target {target!r} has {_outer(target_sizes)}"
+  elif gtype == "MultiPolygon":
+    for n, (polygon, target_polygon) in enumerate(zip(sizes, target_sizes)):
+      if _outer(polygon) != _outer(target_polygon):
+        return (f"polygon {n} outer ring has {_outer(polygon)} positions, "
+                f"animateTo target {target!r} has {_outer(target_polygon)}")
+  elif gtype == "LineString":
+    if isinstance(sizes, int) and isinstance(target_sizes, int) and target_sizes < sizes:
+      return f"animateTo target {target!r} has fewer positions ({target_sizes} vs {sizes})"
+  else:
+    return f"can't animate a {gtype}"
+  return None
+
+
+def validate_file(path: Path, warnings: list | None = None) -> list[str]:
+  """Check one study file, streaming its features so that memory stays
+  bounded by the largest feature rather than the file."""
   errors: list[str] = []
+  ids = set()
+  stubs = []
+  animations = []
+  checker = GeometryChecker() if GeometryChecker is not None else None
+  count = 0
   try:
-    text = path.read_text(encoding="utf-8")
-    data, _ = load_ohmec_geojson(text)
+    with open_ohmec_stream(path) as stream:
+      for i, feat in enumerate(stream):
+        count += 1
+        if not isinstance(feat, dict):
+          errors.append(f"{path.name}: features[{i}] is not an object")
+          continue
+        if feat.get("type") != "Feature":
+          errors.append(f"{path.name}: features[{i}] type is {feat.get('type')!r}, expected Feature")
+        fid = feat.get("id")
+        if fid is None or fid == "":
+          errors.append(f"{path.name}: features[{i}] missing id")
+        elif fid in ids:
+          errors.append(f"{path.name}: duplicate feature id {fid!r}")
+        else:
+          ids.add(fid)
+        if "geometry" not in feat:
+          errors.append(f"{path.name}: feature {fid!r} missing geometry")
+        elif not isinstance(feat["geometry"], dict) or "type" not in feat["geometry"]:
+          errors.append(f"{path.name}: feature {fid!r} geometry must be an object with a type")
+        elif fid is not None:
+          stubs.append(geometry_stub(feat))
+          if checker is not None and "coordinates" in feat["geometry"]:
+            checker.add(fid, feat["geometry"]["type"], feat["geometry"]["coordinates"])
+        if "properties" not in feat:
+          errors.append(f"{path.name}: feature {fid!r} missing properties")
+        elif isinstance(feat["properties"], dict) and "animateTo" in feat["properties"]:
+          animations.append((fid, feat["properties"]["animateTo"]))
   except Exception as exc:  # noqa: BLE001 - report any parse/load failure
     return [f"{path.name}: failed to parse ({exc})"]
 
-  if not isinstance(data, dict):
-    return [f"{path.name}: top-level value must be an object"]
+  header = stream.header
+  if header.get("type") != "FeatureCollection":
+    errors.insert(0, f"{path.name}: expected type FeatureCollection, got {header.get('type')!r}")
 
-  if data.get("type") != "FeatureCollection":
-    errors.append(f"{path.name}: expected type FeatureCollection, got {data.get('type')!r}")
-
-  features = data.get("features")
-  if not isinstance(features, list):
+  if not stream.has_features:
     errors.append(f"{path.name}: missing features array")
     return errors
 
-  if len(features) == 0:
+  if count == 0:
     errors.append(f"{path.name}: features array is empty")
 
-  ids = set()
-  for i, feat in enumerate(features):
-    if not isinstance(feat, dict):
-      errors.append(f"{path.name}: features[{i}] is not an object")
-      continue
-    if feat.get("type") != "Feature":
-      errors.append(f"{path.name}: features[{i}] type is {feat.get('type')!r}, expected Feature")
-    fid = feat.get("id")
-    if fid is None or fid == "":
-      errors.append(f"{path.name}: features[{i}] missing id")
-    elif fid in ids:
-      errors.append(f"{path.name}: duplicate feature id {fid!r}")
+  if checker is not None:
+    geometry_errors, geometry_warnings = checker.check()
+    errors.extend(f"{path.name}: {err}" for err in geometry_errors)
+    if warnings is not None:
+      warnings.extend(f"{path.name}: {warning}" for warning in geometry_warnings)
+
+  if not errors:
+    try:
+      store = FeatureStore({"features": stubs})
+    except FeatureStoreError as exc:
+      errors.append(f"{path.name}: {exc}")
     else:
-      ids.add(fid)
-    if "geometry" not in feat:
-      errors.append(f"{path.name}: feature {fid!r} missing geometry")
-    if "properties" not in feat:
-      errors.append(f"{path.name}: feature {fid!r} missing properties")
+      for fid, target in animations:
+        err = animation_error(store, fid, target)
+        if err:
+          errors.append(f"{path.name}: feature {fid!r} {err}")
 
   return errors
 
 
+def validator_digest() -> str:
+  digest = hashlib.sha256()
+  for name in VALIDATOR_SOURCES:
+    digest.update((Path(__file__).resolve().parent / name).read_bytes())
+  return digest.hexdigest()
+
+
+def file_digest(path: Path) -> str:
+  return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def load_cache(path: Path, engine: str) -> list[str]:
+  """Digests of files that passed before; a missing or stale cache is empty."""
+  try:
+    data = json.loads(path.read_text(encoding="utf-8"))
+  except (OSError, ValueError):
+    return []
+  if (isinstance(data, dict) and data.get("format") == CACHE_FORMAT
+      and data.get("engine") == engine and isinstance(data.get("passed"), list)):
+    return data["passed"]
+  return []
+
+
+def save_cache(path: Path, engine: str, passed: list[str]) -> None:
+  """Write the cache atomically; a read-only checkout just goes without."""
+  try:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps({"format": CACHE_FORMAT, "engine": engine,
+                               "passed": passed[-CACHE_ENTRIES:]}, indent=1) + "\n", encoding="utf-8")
+    os.replace(tmp, path)
+  except OSError:
+    pass
+
+
+def timed_validate(path: Path) -> tuple[list[str], list[str], float]:
+  started = time.perf_counter()
+  warnings: list[str] = []
+  errors = validate_file(path, warnings)
+  return errors, warnings, time.perf_counter() - started
+
+
 def main(argv: list[str]) -> int:
-  if len(argv) > 1:
-    files = [Path(a) for a in argv[1:]]
-  else:
-    files = sorted(ROOT.glob("ohmec_data_*.geojson"))
+  parser = argparse.ArgumentParser(description="Check that study files parse and have basic structure.")
+  parser.add_argument("files", nargs="*", type=Path, help="study files (default: all ohmec_data_*.geojson)")
+  parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, metavar="N",
+                      help="validate N files at a time (default: one per CPU)")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="validate every file, and leave the cache of passing files alone")
+  args = parser.parse_args(argv[1:])
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+  files = args.files or sorted(ROOT.glob("ohmec_data_*.geojson"))
 
   if not files:
     print("no GeoJSON files to validate", file=sys.stderr)
     return 2
 
   all_errors: list[str] = []
+  todo = []
+  digests = {}
   for path in files:
     if not path.is_file():
       all_errors.append(f"{path}: not a file")
       continue
-    errs = validate_file(path)
+    todo.append(path)
+    if not args.no_cache:
+      digests[path] = file_digest(path)
+
+  if GeometryChecker is None:
+    print("numpy not installed: skipping the geometry checks", file=sys.stderr)
+  engine = validator_digest() + ("/geometry" if GeometryChecker is not None else "")
+  passed = [] if args.no_cache else load_cache(CACHE_PATH, engine)
+  known = set(passed)
+  check = [path for path in todo if digests.get(path) not in known]
+  started = time.perf_counter()
+  if len(check) > 1 and args.jobs > 1:
+    with multiprocessing.Pool(min(args.jobs, len(check))) as pool:
+      results = dict(zip(check, pool.map(timed_validate, check, chunksize=1)))
+  else:
+    results = {path: timed_validate(path) for path in check}
+
+  for path in todo:
+    if path not in results:
+      print(f"OK {path.name} (cached)")
+      passed.remove(digests[path])
+      passed.append(digests[path])
+      continue
+    errs, warnings, seconds = results[path]
+    for warning in warnings:
+      print(f"warning: {warning}", file=sys.stderr)
     if errs:
       all_errors.extend(errs)
     else:
-      print(f"OK {path.name}")
+      print(f"OK {path.name} ({seconds:.2f}s)")
+      # a file with warnings is checked again, so they keep being shown
+      if path in digests and digests[path] not in known and not warnings:
+        known.add(digests[path])
+        passed.append(digests[path])
+  if not args.no_cache:
+    save_cache(CACHE_PATH, engine, passed)
 
   if all_errors:
     print("\n".join(all_errors), file=sys.stderr)
     print(f"{len(all_errors)} validation error(s)", file=sys.stderr)
     return 1
 
-  print(f"validated {len(files)} file(s)")
+  print(f"validated {len(todo)} file(s) in {time.perf_counter() - started:.2f}s, {len(todo) - len(check)} from cache")
   return 0
 
 
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Copyright OHMEC contributors.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+"""Watch a study file and recheck its boundaries as it is edited.
+
+The file is loaded and checked once, the way check_boundaries.py does it
+(the same compare_features() verdicts and report lines), and the shapes,
+waivers and the verdict of every pair are kept in memory. The file is
+then polled: a changed mtime or size has it read, and a changed SHA-256
+of its content reloaded. Features whose resolved geometry or properties
+differ, copies of an edited feature included, are compared again, and
+only against the features they share a date and a bounding-box overlap
+with; every other verdict stands.
+
+Each recheck prints the errors it introduced and the ones it resolved,
+then the summary line check_boundaries.py ends with, over the whole
+file. A save that doesn't load (an editor halfway through writing it, a
+broken copy) is reported and the last good state kept until the next
+change. Features are matched by id; duplicate ids are validate_geojson.py's
+business.
+
+Usage: watch_boundaries.py [--interval SECONDS] geojsonfile
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import check_boundaries as cb  # noqa: E402
+from feature_store import POLYGONAL, FeatureStore, FeatureStoreError  # noqa: E402
+from load_ohmec_geojson import load_ohmec_geojson  # noqa: E402
+from ohmec_dates import IntervalIndex  # noqa: E402
+
+# the per-feature state compare_features() reads, in check_boundaries
+_WAIVERS = (cb.borderless, cb.overlap_waiver, cb.double_waiver, cb.point_waiver)
+
+
+def _boxes_meet(a: tuple, b: tuple) -> bool:
+  return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class BoundaryWatch:
+  def __init__(self, path: Path):
+    self.path = Path(path)
+    self.signature = None
+    self.digest = None
+    # fid -> (properties, type, coordinates) as last checked
+    self.state: dict = {}
+    # fid -> (start, end, file index, startdatestr) of the features in the sweep
+    self.swept: dict = {}
+    # (idA, idB) -> (result, report lines), as compare_features() gave them
+    self.verdicts: dict = {}
+
+  def poll(self) -> bytes | None:
+    """The file's content if it changed since the last poll."""
+    try:
+      st = self.path.stat()
+    except FileNotFoundError:  # some editors save by replacing the file
+      return None
+    signature = (st.st_mtime_ns, st.st_size)
+    if signature == self.signature:
+      return None
+    self.signature = signature
+    data = self.path.read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest == self.digest:
+      return None
+    self.digest = digest
+    return data
+
+  def _forget(self, fid) -> None:
+    cb.shapes.pop(fid, None)
+    cb.prepared.pop(fid, None)
+    cb.uses.pop(fid, None)
+    for waiver in _WAIVERS:
+      waiver.pop(fid, None)
+    self.swept.pop(fid, None)
+
+  def sync(self, store: FeatureStore, problems: list) -> set:
+    """Bring the shapes, waivers and sweep entries up to date with store;
+    returns the ids whose verdicts are stale."""
+    state = {}
+    for index, feat in enumerate(store.features):
+      fid = feat["id"]
+      if feat["geometry"]["type"] in POLYGONAL and fid not in state and store.index[fid] == index:
+        geometry = store.geometry(fid)
+        state[fid] = (feat["properties"], geometry["type"], geometry["coordinates"])
+    stale = {fid for fid in self.state if fid not in state}
+    stale.update(fid for fid, entry in state.items() if self.state.get(fid) != entry)
+    for fid in stale:
+      self._forget(fid)
+    self.state = state
+
+    for fid in stale:
+      if fid not in state:
+        continue
+      feat = store[fid]
+      index = store.index[fid]
+      try:
+        cb.check_props(feat)
+        if fid not in cb.borderless:
+          start, end = store.date_range(index)
+      except (KeyError, FeatureStoreError) as err:
+        problems.append(f"{fid}: not checked: {err if isinstance(err, FeatureStoreError) else f'no {err}'}")
+        continue
+      cb.shapes[fid] = store.shape(fid)
+      if not cb.shapes[fid].is_valid:
+        problems.append(f"{fid} is not valid")
+      if fid not in cb.borderless:
+        self.swept[fid] = (start, end, index, feat["properties"]["startdatestr"])
+    # moving features around the file changes which start date a tie reports
+    for fid, (start, end, _index, startdatestr) in list(self.swept.items()):
+      self.swept[fid] = (start, end, store.index[fid], startdatestr)
+    return stale
+
+  def recheck(self, stale: set) -> int:
+    """Compare the stale features with their neighbours; returns the
+    number of pairs compared."""
+    for key in [key for key in self.verdicts if key[0] in stale or key[1] in stale]:
+      del self.verdicts[key]
+    ids = list(self.swept)
+    entries = [self.swept[fid] for fid in ids]
+    dates = IntervalIndex([entry[0] for entry in entries], [entry[1] for entry in entries])
+    compared = 0
+    for fid in stale:
+      if fid not in self.swept:
+        continue
+      start, end, index, _startdatestr = self.swept[fid]
+      bounds = cb.shapes[fid].bounds
+      for position in dates.overlapping(start, end):
+        other = ids[position]
+        if other == fid or not _boxes_meet(bounds, cb.shapes[other].bounds):
+          continue
+        idA, idB = (fid, other) if fid < other else (other, fid)
+        if (idA, idB) in self.verdicts:
+          continue
+        # like check_boundaries: the later start date, on a tie the later feature in the file
+        later = max((entries[position][0], entries[position][2], entries[position][3]),
+                    (start, index, self.swept[fid][3]))
+        out: list[str] = []
+        self.verdicts[(idA, idB)] = (cb.compare_features(idA, idB, later[2], out), out)
+        compared += 1
+    return compared
+
+  def errors(self) -> dict:
+    return {key: out for key, (_res, out) in self.verdicts.items() if out}
+
+  def summary(self) -> str:
+    results = [res for res, _out in self.verdicts.values()]
+    return (f"completed checking {sum(res >= 1 for res in results)} boundaries, with "
+            f"{results.count(2)} overlaps, {results.count(3)} gaps and {results.count(4)} points")
+
+  def update(self, data: bytes) -> bool:
+    """Reload from data and recheck what changed; False if it doesn't load."""
+    started = time.perf_counter()
+    stamp = time.strftime("%H:%M:%S")
+    try:
+      struct, varname = load_ohmec_geojson(data.decode("utf-8"))
+      store = FeatureStore(struct, varname)
+    except (ValueError, KeyError, TypeError) as err:
+      print(f"[{stamp}] {self.path.name}: can't load, keeping the last good version: {err}", flush=True)
+      return False
+    before = self.errors()
+    problems: list[str] = []
+    stale = self.sync(store, problems)
+    compared = self.recheck(stale)
+    after = self.errors()
+    print(f"[{stamp}] {self.path.name}: {len(stale)} feature(s) changed, {compared} pair(s) compared "
+          f"in {time.perf_counter() - started:.2f}s")
+    for problem in problems:
+      print(problem)
+    for key in sorted(after.keys() - before.keys(), key=str):
+      print("\n".join(after[key]))
+    for key in sorted(before.keys() - after.keys(), key=str):
+      print("resolved: " + before[key][0].strip())
+    print(self.summary(), flush=True)
+    return True
+
+
+def main(argv: list[str]) -> int:
+  parser = argparse.ArgumentParser(description="Recheck a study file's boundaries whenever it is saved.")
+  parser.add_argument("filename", type=Path, help="OHMEC geojson file to watch")
+  parser.add_argument("--interval", type=float, default=0.5, metavar="SECONDS",
+                      help="how often to look at the file (default %(default)s)")
+  args = parser.parse_args(argv[1:])
+  if args.interval <= 0:
+    parser.error("--interval must be positive")
+  watch = BoundaryWatch(args.filename)
+  data = watch.poll()
+  if data is None:
+    sys.stderr.write(f"{args.filename}: no such file\n")
+    return 2
+  if not watch.update(data):
+    return 2
+  print(f"watching {args.filename}, Ctrl-C to stop", flush=True)
+  try:
+    while True:
+      time.sleep(args.interval)
+      data = watch.poll()
+      if data is not None:
+        watch.update(data)
+  except KeyboardInterrupt:
+    return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))